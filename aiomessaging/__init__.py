@@ -1,11 +1,12 @@
 """aiomessaging.
 """
 from .app import AiomessagingApp
-from .queues import QueueBackend
+from .queues import QueueBackend, MemoryQueueBackend
 from .event import Event
 from .message import Message, Route, Effect
 
 
 __all__ = [
-    'QueueBackend', 'AiomessagingApp', 'Event', 'Message', 'Route', 'Effect'
+    'QueueBackend', 'MemoryQueueBackend', 'AiomessagingApp', 'Event',
+    'Message', 'Route', 'Effect'
 ]
@@ -24,8 +24,8 @@ class Action(abc.ABC):
         """
         pass  # pragma: no cover
 
-    def execute(self, message, retry=0):
-        """Execute action.
+    async def execute(self, message, retry=0):
+        """Execute action (coroutine).
 
         :param Message message: message to execute action over.
         :param int retry: retry number from effect
@@ -44,8 +44,8 @@ class SendOutputAction(Action):
     def get_output(self):
         return self.output
 
-    def execute(self, message, retry=0):
-        return self.output.send(message, retry)
+    async def execute(self, message, retry=0):
+        return await self.output.deliver(message, retry)
 
 
 class CheckOutputAction(Action):
@@ -61,8 +61,8 @@ class CheckOutputAction(Action):
     def get_output(self):
         return self.output
 
-    def execute(self, message, retry=0):
-        return self.output.check(message)
+    async def execute(self, message, retry=0):
+        return await self.output.call(self.output.check, message)
 
 
 # class CallAction(Action):
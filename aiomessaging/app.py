@@ -8,6 +8,11 @@ from logging.config import dictConfig
 from .config import Config
 from .consumers import ConsumersManager
 from .queues import QueueBackend
+from .outputs import close_batchers, shutdown_executors
+
+
+# max time to wait running calls of blocking outputs on shutdown (seconds)
+EXECUTORS_SHUTDOWN_TIMEOUT = 10
 
 
 def apply_logging_configuration(config):  # pragma: no cover
@@ -110,10 +115,29 @@ class AiomessagingApp:
         self.log.debug('Stopping event loop')
         self.loop.stop()
 
+    async def shutdown_executors(self):
+        """Shutdown thread pools of blocking outputs.
+
+        Running calls are waited in a thread, so hung output call blocks
+        neither the loop nor shutdown (longer than
+        `EXECUTORS_SHUTDOWN_TIMEOUT`).
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            await asyncio.wait_for(
+                loop.run_in_executor(None, shutdown_executors),
+                EXECUTORS_SHUTDOWN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.log.warning("Blocking output calls not completed in %ss",
+                             EXECUTORS_SHUTDOWN_TIMEOUT)
+
     async def shutdown(self):
         """Shutdown application gracefully.
         """
         await self.consumers.stop_all()
+        await close_batchers()
+        await self.shutdown_executors()
 
         await self.queue.close()
         self.log.info("Shutdown complete.")
@@ -5,11 +5,28 @@ from typing import Dict
 
 import yaml
 
-from .queues import QueueBackend
+from .queues import QueueBackend, MemoryQueueBackend
 from .pipeline import EventPipeline, GenerationPipeline
 from .utils import class_from_string
 
 
+CHANNEL_PER_CONSUMER = 'consumer'
+CHANNEL_PER_CLASS = 'class'
+CHANNEL_SHARED = 'shared'
+CHANNEL_MODES = (CHANNEL_PER_CONSUMER, CHANNEL_PER_CLASS, CHANNEL_SHARED)
+
+# generators publish to tmp queue drained by generation consumers of cluster
+GENERATION_QUEUE = 'queue'
+# generators publish straight to messages exchange
+GENERATION_DIRECT = 'direct'
+GENERATION_MODES = (GENERATION_QUEUE, GENERATION_DIRECT)
+
+QUEUE_BACKENDS = {
+    'rabbitmq': QueueBackend,
+    'memory': MemoryQueueBackend,
+}
+
+
 # pylint: disable=too-many-ancestors
 class ConfigLoader(yaml.Loader):
     """YAML config loader.
@@ -140,19 +157,73 @@ class Config(BaseConfig):
             pipeline = GenerationPipeline(pipeline)
         return pipeline
 
+    def get_generation_mode(self, event_type):
+        """Generation mode for event type (`queue` or `direct`).
+        """
+        event_config = self.get_event_config(event_type)
+        mode = event_config.get('generation', GENERATION_QUEUE)
+        if mode not in GENERATION_MODES:
+            raise Exception(f"Unknown generation mode `{mode}` for "
+                            f"{event_type} event")
+        return mode
+
     def get_event_config(self, event_type):
         """Config for particular event type.
         """
         return self.events[event_type]
 
+    def get_consumer_config(self, consumer_type):
+        """Options for consumers of type (event, message, output, generation
+        or cluster).
+
+        Passed to consumer constructor as keyword arguments.
+        """
+        conf = dict(self.get('consumers', {}).get(consumer_type) or {})
+        conf.pop('channel', None)
+        return conf
+
+    def get_consumer_channel(self, consumer_type):
+        """Channel isolation mode for consumers of type.
+
+        `consumer` — every consumer gets own channel (default), `class` — one
+        channel for all consumers of type, `shared` — default channel.
+        """
+        conf = self.get('consumers', {}).get(consumer_type) or {}
+        mode = conf.get('channel', CHANNEL_PER_CONSUMER)
+        if mode not in CHANNEL_MODES:
+            raise Exception(f"Unknown channel mode `{mode}` for "
+                            f"{consumer_type} consumers")
+        return mode
+
+    def get_rate_limits(self):
+        """Output rate limits by output name.
+
+        Limit is a number (messages per second) or dict with `rate` and
+        `burst` keys.
+        """
+        limits = {}
+        for name, limit in (self.get('rate_limits') or {}).items():
+            if not isinstance(limit, dict):
+                limit = {'rate': limit}
+            limits[name] = limit
+        return limits
+
+    def get_circuit_breakers(self):
+        """Output circuit breaker arguments by output name.
+        """
+        return {name: dict(conf or {}) for name, conf
+                in (self.get('circuit_breakers') or {}).items()}
+
     def get_queue_backend(self):
         """Queue backend instance.
 
         Instantiate queue backend based on configuration.
         """
-        conf = self.get('queue', {'backend': 'rabbitmq'})
+        conf = dict(self.get('queue', {'backend': 'rabbitmq'}))
         if not conf:  # pragma: no cover
             raise Exception("No queue configuration")
         backend_name = conf.pop('backend')
-        assert backend_name == 'rabbitmq', "No other choice for a while"
-        return QueueBackend(**conf)
+        if backend_name not in QUEUE_BACKENDS:
+            raise Exception(f"Unknown queue backend `{backend_name}`. "
+                            f"Available: {', '.join(QUEUE_BACKENDS)}")
+        return QUEUE_BACKENDS[backend_name](**conf)
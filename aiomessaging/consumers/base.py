@@ -3,17 +3,29 @@
 import asyncio
 import logging
 
-from typing import List
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from abc import ABC, abstractmethod
 
-import ujson
-
 from ..queues import AbstractQueue
 from ..message import Message
+from ..exceptions import PublishError, UnknownContentType
 from ..logging import ConsumerLoggerAdapter
 
+from .prefetch import AdaptivePrefetch, MIN_PREFETCH, MAX_PREFETCH
+
+
+# default worker pool hand-off buffer size (matches default prefetch count)
+WORKER_BUFFER_SIZE = 100
 
-MONITORING_INTERVAL = 0.1
+# default time to wait in-flight deliveries on stop (seconds)
+STOP_TIMEOUT = 10
+
+# default time to collect deliveries batch (seconds)
+BATCH_WINDOW = 0.005
+
+# time to hold delivery of unknown content type before it is returned to
+# the queue (seconds)
+REQUEUE_DELAY = 5
 
 
 class AbstractConsumer(ABC):
@@ -57,20 +69,100 @@ class AbstractConsumer(ABC):
 class BaseConsumer:
     """Base consumer implementation.
 
+    Every delivery is handled in a separate task by default. Pass `workers` to
+    handle deliveries with fixed number of long-lived worker coroutines
+    reading from bounded hand-off buffer instead: memory and scheduler
+    overhead stays flat on delivery bursts.
+
     :param last_messages_size: max size of last messages queue.
+    :param int workers: number of worker coroutines (task per delivery if not
+                        provided).
+    :param int buffer_size: worker pool hand-off buffer size. Deliveries over
+                            this limit are rejected back to the queue.
+    :param int prefetch_count: prefetch window of consuming queues (channel
+                               default if not provided). Window of worker
+                               pool is limited by pool capacity (`workers`
+                               + `buffer_size`), so broker holds deliveries
+                               pool can't accept instead of redelivering
+                               rejected ones.
+    :param bool adaptive_prefetch: resize prefetch window by observed handler
+                                   latency (see `AdaptivePrefetch`).
+    :param int min_prefetch: min adaptive prefetch window.
+    :param int max_prefetch: max adaptive prefetch window (limited by worker
+                             pool capacity).
+    :param float stop_timeout: time to wait in-flight deliveries on stop,
+                               stragglers are cancelled and redelivered by
+                               broker later (see `on_stop_timeout`).
+    :param int batch_size: handle deliveries in batches of up to this size
+                           with `batch_handler` (can't be used with
+                           workers).
+    :param float batch_window: max time to collect batch.
+
+    Consumer with own prefetch window must consume queues on dedicated
+    channel: window is shared by all consumers of the channel.
     """
     running = False  # determine when we shutdown gracefully
     loop: asyncio.AbstractEventLoop
-    monitoring_task: asyncio.Task
     consuming_queues: List[AbstractQueue]
     last_messages: asyncio.Queue
-
-    def __init__(self, loop=None, debug=False, last_messages_size=5):
+    msg_tasks: Set[asyncio.Task]
+    worker_tasks: List[asyncio.Task]
+    work_queue: Optional[asyncio.Queue]
+    prefetch: Optional[AdaptivePrefetch]
+    stop_timeout_handler: Callable
+    _batch: List[Tuple]
+    _batch_handle: Optional[asyncio.Handle]
+    _unknown_content_types: Set[str]
+    # held deliveries of unknown content type by requeue timer
+    _requeue_handles: Dict[asyncio.Handle, Tuple]
+    requeue_delay = REQUEUE_DELAY
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, loop=None, debug=False, last_messages_size=5,
+                 workers=None, buffer_size=WORKER_BUFFER_SIZE,
+                 prefetch_count=None, adaptive_prefetch=False,
+                 min_prefetch=MIN_PREFETCH, max_prefetch=MAX_PREFETCH,
+                 stop_timeout=STOP_TIMEOUT, batch_size=None,
+                 batch_window=BATCH_WINDOW):
+        assert not (workers and batch_size), \
+            "Batch mode can't be used with workers"
         self.loop = loop or asyncio.get_event_loop()
         self.debug = debug
+        self.stop_timeout = stop_timeout
+
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._batch = []
+        self._batch_handle = None
 
         self.consuming_queues = []
-        self.msg_tasks = []
+        self.msg_tasks = set()
+        self._unknown_content_types = set()
+        self._requeue_handles = {}
+
+        self.workers = workers
+        self.worker_tasks = []
+        self.work_queue = None
+        if workers:
+            # deliveries handed to idle workers stay in queue until workers
+            # are scheduled, so burst of full window fits in
+            self.work_queue = asyncio.Queue(maxsize=workers + buffer_size)
+
+        self.prefetch_count = prefetch_count
+        self.prefetch = None
+        self.in_flight = 0
+        if workers:
+            # deliveries over pool capacity would be rejected anyway
+            capacity = workers + buffer_size
+            self.prefetch_count = min(prefetch_count or capacity, capacity)
+            max_prefetch = min(max_prefetch, capacity)
+        if adaptive_prefetch:
+            self.prefetch = AdaptivePrefetch(
+                initial=prefetch_count,
+                min_count=min(min_prefetch, max_prefetch),
+                max_count=max_prefetch
+            )
+            self.prefetch_count = self.prefetch.prefetch_count
 
         self.last_messages = asyncio.Queue(maxsize=last_messages_size)
 
@@ -80,17 +172,20 @@ class BaseConsumer:
         )
 
     async def start(self):
-        """Start consumer and monitoring tasks.
+        """Start consumer and worker tasks.
         """
-        assert not self.running and not hasattr(self, 'monitoring_task')
+        assert not self.running
         self.running = True
-        self.monitoring_task = self.loop.create_task(self._monitoring())
+        for _ in range(self.workers or 0):
+            self.worker_tasks.append(self.loop.create_task(self._worker()))
 
     def consume(self, queue):
         """Consume coroutine.
 
         Create task for incoming message.
         """
+        if self.prefetch_count is not None:
+            queue.set_prefetch(self.prefetch_count)
         queue.consume(self._handler)
         self.consuming_queues.append(queue)
 
@@ -104,42 +199,186 @@ class BaseConsumer:
         self.consuming_queues.remove(queue)
         queue.close()
 
-    async def _monitoring(self):
-        while self.running:
-            # TODO: GenerationConsumer._monitor_generation() pending task was
-            #       destroyed warning printed to logs with shorter sleep.
-            await asyncio.sleep(MONITORING_INTERVAL)
-            for task in self.msg_tasks:
-                if task.done():
-                    self.msg_tasks.remove(task)
-                    del task
+    def channels(self) -> Dict[str, Tuple[str, Optional[int]]]:
+        """Channel name and number by consuming queue name.
+        """
+        return {queue.name: (queue.channel_name, queue.channel_number)
+                for queue in self.consuming_queues}
 
     def _handler(self, queue, channel, basic_deliver, properties, body):
-        self.log.debug('Start task execution (_handler): %s', body)
-        # pylint: disable=c-extension-no-member
-        task = self.loop.create_task(
-            self._handler_task(
-                ujson.loads(body),
-                channel,
-                basic_deliver.delivery_tag
-            )
-        )
-        self.msg_tasks.append(task)
+        """Delivery handler.
 
-    async def _handler_task(self, body, channel, delivery_tag):
+        Return True if delivery was passed to handler (False if rejected or
+        held).
+        """
+        self.log.debug('Start task execution (_handler): %s', body)
+        acks = queue.acks
+        acks.track(channel, basic_deliver.delivery_tag)
+        try:
+            message = queue.decode(properties, body)
+        except UnknownContentType:
+            # other node may know it, but immediate requeue would redeliver
+            # it to this consumer in a loop
+            if properties.content_type not in self._unknown_content_types:
+                self._unknown_content_types.add(properties.content_type)
+                self.log.warning("Unknown content type %s, return message "
+                                 "to the queue in %ss",
+                                 properties.content_type, self.requeue_delay)
+            self._requeue_later(acks, channel, basic_deliver.delivery_tag)
+            return False
+        # pylint: disable=broad-except
+        except Exception:
+            self.log.exception("Can't decode message, drop it")
+            acks.nack(channel, basic_deliver.delivery_tag, requeue=False)
+            return False
+        item = (message, acks, channel, basic_deliver.delivery_tag)
+        if self.batch_size:
+            self._add_to_batch(item)
+            return True
+        if self.work_queue is None:
+            self.in_flight += 1
+            task = self.loop.create_task(self._handler_task(*item))
+            self.msg_tasks.add(task)
+            task.add_done_callback(self.msg_tasks.discard)
+            return True
+        try:
+            self.work_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.log.warning("Worker buffer is full, reject delivery")
+            acks.nack(channel, basic_deliver.delivery_tag, requeue=True)
+            return False
+        self.in_flight += 1
+        return True
+
+    async def _worker(self):
+        """Worker coroutine.
+
+        Handle deliveries from hand-off buffer one by one.
+        """
+        while True:
+            item = await self.work_queue.get()
+            try:
+                await self._handler_task(*item)
+            finally:
+                self.work_queue.task_done()
+
+    # pylint: disable=too-many-arguments
+    async def _handler_task(self, body, acks, channel, delivery_tag):
+        started = self.loop.time()
         try:
-            # TODO: retry (republish), drop, explicit nack(?) handling
+            # TODO: retry (republish) of messages failed in handler, they
+            # are abandoned (left unacked) for now
             await self.handler(body)
-            # TODO: ack only in case of success of handler
-            channel.basic_ack(delivery_tag)
-            # TODO: wait for ack ok
+            self._observe_latency(self.loop.time() - started)
+            # handler waits for downstream publish confirmation, so message
+            # acked only after it was safely passed to the next stage.
+            # Acks are coalesced per channel (see `AckCoalescer`)
+            acks.ack(channel, delivery_tag)
             while self.last_messages.full():
                 # drop old messages
                 await self.last_messages.get()
             await self.last_messages.put(body)
+        except PublishError:
+            self.log.warning("Downstream publish not confirmed, requeue "
+                             "message", exc_info=True)
+            acks.nack(channel, delivery_tag, requeue=True)
         # pylint: disable=broad-except
         except Exception:  # pragma: no cover
             self.log.exception("Error in handler task")
+            acks.abandon(channel, delivery_tag)
+        finally:
+            self.in_flight -= 1
+
+    def _requeue_later(self, acks, channel, delivery_tag):
+        """Hold delivery for `requeue_delay` and return it to the queue.
+        """
+        handle = self.loop.call_later(self.requeue_delay, self._requeue)
+        self._requeue_handles[handle] = (acks, channel, delivery_tag)
+
+    def _requeue(self, handles=None):
+        """Return held deliveries with expired delay (or given ones).
+        """
+        if handles is None:
+            now = self.loop.time()
+            handles = [handle for handle in self._requeue_handles
+                       if handle.when() <= now]
+        for handle in handles:
+            handle.cancel()
+            acks, channel, delivery_tag = self._requeue_handles.pop(handle)
+            if channel.is_open:
+                # closed channel requeues it anyway
+                acks.nack(channel, delivery_tag, requeue=True)
+
+    def _add_to_batch(self, item):
+        """Add delivery to batch, send batch to handler if it is full.
+        """
+        self.in_flight += 1
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+        elif self._batch_handle is None:
+            self._batch_handle = self.loop.call_later(self.batch_window,
+                                                      self._flush_batch)
+
+    def _flush_batch(self):
+        """Start handler task for collected batch.
+        """
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        task = self.loop.create_task(self._batch_task(batch))
+        self.msg_tasks.add(task)
+        task.add_done_callback(self.msg_tasks.discard)
+
+    async def _batch_task(self, batch):
+        """Handle batch of deliveries.
+
+        Whole batch is acked (with multiple ack where possible) or rejected.
+        """
+        started = self.loop.time()
+        try:
+            await self.batch_handler([item[0] for item in batch])
+            self._observe_latency(self.loop.time() - started)
+            for _, acks, channel, delivery_tag in batch:
+                acks.ack(channel, delivery_tag)
+            for acks, channel in {item[1:3] for item in batch}:
+                acks.flush(channel)
+            for item in batch:
+                while self.last_messages.full():
+                    await self.last_messages.get()
+                await self.last_messages.put(item[0])
+        except PublishError:
+            self.log.warning("Downstream publish not confirmed, requeue "
+                             "batch", exc_info=True)
+            for _, acks, channel, delivery_tag in batch:
+                acks.nack(channel, delivery_tag, requeue=True)
+        # pylint: disable=broad-except
+        except Exception:  # pragma: no cover
+            self.log.exception("Error in batch handler task")
+            for _, acks, channel, delivery_tag in batch:
+                acks.abandon(channel, delivery_tag)
+        finally:
+            self.in_flight -= len(batch)
+
+    def _observe_latency(self, duration):
+        """Feed handler latency to adaptive prefetch and apply new window.
+        """
+        if self.prefetch is None:
+            return
+        prefetch_count = self.prefetch.observe(duration, self.in_flight,
+                                               self.loop.time())
+        if prefetch_count is None:
+            return
+        self.log.debug("Prefetch window %i -> %i (latency %.4fs)",
+                       self.prefetch_count, prefetch_count,
+                       self.prefetch.latency)
+        self.prefetch_count = prefetch_count
+        # sent once for every channel of consuming queues
+        for queue in self.consuming_queues:
+            queue.set_prefetch(prefetch_count)
 
     async def handler(self, message):
         """Queue message handler.
@@ -148,25 +387,78 @@ class BaseConsumer:
         """
         raise NotImplementedError  # pragma: no cover
 
+    async def batch_handler(self, messages):
+        """Batch of queue messages handler.
+
+        Handle messages one by one by default.
+        """
+        for message in messages:
+            await self.handler(message)
+
+    def on_stop_timeout(self, handler):
+        """Add stop timeout callback.
+
+        Handler will be invoked if in-flight deliveries were not completed in
+        `stop_timeout` and will receive number of them.
+        """
+        self.stop_timeout_handler = handler
+
     # pylint: disable=too-many-branches
     async def stop(self):
         """Stop consumer.
 
-        Graceful shutdown all coroutines.
+        Graceful shutdown all coroutines: stop consume, wait in-flight
+        deliveries up to `stop_timeout` and cancel stragglers.
         """
         self.running = False
         self.log.info('Stop consumer')
 
-        for queue in self.consuming_queues:
+        acks = {queue.acks for queue in self.consuming_queues}
+        for queue in list(self.consuming_queues):
             self.cancel(queue)
 
         await asyncio.sleep(0)
+        self._flush_batch()
+        self._requeue(list(self._requeue_handles))
+        await self._drain()
+
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
 
-        if getattr(self, 'monitoring_task', False):
-            await asyncio.wait_for(self.monitoring_task, 2)
+        for coalescer in acks:
+            coalescer.flush()
 
         self.log.debug('Stopped.')
 
+    async def _drain(self):
+        """Wait in-flight deliveries to complete.
+
+        Deliveries not completed in `stop_timeout` are reported and
+        cancelled (left unacknowledged).
+        """
+        waiters = set(self.msg_tasks)
+        if self.work_queue is not None and self.in_flight:
+            waiters.add(self.loop.create_task(self.work_queue.join()))
+        if not waiters:
+            return
+        self.log.info("Wait %i in-flight deliveries", self.in_flight)
+        _, pending = await asyncio.wait(waiters, timeout=self.stop_timeout)
+        if not pending:
+            return
+        self.log.warning("%i in-flight deliveries not completed in %ss",
+                         self.in_flight, self.stop_timeout)
+        if hasattr(self, 'stop_timeout_handler'):
+            try:
+                await self.stop_timeout_handler(self.in_flight)
+            # pylint: disable=broad-except
+            except Exception:  # pragma: no cover
+                self.log.exception("Exception in stop timeout handler")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
 
 # pylint: disable=abstract-method
 class SingleQueueConsumer(BaseConsumer):
@@ -197,6 +489,13 @@ class MessageConsumerMixIn:
         obj = Message.from_dict(message)
         await self.handle_message(obj)
 
+    async def batch_handler(self, messages):
+        """Internal batch handler.
+
+        Converts queue messages to Message instances.
+        """
+        await self.handle_batch([Message.from_dict(m) for m in messages])
+
     async def handle_message(self, message: Message):
         """Message handler.
 
@@ -204,6 +503,14 @@ class MessageConsumerMixIn:
         """
         raise NotImplementedError  # pragma: no cover
 
+    async def handle_batch(self, messages: List[Message]):
+        """Batch of messages handler.
+
+        Handle messages one by one by default.
+        """
+        for message in messages:
+            await self.handle_message(message)
+
 
 class BaseMessageConsumer(MessageConsumerMixIn, SingleQueueConsumer):
 
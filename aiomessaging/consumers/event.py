@@ -1,11 +1,69 @@
 """Event consumer.
 """
-from typing import Callable
+import asyncio
+
+from typing import Callable, Optional, Set
 
 from ..event import Event
+from ..exceptions import PublishError
 # from ..exceptions import DropException, DelayException
 
 from .base import SingleQueueConsumer
+from .generation import end_of_stream
+
+
+class PublishTracker:
+
+    """Queue wrapper tracking publish confirmations.
+
+    Passed to generators instead of the queue, so event is acknowledged
+    only after everything generators published was confirmed, whatever
+    `confirm` they pass.
+    """
+
+    _pending: Set[asyncio.Future]
+    _error: Optional[BaseException]
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._pending = set()
+        self._error = None
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
+
+    async def publish(self, *args, **kwargs) -> asyncio.Future:
+        """Publish message (see `Queue.publish`).
+        """
+        return self._track(await self.queue.publish(*args, **kwargs))
+
+    async def publish_many(self, *args, **kwargs) -> asyncio.Future:
+        """Publish batch of messages (see `Queue.publish_many`).
+        """
+        return self._track(await self.queue.publish_many(*args, **kwargs))
+
+    async def wait(self):
+        """Wait all publishes to be confirmed.
+
+        Raise first publish error (`PublishError`).
+        """
+        while self._pending:
+            await asyncio.wait(list(self._pending))
+        if self._error is not None:
+            raise self._error
+
+    def _track(self, future: asyncio.Future) -> asyncio.Future:
+        if future.done():
+            self._done(future)
+        else:
+            self._pending.add(future)
+            future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: asyncio.Future):
+        self._pending.discard(future)
+        if self._error is None and not future.cancelled():
+            self._error = future.exception()
 
 
 class EventConsumer(SingleQueueConsumer):
@@ -14,18 +72,25 @@ class EventConsumer(SingleQueueConsumer):
 
     Receive messages from inbound queue, pass it though event pipeline and
     generate messages using generation pipeline.
+
+    Generators publish to tmp queue drained by generation consumers of the
+    cluster by default. With `direct=True` they publish straight to the
+    messages queue, which saves tmp queue declare/delete, cluster broadcast
+    and one broker hop per event.
     """
 
     queue_prefix = "aiomessaging.events"
     generation_complete_handler: Callable
 
+    # pylint: disable=too-many-arguments
     def __init__(self, event_type, event_pipeline, generators,
-                 queue_service, **kwargs):
+                 queue_service, direct=False, **kwargs):
         super().__init__(**kwargs)
         self.event_type = event_type
         self.pipeline = event_pipeline
         self.generators = generators
         self.queue_service = queue_service
+        self.direct = direct
 
     def on_generation_complete(self, handler):
         """Add generation complete callback.
@@ -36,7 +101,7 @@ class EventConsumer(SingleQueueConsumer):
         self.generation_complete_handler = handler
 
     async def handler(self, message):
-        event = Event('example_event', payload=message)
+        event = Event(self.event_type, payload=message)
         event.log.info("Event received")
         try:
             await self.handle_event(event)
@@ -44,6 +109,8 @@ class EventConsumer(SingleQueueConsumer):
         #     pass
         # except DelayException:
         #     pass
+        except PublishError:
+            raise
         except Exception:  # pylint: disable=broad-except
             self.log.exception("Exception in event handler")
 
@@ -58,15 +125,31 @@ class EventConsumer(SingleQueueConsumer):
     async def generate_messages(self, event: Event):
         """Generate messages from event.
 
-        Start generators and pass tmp queue to them. Wait them to finish.
+        Start generators and pass tmp queue (or messages queue in direct
+        mode) to them. Wait them to finish and generated messages to be
+        confirmed.
         """
         event.log.info("Start generation")
+        if self.direct:
+            queue = await self.queue_service.messages_queue(self.event_type)
+            await self.generate(queue, event)
+            event.log.info("Generation finished")
+            return
         tmp_queue = await self.queue_service.generation_queue(self.event_type)
-        await self.generators(tmp_queue, event)
+        await self.generate(tmp_queue, event)
         # TODO: check generator results. Stop if failed.
+        # generation consumer deletes tmp queue when marker received
+        await tmp_queue.publish(end_of_stream(tmp_queue.name), confirm=True)
         await self.start_consume(tmp_queue)
         event.log.info("Generation finished")
 
+    async def generate(self, queue, event: Event):
+        """Run generators and wait their messages to be confirmed.
+        """
+        tracker = PublishTracker(queue)
+        await self.generators(tracker, event)
+        await tracker.wait()
+
     async def start_consume(self, queue):
         """ Start consume queue with generated messages
         """
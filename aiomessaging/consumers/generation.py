@@ -1,8 +1,10 @@
 """Generation consumer.
 """
-import time
+import heapq
 import asyncio
-from typing import Dict, Optional
+import itertools
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
 
 from ..message import Message
 from ..queues import AbstractQueue
@@ -12,20 +14,52 @@ from .base import MessageConsumerMixIn, BaseConsumer
 
 QUEUE_CLEANUP_TIMEOUT = 10
 
+# end-of-stream marker key, value is tmp queue name
+END_OF_STREAM = 'end_of_stream'
+
+
+def end_of_stream(queue_name) -> dict:
+    """End-of-stream marker published to tmp queue after generation.
+    """
+    return {END_OF_STREAM: queue_name}
+
 
 class GenerationConsumer(MessageConsumerMixIn, BaseConsumer):
 
     """Generation consumer.
 
     Receive message from tmp generation queue and place them to the provided
-    messages queue.
+    messages queue. Messages are published with event type routing key, so
+    one consumer serves all event types through shared messages exchange
+    (see `AbstractQueueBackend.messages_exchange`).
+
+    Tmp queue is cancelled as soon as its end-of-stream marker received.
+    Queues without marker (generation failed or marker went to another node)
+    are cancelled after `cleanup_timeout` of silence, idle deadlines are kept
+    in heap ordered by time.
+
+    Only consumer of this node is cancelled, tmp queue is auto-deleted by
+    broker after consumers of all nodes are gone. So deliveries handled (and
+    maybe requeued) by other nodes are not lost.
     """
 
     # messages from tmp generation queue will be drained to this queue
     messages_queue: AbstractQueue
 
-    # last received message time for each consumed queue
-    last_recived_time: Dict[AbstractQueue, int]
+    # last received message time (loop time) for each consumed queue
+    last_recived_time: Dict[AbstractQueue, float]
+
+    # idle deadlines heap, entries are checked against last received time
+    # when deadline expires
+    _deadlines: List[Tuple[float, int, AbstractQueue]]
+
+    # consumed queue of delivery by (channel, delivery tag)
+    _delivery_queues: Dict[Tuple[Any, int], AbstractQueue]
+    # number of messages being handled for each consumed queue (markers are
+    # not counted)
+    _queue_in_flight: Counter
+    # notified every time delivery is settled
+    _settled: asyncio.Condition
 
     _consumer_monitoring_task: Optional[asyncio.Task]
 
@@ -33,13 +67,23 @@ class GenerationConsumer(MessageConsumerMixIn, BaseConsumer):
                  messages_queue: AbstractQueue,
                  cleanup_timeout=QUEUE_CLEANUP_TIMEOUT,
                  **kwargs) -> None:
+        # end-of-stream marker must be handled apart from messages
+        assert not kwargs.get('batch_size'), \
+            "Batch mode can't be used with generation consumer"
         super().__init__(**kwargs)
         self.messages_queue = messages_queue
         self.last_recived_time = {}
         self.cleanup_timeout = cleanup_timeout
 
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
         self._consumer_monitoring_task = None
 
+        self._delivery_queues = {}
+        self._queue_in_flight = Counter()
+        self._settled = asyncio.Condition()
+
     async def start(self):
         """Start generation consumer.
 
@@ -51,12 +95,17 @@ class GenerationConsumer(MessageConsumerMixIn, BaseConsumer):
     async def stop(self):
         """Stop generation consumer.
 
-        Also stop generation task.
+        Also stop generation task. Cancelled tmp queues are auto-deleted by
+        broker if no other node consumes them.
         """
         await super().stop()
         await self._stop_consumer_monitoring()
-        for queue in self.last_recived_time:
-            await queue.delete()
+
+    async def handler(self, message):
+        if END_OF_STREAM in message:
+            await self.end_of_stream(message[END_OF_STREAM])
+            return
+        await super().handler(message)
 
     async def handle_message(self, message: Message):
         message.log.debug("Send message to output")
@@ -67,22 +116,56 @@ class GenerationConsumer(MessageConsumerMixIn, BaseConsumer):
         """
         await self.messages_queue.publish(
             message.to_dict(),
-            routing_key=message.type
+            routing_key=message.type,
+            confirm=True
         )
         self.log.debug("Generated message passed to output exchange %s",
                        self.messages_queue)
 
+    async def end_of_stream(self, queue_name):
+        """Stop consume drained tmp queue.
+
+        Messages published before marker were already delivered, but ones
+        still handled by this node can be requeued behind the marker. So
+        marker is published again after they are settled, and queue is
+        cancelled only when marker is the last delivery of the queue.
+        """
+        for queue in self.consuming_queues:
+            if queue.name == queue_name:
+                break
+        else:
+            return
+        if self._queue_in_flight[queue]:
+            async with self._settled:
+                await self._settled.wait_for(
+                    lambda: not self._queue_in_flight[queue]
+                )
+            await queue.publish(end_of_stream(queue_name), confirm=True)
+            queue.log.debug('End-of-stream marker republished behind '
+                            'in-flight deliveries')
+            return
+        self.cancel(queue)
+        queue.log.debug('Drained. Cancel by end-of-stream marker')
+
     def consume(self, queue):
         """Start consume provided queue.
         """
         super().consume(queue)
-        self.last_recived_time[queue] = time.time()
+        now = self.loop.time()
+        self.last_recived_time[queue] = now
+        heapq.heappush(self._deadlines, (now + self.cleanup_timeout,
+                                         next(self._counter), queue))
+        self._wakeup.set()
 
     def cancel(self, queue):
         """Stop consume provided queue.
         """
         super().cancel(queue)
         del self.last_recived_time[queue]
+        self._delivery_queues = {
+            key: value for key, value in self._delivery_queues.items()
+            if value is not queue
+        }
 
     # pylint: disable=arguments-differ
     def _handler(self, queue, *args, **kwargs):
@@ -90,8 +173,33 @@ class GenerationConsumer(MessageConsumerMixIn, BaseConsumer):
 
         Catch queue argument and update last message time for this queue.
         """
-        self.last_recived_time[queue] = time.time()
-        super()._handler(queue, *args, **kwargs)
+        self.last_recived_time[queue] = self.loop.time()
+        channel, basic_deliver = args[:2]
+        key = (channel, basic_deliver.delivery_tag)
+        self._delivery_queues[key] = queue
+        if not super()._handler(queue, *args, **kwargs):
+            # rejected or held, handler task won't take it
+            del self._delivery_queues[key]
+            return False
+        return True
+
+    # pylint: disable=too-many-arguments
+    async def _handler_task(self, body, acks, channel, delivery_tag):
+        """Handle delivery and count message in-flight for its queue.
+        """
+        queue = self._delivery_queues.pop((channel, delivery_tag), None)
+        if END_OF_STREAM in body:
+            await super()._handler_task(body, acks, channel, delivery_tag)
+            return
+        self._queue_in_flight[queue] += 1
+        try:
+            await super()._handler_task(body, acks, channel, delivery_tag)
+        finally:
+            self._queue_in_flight[queue] -= 1
+            if not self._queue_in_flight[queue]:
+                del self._queue_in_flight[queue]
+            async with self._settled:
+                self._settled.notify_all()
 
     def _start_consumer_monitoring(self):
         """Start monitoring task.
@@ -104,18 +212,41 @@ class GenerationConsumer(MessageConsumerMixIn, BaseConsumer):
         """Cancel monitoring task.
         """
         if self._consumer_monitoring_task:
+            self._wakeup.set()
             await self._consumer_monitoring_task
 
     async def _consumer_monitoring(self):
         """Consumer monitoring coroutine.
+
+        Sleep until the nearest idle deadline (or new queue consumed).
         """
         while self.running:
-            for queue, last_time in self.last_recived_time.copy().items():
-                if time.time() - last_time > self.cleanup_timeout:
-                    self.cancel(queue)
-                    await queue.delete()
-                    queue.log.debug(
-                        'Empty. Cancel by generation monitoring after %f',
-                        self.cleanup_timeout
-                    )
-            await asyncio.sleep(0.1)
+            timeout = None
+            if self._deadlines:
+                timeout = max(0, self._deadlines[0][0] - self.loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._cleanup_idle()
+
+    async def _cleanup_idle(self):
+        """Delete queues idle for `cleanup_timeout`.
+        """
+        now = self.loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, queue = heapq.heappop(self._deadlines)
+            last_time = self.last_recived_time.get(queue)
+            if last_time is None:
+                continue  # already cancelled
+            deadline = last_time + self.cleanup_timeout
+            if deadline > now:
+                heapq.heappush(self._deadlines,
+                               (deadline, next(self._counter), queue))
+                continue
+            self.cancel(queue)
+            queue.log.debug(
+                'Empty. Cancel by generation monitoring after %f',
+                self.cleanup_timeout
+            )
@@ -7,8 +7,14 @@ from typing import Dict
 from collections import defaultdict
 
 from ..queues import QueueBackend
-from ..config import Config
+from ..config import (
+    Config,
+    CHANNEL_PER_CLASS,
+    CHANNEL_SHARED,
+    GENERATION_DIRECT,
+)
 from ..router import Router
+from ..outputs import set_circuit_breaker, set_rate_limit
 from ..cluster import Cluster
 
 from .event import EventConsumer
@@ -54,6 +60,11 @@ class ConsumersManager:
         if loop:
             self.loop = loop
 
+        for output, limit in self.config.get_rate_limits().items():
+            set_rate_limit(output, **limit)
+        for output, conf in self.config.get_circuit_breakers().items():
+            set_circuit_breaker(output, **conf)
+
         await self.start_generation_consumer()
         await self.create_cluster()
         await self.create_event_consumers()
@@ -75,10 +86,13 @@ class ConsumersManager:
     async def create_cluster(self):
         """Create Cluster instance and start cluster queue handling.
         """
-        queue = await self.queue.cluster_queue()
+        queue = await self.queue.cluster_queue(
+            channel_name=self.consumer_channel('cluster')
+        )
         self.cluster = Cluster(
             queue=queue,
-            loop=self.loop
+            loop=self.loop,
+            **self.config.get_consumer_config('cluster')
         )
         self.cluster.on_start_consume(self.consume_generation_queue)
         self.cluster.on_output_observed(self.on_cluster_output_observed)
@@ -96,7 +110,10 @@ class ConsumersManager:
         """
         self.log.debug('Start consume tmp queue %s (start_consume received '
                        'from cluster)', queue_name)
-        queue = await self.queue.generation_queue(name=queue_name)
+        queue = await self.queue.generation_queue(
+            name=queue_name,
+            channel_name=self.consumer_channel('generation')
+        )
         self.generation_consumer.consume(queue)
 
     async def create_event_consumers(self):
@@ -105,15 +122,22 @@ class ConsumersManager:
         for event_type in self.event_types():
             event_pipeline = self.config.get_event_pipeline(event_type)
             generators = self.config.get_generators(event_type)
+            direct = self.config.get_generation_mode(event_type) \
+                == GENERATION_DIRECT
 
             consumer = EventConsumer(
                 event_type=event_type,
                 event_pipeline=event_pipeline,
                 generators=generators,
-                queue=await self.queue.events_queue(event_type),
+                direct=direct,
+                queue=await self.queue.events_queue(
+                    event_type,
+                    channel_name=self.consumer_channel('event', event_type)
+                ),
                 # TODO: replace with tmp queue factory?
                 queue_service=self.queue,
                 loop=self.loop,
+                **self.config.get_consumer_config('event')
             )
             consumer.on_generation_complete(self.cluster.start_consume)
             await consumer.start()
@@ -130,10 +154,17 @@ class ConsumersManager:
                 event_type,
                 router=self.get_router(event_type),
                 output_queue=await self.queue.output_queue(event_type),
-                queue=await self.queue.messages_queue(event_type),
-                loop=self.loop
+                queue=await self.queue.messages_queue(
+                    event_type,
+                    channel_name=self.consumer_channel('message', event_type)
+                ),
+                loop=self.loop,
+                **self.config.get_consumer_config('message')
             )
             consumer.on_output_observed(self.on_output_observed)
+            for output, group in self.output_consumers.items():
+                if event_type in group:
+                    consumer.add_local_output(output, group[event_type])
             await consumer.start()
             self.message_consumers[event_type] = consumer
 
@@ -154,16 +185,25 @@ class ConsumersManager:
         """
         if output in self.output_consumers and event_type in self.output_consumers[output]:
             return
-        queue = await self.queue.output_queue(event_type, output)
+        queue = await self.queue.output_queue(
+            event_type, output,
+            channel_name=self.consumer_channel('output', event_type, output)
+        )
         messages_queue = await self.queue.messages_queue(event_type)
-        self.output_consumers[output][event_type] = OutputConsumer(
+        consumer = OutputConsumer(
             router=self.get_router(event_type),
             event_type=event_type,
             messages_queue=messages_queue,
             queue=queue,
-            loop=self.loop
+            loop=self.loop,
+            **self.config.get_consumer_config('output')
         )
-        await self.output_consumers[output][event_type].start()
+        self.output_consumers[output][event_type] = consumer
+        await consumer.start()
+        # let message consumer apply effects of this output in-process
+        if event_type in self.message_consumers:
+            self.message_consumers[event_type].add_local_output(output,
+                                                                consumer)
 
     async def start_generation_consumer(self):
         """Listen generation queue of cluster for queue names to consume.
@@ -172,9 +212,14 @@ class ConsumersManager:
         """
         self.log.debug("Listen clusters generation queue")
 
+        # messages queues must be bound before generated messages are routed
+        for event_type in self.event_types():
+            await self.queue.messages_queue(event_type)
+
         self.generation_consumer = GenerationConsumer(
-            messages_queue=await self.queue.messages_queue('example_event'),
-            loop=self.loop
+            messages_queue=await self.queue.messages_exchange(),
+            loop=self.loop,
+            **self.config.get_consumer_config('generation')
         )
         await self.generation_consumer.start()
 
@@ -183,13 +228,51 @@ class ConsumersManager:
         """
         await self.generation_consumer.stop()
 
-    # pylint: disable=no-self-use
     def event_types(self):
         """Get event types served by this instance.
 
-        FIXME
+        Every event type from config gets its own event, message and output
+        consumers.
+        """
+        return list(self.config.events)
+
+    def consumer_channel(self, consumer_type, *names):
+        """Get backend channel name for consumer queue.
+
+        Every consumer gets dedicated channel by default, so backed-up
+        consumer can't starve others with shared prefetch window or flow
+        control. Consumers of type can share one channel (`class` mode) or
+        default one (`shared` mode) unless they have own prefetch window.
+        """
+        mode = self.config.get_consumer_channel(consumer_type)
+        conf = self.config.get_consumer_config(consumer_type)
+        # worker pool window is limited by pool capacity
+        own_window = conf.get('prefetch_count') is not None \
+            or conf.get('adaptive_prefetch') or conf.get('workers')
+        if mode == CHANNEL_SHARED and not own_window:
+            return 'default'
+        if mode == CHANNEL_PER_CLASS and not own_window:
+            return consumer_type
+        return '.'.join((consumer_type,) + names)
+
+    def channel_assignment(self):
+        """Channels of consumed queues by consumer.
+
+        Return dict `{consumer: {queue name: (channel name, number)}}`.
         """
-        return ['example_event']
+        consumers = {
+            'cluster': self.cluster,
+            'generation': self.generation_consumer,
+        }
+        for event_type, consumer in self.event_consumers.items():
+            consumers[f'event.{event_type}'] = consumer
+        for event_type, consumer in self.message_consumers.items():
+            consumers[f'message.{event_type}'] = consumer
+        for output, group in self.output_consumers.items():
+            for event_type, consumer in group.items():
+                consumers[f'output.{event_type}.{output}'] = consumer
+        return {name: consumer.channels()
+                for name, consumer in consumers.items()}
 
     def get_router(self, event_type) -> Router:
         """Get router instance for event type.
@@ -1,13 +1,25 @@
 """Message consumer.
 """
-from typing import Callable
+import time
+import asyncio
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
 
 from ..message import Message
 from ..router import Router
 from ..queues import AbstractQueue
 from ..actions import SendOutputAction, CheckOutputAction
+from ..exceptions import PublishError
 
 from .base import BaseMessageConsumer
+from .output import OutputConsumer
+
+
+# time to suppress repeated output observed notifications (seconds)
+OBSERVED_TTL = 60
+
+# max number of effects applied in-process before hand-off through broker
+LOCAL_STEPS = 10
 
 
 class OutputNotAvailable(Exception):
@@ -28,6 +40,17 @@ class MessageConsumer(BaseMessageConsumer):
 
     Output queue used to distribute message delivery between all subscribed
     workers.
+
+    Output observed handler is invoked once per output in `observed_ttl`
+    seconds, so cluster is notified about new outputs only (and refreshed
+    periodically for nodes joined later). Skipped notifications are counted
+    in `observed_suppressed`.
+
+    With `local_outputs=True` effects of outputs consumed by this process
+    (see `add_local_output`) are applied in-process, without round-trip
+    through output and messages queues. Message is handed off through the
+    broker when next output is not local, next step is delayed or after
+    `local_steps` effects.
     """
 
     event_type: str
@@ -35,46 +58,155 @@ class MessageConsumer(BaseMessageConsumer):
     output_queue: AbstractQueue
     output_observed_handler: Callable
 
+    # observed outputs expiration time by (event type, output name)
+    observed: Dict[Tuple[str, str], float]
+    observed_suppressed: int
+
+    # output consumers of this process by output name
+    local_consumers: Dict[str, OutputConsumer]
+
+    # pylint: disable=too-many-arguments
     def __init__(self, event_type, router: Router, output_queue,
-                 **kwargs) -> None:
+                 observed_ttl=OBSERVED_TTL, local_outputs=False,
+                 local_steps=LOCAL_STEPS, **kwargs) -> None:
         super().__init__(**kwargs)
         self.event_type = event_type
         self.router = router
         self.output_queue = output_queue
+        self.observed_ttl = observed_ttl
+        self.observed = {}
+        self.observed_suppressed = 0
+        self.local_outputs = local_outputs
+        self.local_steps = local_steps
+        self.local_consumers = {}
 
     def on_output_observed(self, handler):
         """Set output observed handler.
         """
         self.output_observed_handler = handler
 
+    def add_local_output(self, output_name, consumer: OutputConsumer):
+        """Register output consumer running in this process.
+        """
+        self.local_consumers[output_name] = consumer
+
+    def get_local_output(self, output) -> Optional[OutputConsumer]:
+        """Get output consumer to apply effect in-process.
+        """
+        if not self.local_outputs:
+            return None
+        consumer = self.local_consumers.get(output.name)
+        if consumer is None or not consumer.running:
+            return None
+        return consumer
+
+    async def observe_output(self, output):
+        """Notify output observed handler if output is not observed yet.
+        """
+        if not hasattr(self, 'output_observed_handler'):
+            return
+        key = (self.event_type, output.name)
+        now = time.monotonic()
+        if self.observed.get(key, 0) > now:
+            self.observed_suppressed += 1
+            return
+        # mark before notification, concurrent deliveries are suppressed
+        self.observed[key] = now + self.observed_ttl
+        try:
+            await self.output_observed_handler(self.event_type, output)
+        except Exception:
+            del self.observed[key]
+            raise
+
     async def handle_message(self, message: Message):
         """Message handler.
 
         Select next output for message and send it to related queue.
         """
         try:
-            while True:
-                effect = self.router.next_effect(message)
-                prev_state = message.get_route_state(effect)
-                action = effect.next_action(prev_state)
-
-                if isinstance(action, (SendOutputAction, CheckOutputAction)):
-                    # send message to output queue
-                    output = action.get_output()
+            output_name = await self.route_message(message)
+            if output_name is None:
+                return True
+            await self.output_queue.publish(
+                message.to_dict(), routing_key=output_name, confirm=True
+            )
+            message.log.debug("published to output %s, routing_key=%s",
+                              self.output_queue.name, output_name)
+            return True
+        except PublishError:
+            raise
+        # pylint: disable=broad-except
+        except Exception:  # pragma: no cover
+            message.log.exception("Unhandled exception in MessageConsumer")
 
-                    # manager will create output consumer for us if possible
-                    if hasattr(self, 'output_observed_handler'):
-                        await self.output_observed_handler(self.event_type, output)
+    async def handle_batch(self, messages: List[Message]):
+        """Batch handler.
 
-                    await self.output_queue.publish(
-                        message.to_dict(), routing_key=output.name
+        Route all messages and publish them with single batch per output
+        routing key.
+        """
+        batches = defaultdict(list)
+        for message in messages:
+            try:
+                output_name = await self.route_message(message)
+            except PublishError:
+                raise
+            # pylint: disable=broad-except
+            except Exception:  # pragma: no cover
+                message.log.exception("Unhandled exception in "
+                                      "MessageConsumer")
+                continue
+            if output_name is not None:
+                batches[output_name].append(message.to_dict())
+
+        futures = []
+        for output_name, bodies in batches.items():
+            futures.append(await self.output_queue.publish_many(
+                bodies, routing_key=output_name
+            ))
+            self.log.debug("%i messages published to output %s, "
+                           "routing_key=%s", len(bodies),
+                           self.output_queue.name, output_name)
+        if futures:
+            await asyncio.gather(*futures)
+
+    async def route_message(self, message: Message) -> Optional[str]:
+        """Route message.
+
+        Return name of output message must be published to (`None` if it
+        was delivered or rescheduled in-process).
+        """
+        steps = 0
+        while True:
+            effect = self.router.next_effect(message)
+            if effect is None:
+                message.log.info("Message has no next effect, delivery "
+                                 "complete")
+                return None
+            prev_state = message.get_route_state(effect)
+            action = effect.next_action(prev_state)
+
+            if isinstance(action, (SendOutputAction, CheckOutputAction)):
+                # send message to output queue
+                output = action.get_output()
+
+                # manager will create output consumer for us if possible
+                await self.observe_output(output)
+
+                consumer = self.get_local_output(output)
+                if consumer is None or steps >= self.local_steps:
+                    return output.name
+
+                steps += 1
+                message.log.debug("apply %s in-process", output.name)
+                delay = await consumer.throttle(message)
+                if not delay and await consumer.apply_effect(message):
+                    delay = message.delay
+                if delay:
+                    await self.queue.publish(
+                        message.to_dict(), confirm=True, delay=delay
                     )
-                    message.log.debug("published to output %s, routing_key=%s",
-                                      self.output_queue.name, output.name)
-                    # TODO: publish not confirmed
-                    return True
+                    return None
+                continue
 
-                message.log.error("Unhandled action type %s", type(action))  # pragma: no cover
-        # pylint: disable=broad-except
-        except Exception:  # pragma: no cover
-            message.log.exception("Unhandled exception in MessageConsumer")
+            message.log.error("Unhandled action type %s", type(action))  # pragma: no cover
@@ -1,23 +1,69 @@
 """Output consumer.
 """
+import asyncio
+from typing import Optional
+
 from ..message import Message
 from ..router import Router
+from ..outputs import get_rate_limiter
+from ..exceptions import PublishError
 
 from .base import BaseMessageConsumer
 
 
+# max time to hold delivery by output rate limit (deferred if longer)
+RATE_MAX_WAIT = 1
+
+
 class OutputConsumer(BaseMessageConsumer):
     """Output consumer.
+
+    Deliveries to rate limited outputs are held until rate allows them.
+    Messages which would wait longer than `rate_max_wait` are deferred
+    through messages queue with delay.
     """
     event_type: str
     router: Router
 
+    # pylint: disable=too-many-arguments
     def __init__(self, event_type: str, router: Router, messages_queue,
-                 **kwargs) -> None:
+                 rate_max_wait=RATE_MAX_WAIT, **kwargs) -> None:
         super().__init__(**kwargs)
         self.event_type = event_type
         self.router = router
         self.messages_queue = messages_queue
+        self.rate_max_wait = rate_max_wait
+
+    async def throttle(self, message: Message) -> Optional[float]:
+        """Wait for rate limit of output of next message action.
+
+        Return delay to defer message with if wait is too long.
+        """
+        effect = self.router.next_effect(message)
+        if effect is None:
+            return None
+        action = effect.next_action(message.get_route_state(effect))
+        if action is None:  # pragma: no cover
+            return None
+        limiter = get_rate_limiter(action.get_output())
+        if limiter is None:
+            return None
+        wait = limiter.reserve()
+        if wait > self.rate_max_wait:
+            limiter.cancel()
+            return wait
+        if wait:
+            await asyncio.sleep(wait)
+        return None
+
+    async def apply_effect(self, message: Message) -> bool:
+        """Apply next effect of message.
+
+        Return True if message has next effect.
+        """
+        message.delay = None
+        await self.router.apply_next_effect(message)
+        return self.router.next_effect(message) is not None
 
     async def handle_message(self, message: Message):
         """
@@ -31,21 +77,29 @@ class OutputConsumer(BaseMessageConsumer):
                to output queue (select next backend in next step)
         """
         try:
-            self.router.apply_next_effect(message)
-
-            if self.router.next_effect(message):
+            delay = await self.throttle(message)
+            if delay:
+                message.log.debug("Output rate limit, defer for %.2fs", delay)
+                await self.messages_queue.publish(
+                    message.serialize(), confirm=True, delay=delay
+                )
+                return
+            if await self.apply_effect(message):
+                # retry or delivery check may postpone next step
                 await self.messages_queue.publish(
-                    message.serialize()
+                    message.serialize(), confirm=True, delay=message.delay
                 )
                 message.log.debug("Message rescheduled on message queue with "
-                                  "queue_name=%s",
-                                  self.messages_queue.name)
+                                  "queue_name=%s, delay=%s",
+                                  self.messages_queue.name, message.delay)
             else:
                 message.log.info(
                     "Message has no next effect, delivery complete "
                     "[this is the end for a while]"
                 )
                 message.log.debug("Finish status:\n%s\n", message.pretty())
+        except PublishError:
+            raise
         # pylint:disable=broad-except
         except Exception:
             self.log.exception("Exception while routing message")
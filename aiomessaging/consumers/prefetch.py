@@ -0,0 +1,104 @@
+"""Adaptive prefetch.
+"""
+from typing import Optional
+
+
+# default bounds of adaptive prefetch window
+MIN_PREFETCH = 1
+MAX_PREFETCH = 1000
+# share of latency change baseline follows on every window decision
+BASELINE_DRIFT = 0.05
+
+
+# pylint: disable=too-many-instance-attributes
+class AdaptivePrefetch:
+
+    """Adaptive prefetch window controller.
+
+    Fixed prefetch either starves fast consumer (too small window, consumer
+    waits for network round-trip) or makes slow one hoard messages other
+    nodes could process (too large window, latency grows while messages wait
+    in local buffer).
+
+    Controller observes handler latency (exponentially weighted) and compares
+    it with the best latency seen recently. Window grows by a quarter while
+    latency stays close to baseline and the window is actually used, halves
+    when latency grows — messages start to wait for the consumer or its
+    downstream. Window changes at most once per `interval`.
+
+    :param int initial: initial window.
+    :param int min_count: min window.
+    :param int max_count: max window.
+    :param float interval: min time between window changes.
+    :param float tolerance: latency growth ratio treated as saturation.
+    :param float smoothing: latency EWMA weight of new sample.
+    """
+
+    latency: Optional[float]
+    base_latency: Optional[float]
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, initial=None, min_count=MIN_PREFETCH,
+                 max_count=MAX_PREFETCH, interval=1.0, tolerance=2.0,
+                 smoothing=0.2):
+        assert 0 < min_count <= max_count, "Invalid prefetch bounds"
+        self.min_count = min_count
+        self.max_count = max_count
+        self.prefetch_count = self._bound(initial or min_count)
+        self.interval = interval
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+
+        self.latency = None
+        self.base_latency = None
+        self.max_in_flight = 0
+        self._changed_at = None
+
+    def observe(self, duration, in_flight, now) -> Optional[int]:
+        """Register handled delivery.
+
+        :param float duration: handler execution time.
+        :param int in_flight: number of deliveries being handled.
+        :param float now: current loop time.
+
+        Return new window if it must be changed.
+        """
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += self.smoothing * (duration - self.latency)
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+
+        if self._changed_at is None:
+            self._changed_at = now
+        if now - self._changed_at < self.interval:
+            return None
+        return self._adjust(now)
+
+    def _adjust(self, now) -> Optional[int]:
+        """Make window decision for passed interval.
+        """
+        if self.base_latency is None or self.latency < self.base_latency:
+            self.base_latency = self.latency
+
+        current = self.prefetch_count
+        if self.latency > self.base_latency * self.tolerance:
+            new = self._bound(current // 2)
+        elif self.max_in_flight >= current:
+            new = self._bound(current + max(1, current // 4))
+        else:
+            new = current
+
+        # let baseline follow persistent latency changes slowly
+        self.base_latency += BASELINE_DRIFT \
+            * (self.latency - self.base_latency)
+
+        self.max_in_flight = 0
+        self._changed_at = now
+        if new == current:
+            return None
+        self.prefetch_count = new
+        return new
+
+    def _bound(self, count):
+        return max(self.min_count, min(self.max_count, count))
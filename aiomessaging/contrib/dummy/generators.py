@@ -19,10 +19,12 @@ class DummyGenerator:
         self.msg_count = msg_count
 
     async def __call__(self, event: Event, tmp_queue):
-        for i in range(self.msg_count):
-            message = Message(event_type=event.type, event_id=event.id,
-                              content={'a': i})
-            await tmp_queue.publish(
-                body=message.to_dict(),
-                routing_key=tmp_queue.routing_key
-            )
+        await tmp_queue.publish_many(
+            (
+                Message(event_type=event.type, event_id=event.id,
+                        content={'a': i}).to_dict()
+                for i in range(self.msg_count)
+            ),
+            routing_key=tmp_queue.routing_key,
+            confirm=True
+        )
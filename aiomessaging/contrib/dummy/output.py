@@ -74,6 +74,8 @@ class CheckOutput(AbstractOutputBackend):
     Instead of simple forget message like NullOutput and mark it as delivered,
     this output will make additional cycle through messages queue to make a
     delivery check (which will be successful)
+
+    :param float delay: delay before delivery check.
     """
 
     name = 'check'
@@ -81,7 +83,7 @@ class CheckOutput(AbstractOutputBackend):
     def send(self, message: Message, retry=0):
         """Always send to delivery check.
         """
-        raise CheckDelivery()
+        raise CheckDelivery(delay=self.kwargs.get('delay'))
 
     def check(self, message: Message):
         """Check is always successful.
@@ -94,6 +96,7 @@ class RetryOutput(AbstractOutputBackend):
     """Retry sending until requested number of retries achieved.
 
     :param in retries: Number of retries to achieve.
+    :param float delay: delay before next try.
     """
 
     name = 'retry'
@@ -103,4 +106,4 @@ class RetryOutput(AbstractOutputBackend):
         """
         expected_retries = self.kwargs.get('retries', 1)
         if retry < expected_retries:
-            raise Retry("Test retry")
+            raise Retry("Test retry", delay=self.kwargs.get('delay'))
@@ -3,7 +3,9 @@ pipeline effects
 """
 import sys
 import abc
+import asyncio
 import enum
+import time
 import logging
 
 from itertools import zip_longest
@@ -11,12 +13,16 @@ from typing import Dict, Optional
 
 from .actions import Action, SendOutputAction, CheckOutputAction
 from .exceptions import CheckDelivery, Retry
+from .queues.backend import MAX_DELAY
 
 from .utils import NamedSerializable, class_from_string
 
 
 _registered_effects: Dict = {}
 
+# min delay of call deferred by circuit breaker
+BREAKER_MIN_DELAY = 1
+
 logger = logging.getLogger()
 
 
@@ -101,8 +107,8 @@ class Effect(NamedSerializable, abc.ABC):
         pass  # pragma: no cover
 
     @abc.abstractmethod
-    def apply(self, message):
-        """Apply next action and return next state.
+    async def apply(self, message):
+        """Apply next action and return next state (coroutine).
         """
         pass  # pragma: no cover
 
@@ -134,6 +140,10 @@ class SendEffect(Effect):
     """Effect: send message through outputs.
 
     Accepts outputs as the args.
+
+    Outputs with open circuit breaker are skipped while other pending
+    outputs are available. If selected output breaker is still open, its
+    call is deferred like retry (retry counter is not increased).
     """
 
     name = 'send'
@@ -146,6 +156,11 @@ class SendEffect(Effect):
 
         if position is None:
             return None
+        return self.action_at(state, position)
+
+    def action_at(self, state, position) -> Action:
+        """Action of output at position.
+        """
         selected_output = self.args[position]
 
         if state[position] == OutputStatus.CHECK:
@@ -159,12 +174,18 @@ class SendEffect(Effect):
 
         selected_output = None
 
-        # search next pending backend
-        for i, (_, status) in enumerate(zip(self.args, state)):
-            if status == OutputStatus.PENDING:
+        # search next pending backend, skip ones with open circuit breaker
+        pending = [i for i, status in enumerate(state)
+                   if status == OutputStatus.PENDING]
+        for i in pending:
+            breaker = self.args[i].get_circuit_breaker()
+            if breaker is None or breaker.is_available():
                 selected_output = i
                 break
         else:
+            if pending:
+                selected_output = pending[0]
+        if selected_output is None:
             for i, (_, status) in enumerate(zip(self.args, state)):
                 if status == OutputStatus.CHECK:
                     selected_output = i
@@ -192,7 +213,7 @@ class SendEffect(Effect):
                     state[i] = OutputStatus.PENDING
         return state
 
-    def apply(self, message):
+    async def apply(self, message):
         """Send message through next pending output.
 
         Modifies message route. Return state.
@@ -200,26 +221,87 @@ class SendEffect(Effect):
         state = message.get_route_state(self)
         state = self.reset_state(state)
 
+        delay = self.retry_delay(message, state)
+        if delay:
+            # message arrived before retry backoff expired, hold it for the
+            # rest of delay
+            message.delay = delay
+            return state
+
         position = self.next_action_pos(state)
-        action = self.next_action(state)
+        action = self.action_at(state, position)
         retry = message.get_route_retry(self)
+        breaker = action.get_output().get_circuit_breaker()
+        if breaker is not None and not breaker.acquire():
+            return self.defer(message, state, position,
+                              breaker.retry_after())
+        started = time.monotonic()
         try:
-            result = action.execute(message, retry)
+            result = await action.execute(message, retry)
 
             if result is False:  # ignore None
                 state[position] = OutputStatus.FAIL
             else:
                 state[position] = OutputStatus.SUCCESS
-        except CheckDelivery:
+            record(breaker, result is not False, started)
+        except CheckDelivery as exc:
+            record(breaker, True, started)
             state[position] = OutputStatus.CHECK
-        except Retry:
+            message.delay = hold_delay(exc.delay)
+            return state
+        except Retry as exc:
+            record(breaker, False, started)
             prev = message.get_route_retry(self)
             message.set_route_retry(self, prev + 1)
             state[position] = OutputStatus.RETRY
-            message.log.info("Delivery retried (%i)", prev + 1)
+            delay = exc.delay
+            if delay is None:
+                delay = action.get_output().retry_delay(prev)
+            message.set_route_not_before(self, time.time() + delay)
+            message.log.info("Delivery retried (%i), next try in %.2fs",
+                             prev + 1, delay)
+        except asyncio.CancelledError:
+            # outcome is unknown, don't hold trial call of half-open breaker
+            if breaker is not None:
+                breaker.release()
+            raise
+        except Exception:
+            record(breaker, False, started)
+            raise
+
+        message.delay = self.retry_delay(message, state)
+        return state
 
+    def defer(self, message, state, position, delay):
+        """Postpone output call rejected by circuit breaker.
+        """
+        message.log.info("Circuit breaker of %s is open, defer for %.2fs",
+                         self.args[position].name, delay)
+        delay = max(delay, BREAKER_MIN_DELAY)
+        if state[position] == OutputStatus.CHECK:
+            message.delay = delay
+            return state
+        state[position] = OutputStatus.RETRY
+        message.set_route_not_before(self, time.time() + delay)
+        message.delay = self.retry_delay(message, state)
         return state
 
+    def retry_delay(self, message, state) -> Optional[float]:
+        """Time to wait before next action if it is a retry.
+
+        Retried outputs are eligible again after backoff delay stored in
+        message route, other pending outputs are not delayed. Delay longer
+        than delay queue allows is held again for the rest on arrival.
+        """
+        position = self.next_action_pos(list(state))
+        if position is None or state[position] != OutputStatus.RETRY:
+            return None
+        not_before = message.get_route_not_before(self)
+        if not_before is None:
+            return None
+        delay = not_before - time.time()
+        return hold_delay(delay) if delay > 0 else None
+
     def load_state(self, data):
         if not data:
             data = []
@@ -250,6 +332,21 @@ class SendEffect(Effect):
         ])
 
 
+def hold_delay(delay):
+    """Limit time message is held in delay queue at once.
+    """
+    if delay is None:
+        return None
+    return min(delay, MAX_DELAY)
+
+
+def record(breaker, success, started):
+    """Record output call outcome in circuit breaker.
+    """
+    if breaker is not None:
+        breaker.record(success, time.monotonic() - started)
+
+
 # @register_effect
 # class CallEffect(Effect):
 
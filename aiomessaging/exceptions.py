@@ -10,6 +10,30 @@ class MessagingException(Exception):
     pass
 
 
+class PublishError(MessagingException):
+
+    """Publish error.
+
+    Raised when published message was rejected (nacked) by the broker or the
+    channel was closed before publish confirmation received. Consumers must
+    not acknowledge inbound message in this case.
+    """
+
+    pass
+
+
+class UnknownContentType(MessagingException):
+
+    """Unknown content type.
+
+    Raised when no codec available to decode message. Other node of the
+    cluster may know it, so message must be returned to the queue
+    (consumers do it after delay to avoid redelivery loop).
+    """
+
+    pass
+
+
 class FlowException(MessagingException):
 
     """Base flow exception.
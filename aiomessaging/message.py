@@ -21,9 +21,13 @@ ST_FAILED = 3  # fail
 class Message:
 
     """Message.
+
+    `delay` is set by pipeline effect when next routing step must be
+    postponed (transient, not serialized).
     """
 
-    __slots__ = ['id', 'event_type', 'content', 'meta', 'route', 'log']
+    __slots__ = ['id', 'event_type', 'content', 'meta', 'route', 'log',
+                 'delay']
 
     id: int
     event_type: str
@@ -31,6 +35,7 @@ class Message:
     meta: Optional[Dict]
     route: List['Route']
     log: MessageLoggerAdapter
+    delay: Optional[float]
 
     # pylint: disable=redefined-builtin
     def __init__(self, id=None, event_id=None, event_type=None, content=None,
@@ -50,6 +55,7 @@ class Message:
         self.meta = meta
         self.route = route or []
         self.log = MessageLoggerAdapter(self)
+        self.delay = None
 
     @property
     def type(self):
@@ -113,6 +119,22 @@ class Message:
                 route.retry_count = retry_count
                 return
 
+    def get_route_not_before(self, effect) -> Optional[float]:
+        """Get time (unix timestamp) effect is eligible to retry at.
+        """
+        for route in self.route:
+            if route.effect == effect:
+                return route.not_before
+        return None
+
+    def set_route_not_before(self, effect, not_before):
+        """Set time (unix timestamp) effect is eligible to retry at.
+        """
+        for route in self.route:
+            if route.effect == effect:
+                route.not_before = not_before
+                return
+
     def to_dict(self) -> dict:
         """Serialize message to dict.
         """
@@ -165,33 +187,46 @@ class Route:
     Container for effect, its overall status and state.
 
     State may be any json-serializable object.
+
+    `not_before` is the time (unix timestamp) retried effect becomes
+    eligible again.
     """
-    __slots__ = ['effect', 'status', 'state', 'retry_count']
+    __slots__ = ['effect', 'status', 'state', 'retry_count', 'not_before']
 
     effect: Effect
     status: EffectStatus
     state: Any
     retry_count: int
+    not_before: Optional[float]
 
+    # pylint: disable=too-many-arguments
     def __init__(self,
                  effect: Effect,
                  status: EffectStatus = EffectStatus.PENDING,
                  state=None,
-                 retry_count=0) -> None:
+                 retry_count=0,
+                 not_before=None) -> None:
         self.effect = effect
         self.status = status
         self.state = state
         self.retry_count = retry_count
+        self.not_before = not_before
 
     def serialize(self):
         """Serialize route.
+
+        `not_before` is added only if set, so routes without retry delay
+        keep format readable by nodes which don't know it.
         """
-        return [
+        data = [
             self.effect.serialize(),
             self.status.value,
             self.effect.serialize_state(self.state),
-            self.retry_count
+            self.retry_count,
         ]
+        if self.not_before is not None:
+            data.append(self.not_before)
+        return data
 
     @classmethod
     def load(cls, data) -> 'Route':
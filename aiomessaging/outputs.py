@@ -1,11 +1,58 @@
 """
 Output backend abstraction and general implementation.
 """
+import time
+import random
+import asyncio
+import logging
+import functools
+
 from abc import ABC, abstractmethod
-from typing import List, Dict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Dict, Optional, Set, Tuple
 
 from .message import Message
 from .utils import Serializable
+from .consumers.prefetch import AdaptivePrefetch
+
+
+# default number of threads of blocking output
+EXECUTOR_SIZE = 4
+
+logger = logging.getLogger(__name__)
+
+# Shared state of outputs is kept in registries keyed by output name and
+# configuration (see `registry_key`): output instances are restored from
+# message route for every delivery, so instances of the same output must
+# find the same state, but instances configured differently must not.
+
+# thread pools of blocking outputs by output name and pool size
+_executors: Dict[Tuple, ThreadPoolExecutor] = {}
+
+# default batching of outputs with `send_batch`
+BATCH_SIZE = 10
+MAX_BATCH_SIZE = 100
+BATCH_WINDOW = 0.01
+
+# batchers of outputs with `send_batch` by output name and arguments
+_batchers: Dict[Tuple, 'OutputBatcher'] = {}
+
+# rate limits set in config by output name (see `set_rate_limit`)
+_rate_limits: Dict[str, Tuple[float, Optional[int]]] = {}
+# rate limiters by output name and limit
+_rate_limiters: Dict[Tuple, 'TokenBucket'] = {}
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# circuit breakers set in config by output name (see
+# `set_circuit_breaker`)
+_breaker_configs: Dict[str, Dict] = {}
+# circuit breakers by output name and breaker arguments
+_breakers: Dict[Tuple, 'CircuitBreaker'] = {}
 
 
 class NoDeliveryCheck(Exception):
@@ -20,12 +67,71 @@ class NoDeliveryCheck(Exception):
     pass
 
 
+class BackoffPolicy:
+
+    """Exponential backoff with jitter.
+
+    Delay of retry `n` is `base * factor ** n` limited by `cap`, random part
+    of delay (`jitter` share) is subtracted to spread retries of messages
+    failed at the same time.
+
+    :param float base: first retry delay.
+    :param float factor: delay multiplier for every next retry.
+    :param float cap: max delay.
+    :param float jitter: random share of delay (0 — no jitter, 1 — full).
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, base=1, factor=2, cap=300, jitter=0.5):
+        assert 0 <= jitter <= 1, "Jitter must be in [0, 1]"
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, retry: int) -> float:
+        """Get delay before retry number `retry` (from 0).
+        """
+        try:
+            delay = min(self.cap, self.base * self.factor ** retry)
+        except OverflowError:  # pragma: no cover
+            delay = self.cap
+        return delay * (1 - self.jitter * random.random())
+
+
 class AbstractOutputBackend(ABC, Serializable):
 
     """Abstract output backend.
 
     Defines public api for backend and allows to dump and restore of backend
     instance in simple case.
+
+    Retries are spaced with exponential backoff (see `BackoffPolicy`).
+    Override `backoff` on derived class or pass `backoff` dict keyword
+    argument to configure it per output instance. Keyword arguments are
+    serialized, so instance policy travels with message route.
+
+    `send` and `check` can be coroutines: outputs built on asyncio clients
+    are awaited on event loop and can overlap many deliveries.
+
+    Outputs accepting bulk requests can implement `send_batch`: concurrent
+    sends are collected for up to `batch_window` seconds or `batch_size`
+    messages (adapted to provider latency up to `max_batch_size`, see
+    `OutputBatcher`).
+
+    Provider rate limit (messages per second of node) is declared with
+    `rate_limit` and `rate_burst` attributes or keyword arguments, or in
+    `rate_limits` config section (see `set_rate_limit`). Output consumers
+    hold deliveries until rate allows them.
+
+    Circuit breaker (see `CircuitBreaker`) is enabled by `circuit_breaker`
+    dict of breaker arguments (attribute or keyword argument). Outputs with
+    open breaker are skipped by routing while other outputs are available.
+
+    Outputs doing blocking IO in `send` and `check` must set `blocking`
+    (or pass `blocking` keyword argument): they are called in thread pool
+    of `executor_size` threads shared by all instances of output with the
+    same name and pool size, so event loop keeps serving other consumers.
     """
 
     name: str
@@ -33,6 +139,25 @@ class AbstractOutputBackend(ABC, Serializable):
     args: List
     kwargs: Dict
 
+    # default backoff policy arguments
+    backoff: Dict = {}
+
+    # call send and check in thread pool
+    blocking: bool = False
+    executor_size: int = EXECUTOR_SIZE
+
+    # initial and max batch size, time to collect batch
+    batch_size: int = BATCH_SIZE
+    max_batch_size: int = MAX_BATCH_SIZE
+    batch_window: float = BATCH_WINDOW
+
+    # max sends and checks per second, bucket size (rate by default)
+    rate_limit: Optional[float] = None
+    rate_burst: Optional[int] = None
+
+    # circuit breaker arguments (disabled if not set)
+    circuit_breaker: Optional[Dict] = None
+
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
@@ -43,13 +168,31 @@ class AbstractOutputBackend(ABC, Serializable):
     def send(self, message: Message, retry=0):
         """Send message through this backend.
 
-        Must be implemented for every backend.
+        Must be implemented for every backend (regular or async method).
 
         :param Message message: message to send
         :param int retry: retry number (0 by default)
         """
         pass  # pragma: no cover
 
+    def send_batch(self, messages: List[Message], retries: List[int]):
+        """Send batch of messages through this backend.
+
+        Optional, regular or async method. Return list of results in order of
+        messages, every result is a `send` return value or exception
+        instance it would raise (like `Retry` or `CheckDelivery`).
+
+        :param list messages: messages to send
+        :param list retries: retry number of every message
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    @property
+    def is_batching(self) -> bool:
+        """Output implements `send_batch`.
+        """
+        return type(self).send_batch is not AbstractOutputBackend.send_batch
+
     # pylint:disable=no-self-use
     def check(self, message: Message):
         """Check delivery status for message.
@@ -57,3 +200,399 @@ class AbstractOutputBackend(ABC, Serializable):
         Can raise `NoDeliveryCheck` if backend doesn't support delivery check.
         """
         raise NoDeliveryCheck  # pragma: no cover
+
+    @property
+    def is_blocking(self) -> bool:
+        """Output must be called in thread pool.
+        """
+        return self.kwargs.get('blocking', self.blocking)
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """Thread pool of blocking output.
+        """
+        size = self.kwargs.get('executor_size', self.executor_size)
+        key = registry_key(self.name, size)
+        executor = _executors.get(key)
+        if executor is None:
+            executor = _executors[key] = ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix=f'output.{self.name}'
+            )
+        return executor
+
+    async def call(self, method, *args):
+        """Call output method (`send` or `check`).
+
+        Async methods are awaited, blocking output methods are executed in
+        output thread pool.
+        """
+        if asyncio.iscoroutinefunction(method):
+            return await method(*args)
+        if not self.is_blocking:
+            return method(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.get_executor(),
+                                          functools.partial(method, *args))
+
+    async def deliver(self, message: Message, retry=0):
+        """Send message with `send` or as a part of batch.
+        """
+        if self.is_batching:
+            return await get_batcher(self).send(message, retry)
+        return await self.call(self.send, message, retry)
+
+    def get_circuit_breaker(self) -> Optional['CircuitBreaker']:
+        """Circuit breaker of output.
+
+        Shared by instances with the same name and breaker arguments, config
+        (`set_circuit_breaker`) overrides output declaration.
+        """
+        conf = _breaker_configs.get(self.name)
+        if conf is None:
+            conf = self.kwargs.get('circuit_breaker', self.circuit_breaker)
+        if conf is None:
+            return None
+        key = registry_key(self.name, conf)
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(self.name, **conf)
+        return breaker
+
+    def get_backoff_policy(self) -> BackoffPolicy:
+        """Backoff policy of output instance.
+        """
+        return BackoffPolicy(**dict(self.backoff,
+                                    **self.kwargs.get('backoff', {})))
+
+    def retry_delay(self, retry: int) -> float:
+        """Get delay before retry number `retry` (from 0).
+        """
+        return self.get_backoff_policy().delay(retry)
+
+
+class OutputBatcher:
+
+    """Sends collector of output with `send_batch`.
+
+    Every `send` waits for the batch it was added to. Batch is sent when it
+    is full or `batch_window` passed since the first message. Batch size is
+    adapted by observed `send_batch` latency like prefetch window (see
+    `AdaptivePrefetch`): grows while latency stays on baseline and batches
+    are full, halves when provider slows down.
+    """
+
+    _batch: List[Tuple[Message, int, asyncio.Future]]
+    _flush_handle: Optional[asyncio.Handle]
+    _tasks: Set[asyncio.Task]
+
+    def __init__(self, output: AbstractOutputBackend):
+        self.output = output
+        kwargs = output.kwargs
+        self.window = kwargs.get('batch_window', output.batch_window)
+        self.size = AdaptivePrefetch(
+            initial=kwargs.get('batch_size', output.batch_size),
+            max_count=kwargs.get('max_batch_size', output.max_batch_size)
+        )
+        self._batch = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    @property
+    def batch_size(self) -> int:
+        """Current batch size.
+        """
+        return self.size.prefetch_count
+
+    async def send(self, message: Message, retry=0):
+        """Add message to batch and wait for its result.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._batch.append((message, retry, future))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        """Send collected batch.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._send_done)
+
+    def _send_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Batch send of %s failed", self.output.name,
+                         exc_info=task.exception())
+
+    async def close(self):
+        """Send collected batch and wait for batches being sent.
+        """
+        self.flush()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def _send(self, batch):
+        loop = asyncio.get_event_loop()
+        output = self.output
+        started = loop.time()
+        try:
+            results = await output.call(output.send_batch,
+                                        [item[0] for item in batch],
+                                        [item[1] for item in batch])
+            if len(results) != len(batch):
+                raise Exception(f"{output.name} returned {len(results)} "
+                                f"results for batch of {len(batch)}")
+        # pylint: disable=broad-except
+        except Exception as exc:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if future.done():  # pragma: no cover
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self.size.observe(loop.time() - started, len(batch), loop.time())
+
+
+class TokenBucket:
+
+    """Token bucket rate limiter.
+
+    Every call takes a token, tokens are refilled with `rate` per second up
+    to `burst`. Token can be taken in advance: caller gets time to wait
+    until it is available.
+
+    :param float rate: tokens per second.
+    :param int burst: bucket size (rate by default, at least 1).
+    :param clock: time function (`time.monotonic` by default).
+    """
+
+    clock: Callable[[], float]
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        assert rate > 0, "Rate must be positive"
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = None
+
+    def reserve(self, now=None) -> float:
+        """Take token. Return time to wait before it can be used.
+        """
+        if now is None:
+            now = self.clock()
+        if self.updated is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def cancel(self):
+        """Return token taken by `reserve`.
+        """
+        self.tokens += 1
+
+
+# pylint: disable=too-many-instance-attributes
+class CircuitBreaker:
+
+    """Output circuit breaker.
+
+    Closed breaker records outcomes of last `window` calls and opens when
+    failure ratio of at least `min_calls` calls reaches `failure_ratio`.
+    Calls slower than `slow_call` seconds are failures too. Open breaker
+    rejects calls for `open_timeout` seconds, then becomes half-open and
+    lets `trial_calls` calls through: breaker closes if they succeed and
+    opens again otherwise.
+
+    :param str name: output name.
+    :param float failure_ratio: failure ratio to open breaker.
+    :param int min_calls: min number of recorded calls to open breaker.
+    :param int window: number of last calls to calculate ratio.
+    :param float open_timeout: time to reject calls.
+    :param float slow_call: call duration treated as failure.
+    :param int trial_calls: number of calls of half-open breaker.
+    :param clock: time function (`time.monotonic` by default).
+    """
+
+    clock: Callable[[], float]
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, failure_ratio=0.5, min_calls=10, window=20,
+                 open_timeout=30, slow_call=None, trial_calls=1,
+                 clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.open_timeout = open_timeout
+        self.slow_call = slow_call
+        self.trial_calls = trial_calls
+
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.trials = 0
+        self._state = CLOSED
+
+    def state(self, now=None) -> str:
+        """Current breaker state.
+        """
+        if self._state == OPEN:
+            now = self.clock() if now is None else now
+            if now - self.opened_at >= self.open_timeout:
+                self._state = HALF_OPEN
+                self.trials = 0
+        return self._state
+
+    def is_available(self, now=None) -> bool:
+        """Output can be selected by routing.
+        """
+        return self.state(now) != OPEN
+
+    def retry_after(self, now=None) -> float:
+        """Time until open breaker becomes half-open.
+        """
+        if self._state != OPEN:
+            return 0
+        now = self.clock() if now is None else now
+        return max(0, self.opened_at + self.open_timeout - now)
+
+    def acquire(self, now=None) -> bool:
+        """Ask permission to call output.
+        """
+        state = self.state(now)
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self.trials < self.trial_calls:
+            self.trials += 1
+            return True
+        return False
+
+    def release(self):
+        """Return permission of call finished without outcome (cancelled).
+
+        Trial call of half-open breaker becomes available again.
+        """
+        if self._state == HALF_OPEN and self.trials:
+            self.trials -= 1
+
+    def record(self, success, duration=0, now=None):
+        """Record call outcome.
+        """
+        if self.slow_call is not None and duration > self.slow_call:
+            success = False
+        if self._state == OPEN:
+            return  # late outcome of call started before breaker opened
+        if self._state == HALF_OPEN:
+            if success:
+                logger.info("Circuit breaker of %s closed", self.name)
+                self._state = CLOSED
+                self.outcomes.clear()
+            else:
+                self._open(now)
+            return
+        self.outcomes.append(success)
+        if len(self.outcomes) < self.min_calls:
+            return
+        failures = self.outcomes.count(False)
+        if failures / len(self.outcomes) >= self.failure_ratio:
+            self._open(now)
+
+    def _open(self, now=None):
+        logger.warning("Circuit breaker of %s opened for %ss", self.name,
+                       self.open_timeout)
+        self._state = OPEN
+        self.opened_at = self.clock() if now is None else now
+        self.outcomes.clear()
+
+
+def registry_key(name, *config) -> Tuple:
+    """Key of output shared state: output name and configuration values.
+
+    Dicts and lists of configuration are converted to hashable tuples.
+    """
+    return (name,) + tuple(_freeze(value) for value in config)
+
+
+def _freeze(value: Any):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def set_circuit_breaker(output_name, **kwargs):
+    """Set circuit breaker of output (overrides output declaration).
+    """
+    _breaker_configs[output_name] = kwargs
+
+
+def set_rate_limit(output_name, rate, burst=None):
+    """Set rate limit of output (overrides output declaration).
+    """
+    _rate_limits[output_name] = (rate, burst)
+
+
+def get_rate_limiter(output: AbstractOutputBackend) -> Optional[TokenBucket]:
+    """Rate limiter of output.
+
+    Shared by instances with the same name and limit, config
+    (`set_rate_limit`) overrides output declaration.
+    """
+    rate, burst = _rate_limits.get(output.name) or (
+        output.kwargs.get('rate_limit', output.rate_limit),
+        output.kwargs.get('rate_burst', output.rate_burst),
+    )
+    if not rate:
+        return None
+    key = registry_key(output.name, rate, burst)
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        limiter = _rate_limiters[key] = TokenBucket(rate, burst)
+    return limiter
+
+
+def get_batcher(output: AbstractOutputBackend) -> OutputBatcher:
+    """Batcher of output.
+
+    Shared by instances with the same name and arguments: batch is sent
+    with `send_batch` of the instance which created batcher.
+    """
+    key = registry_key(output.name, output.args, output.kwargs)
+    batcher = _batchers.get(key)
+    if batcher is None:
+        batcher = _batchers[key] = OutputBatcher(output)
+    return batcher
+
+
+async def close_batchers():
+    """Send collected batches of outputs and wait for them.
+    """
+    for batcher in list(_batchers.values()):
+        await batcher.close()
+
+
+def shutdown_executors(wait=True):
+    """Shutdown thread pools of blocking outputs.
+    """
+    for executor in _executors.values():
+        executor.shutdown(wait=wait)
+    _executors.clear()
@@ -1,6 +1,13 @@
 """Messaging queues.
 """
-from .backend import QueueBackend
+from .backend import AbstractQueueBackend, QueueBackend
+from .memory import MemoryQueueBackend
 from .queue import Queue, AbstractQueue
 
-__all__ = ['QueueBackend', 'Queue', 'AbstractQueue']
+__all__ = [
+    'AbstractQueueBackend',
+    'QueueBackend',
+    'MemoryQueueBackend',
+    'Queue',
+    'AbstractQueue',
+]
@@ -0,0 +1,228 @@
+"""Acknowledgements coalescing.
+"""
+import logging
+import asyncio
+
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+import pika
+
+
+logger = logging.getLogger(__name__)
+
+# default time to collect acks before write (0 — next loop iteration)
+ACK_WINDOW = 0
+# number of completed deliveries to write acks immediately
+ACK_BATCH_SIZE = 100
+
+# delivery states
+PENDING = 0
+ACKED = 1  # completed, ack not written yet
+SETTLED = 2  # acked or rejected on channel
+
+
+class ChannelAcks:
+
+    """Deliveries of one channel.
+
+    `deliveries` holds tags in delivery order starting from the first not
+    settled one, `floor` is the highest tag everything below of which was
+    already settled.
+    """
+
+    deliveries: Dict[int, int]
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.floor = 0
+        self.deliveries = OrderedDict()
+        self.completed = 0
+
+
+class AckCoalescer:
+
+    """Acknowledgements coalescer.
+
+    Consumer tracks every delivery and reports completed ones. Acks are
+    collected per channel and written on short timer or every `batch_size`
+    completed deliveries. Contiguous run of completed deliveries from the
+    lowest tracked tag is acknowledged with single `multiple=True` ack,
+    other completed deliveries are acknowledged one by one.
+
+    Contiguity is checked by tag numbers, so deliveries not tracked by the
+    coalescer (consumed on the same channel by someone else) are never
+    acknowledged implicitly.
+
+    Nacks are written immediately.
+
+    :param backend: queue backend (provides loop).
+    :param float window: time to collect acks before write.
+    :param int batch_size: number of completed deliveries to write at once
+                           (1 — disable coalescing).
+    """
+
+    _channels: Dict[pika.channel.Channel, ChannelAcks]
+    # channels with abandoned deliveries, acks are written immediately
+    _disabled: Set[pika.channel.Channel]
+    _flush_handle: Optional[asyncio.Handle]
+
+    def __init__(self, backend, window=ACK_WINDOW, batch_size=ACK_BATCH_SIZE):
+        self.backend = backend
+        self.window = window
+        self.batch_size = batch_size
+
+        self._channels = {}
+        self._disabled = set()
+        self._flush_handle = None
+
+    def track(self, channel, delivery_tag):
+        """Register delivery.
+        """
+        state = self._channels.get(channel)
+        if state is None:
+            if channel in self._disabled:
+                return
+            state = self._channels[channel] = ChannelAcks(channel)
+            channel.add_on_close_callback(self.on_channel_closed)
+        state.deliveries[delivery_tag] = PENDING
+
+    def ack(self, channel, delivery_tag):
+        """Acknowledge delivery (buffered).
+        """
+        state = self._channels.get(channel)
+        if state is None or delivery_tag not in state.deliveries:
+            # not tracked, acknowledge right now
+            channel.basic_ack(delivery_tag)
+            return
+        if self.batch_size <= 1:
+            self.forget(channel, delivery_tag)
+            channel.basic_ack(delivery_tag)
+            return
+        state.deliveries[delivery_tag] = ACKED
+        state.completed += 1
+        if state.completed >= self.batch_size:
+            self.flush(channel)
+        else:
+            self._schedule_flush()
+
+    def nack(self, channel, delivery_tag, requeue=True):
+        """Reject delivery immediately.
+        """
+        self.forget(channel, delivery_tag)
+        channel.basic_nack(delivery_tag, requeue=requeue)
+
+    def forget(self, channel, delivery_tag):
+        """Stop tracking delivery settled (or abandoned) by consumer.
+        """
+        state = self._channels.get(channel)
+        if state is not None and delivery_tag in state.deliveries:
+            state.deliveries[delivery_tag] = SETTLED
+
+    def abandon(self, channel, delivery_tag):
+        """Leave delivery unacknowledged.
+
+        Multiple ack would acknowledge it implicitly, so coalescing is
+        disabled for the channel until it is reopened.
+        """
+        if channel not in self._channels:
+            return
+        logger.warning("Delivery %i abandoned, ack coalescing disabled for "
+                       "CHANNEL%i", delivery_tag, channel.channel_number)
+        state = self._channels[channel]
+        state.deliveries.pop(delivery_tag, None)
+        self._flush_channel(state)
+        del self._channels[channel]
+        self._disabled.add(channel)
+
+    @property
+    def pending(self):
+        """Number of completed deliveries waiting for ack.
+        """
+        return sum(state.completed for state in self._channels.values())
+
+    def flush(self, channel=None):
+        """Write collected acks of channel (all channels by default).
+        """
+        if channel is None:
+            self._cancel_flush()
+            for state in list(self._channels.values()):
+                self._flush_channel(state)
+        elif channel in self._channels:
+            self._flush_channel(self._channels[channel])
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """Forget deliveries of closed channel.
+
+        Broker requeues them, acks are not possible anymore.
+        """
+        self._disabled.discard(channel)
+        state = self._channels.pop(channel, None)
+        if state is not None and state.completed:
+            logger.warning("CHANNEL%i closed with %i not acknowledged "
+                           "deliveries: %s %s", channel.channel_number,
+                           state.completed, reply_code, reply_text)
+
+    def _flush_channel(self, state: ChannelAcks):
+        if not state.completed:
+            self._forget_settled(state)
+            return
+        channel = state.channel
+        if not channel.is_open:  # pragma: no cover
+            self._channels.pop(channel, None)
+            return
+
+        # contiguous run of settled deliveries from the lowest tag
+        last_acked = None
+        for tag, status in state.deliveries.items():
+            if status == PENDING or tag != state.floor + 1:
+                break
+            if status == ACKED:
+                last_acked = tag
+                state.completed -= 1
+            state.floor = tag
+        if last_acked is not None:
+            channel.basic_ack(last_acked, multiple=True)
+        self._forget_settled(state)
+
+        # completed deliveries after gap
+        if state.completed:
+            for tag, status in state.deliveries.items():
+                if status == ACKED:
+                    channel.basic_ack(tag)
+                    state.deliveries[tag] = SETTLED
+            state.completed = 0
+
+    # pylint: disable=no-self-use
+    def _forget_settled(self, state: ChannelAcks):
+        """Drop deliveries below floor and settled ones from head.
+
+        Floor is moved only over contiguous tags: untracked delivery makes
+        the gap which disables multiple acks for this channel.
+        """
+        deliveries = state.deliveries
+        while deliveries:
+            tag = next(iter(deliveries))
+            if tag <= state.floor:
+                del deliveries[tag]
+            elif deliveries[tag] == SETTLED:
+                del deliveries[tag]
+                if tag == state.floor + 1:
+                    state.floor = tag
+            else:
+                break
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = self.backend.loop.call_later(
+                self.window, self._scheduled_flush
+            )
+
+    def _cancel_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _scheduled_flush(self):
+        self._flush_handle = None
+        self.flush()
@@ -1,15 +1,28 @@
 """Messaging queue backend.
 """
+import math
 import logging
 import asyncio
+import weakref
 
-from typing import Dict
+from bisect import bisect_left
+from typing import Any, Dict, Hashable, Optional
+from abc import ABC, abstractmethod
 
 import pika
 
 from ..utils import gen_id
 
 from .queue import Queue
+from .publisher import Publisher, PUBLISH_WINDOW, PUBLISH_BATCH_SIZE
+from .acks import AckCoalescer, ACK_WINDOW, ACK_BATCH_SIZE
+from .codecs import (
+    Codec,
+    DEFAULT_CODEC,
+    DEFAULT_COMPRESS_LEVEL,
+    get_codec,
+    decode,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -19,15 +32,307 @@ DECLARE_CHANNEL_TIMEOUT = 1
 DECLARE_EXCHANGE_TIMEOUT = 1
 DECLARE_QUEUE_TIMEOUT = 1
 
+# default per-consumer prefetch count for new channels
+DEFAULT_PREFETCH_COUNT = 100
 
-# pylint: disable=too-many-instance-attributes
-class QueueBackend:
-    """Queue backend implementation.
+# delay queue buckets per delay doubling, fine enough to keep retry jitter
+DELAY_BUCKET_STEPS = 8
+# delay queue TTL buckets (milliseconds) from 1/16s to 65536s, delay rounded
+# up to the nearest one
+DELAY_BUCKETS = tuple(
+    math.ceil(1000 * 2 ** (i / DELAY_BUCKET_STEPS))
+    for i in range(-4 * DELAY_BUCKET_STEPS, 16 * DELAY_BUCKET_STEPS + 1)
+)
+# max delay of delayed publish (seconds)
+MAX_DELAY = DELAY_BUCKETS[-1] / 1000
+
+# shared exchange of messages queues, routing key is event type
+MESSAGES_EXCHANGE = 'messages'
+
+
+class AbstractQueueBackend(ABC):
+
+    """Abstract queue backend.
+
+    Defines public interface of queue backend and declares well-known queues
+    of the messaging pipeline on top of channels provided by implementation.
+    Channels must implement `pika.channel.Channel` interface (callback style)
+    because they are used directly by `Queue`.
+
+    Channels are opened lazily by name and cached in `_channels`, every
+    consumer can use its own named channel to get own QoS and flow control.
+
+    Messages queues of all event types are bound to one shared direct
+    exchange by event type, so generated messages of any type are routed by
+    single publish.
+
+    Messages and output queues are declared with `x-max-priority` if
+    `max_priority` is set. Note that RabbitMQ refuses to redeclare existing
+    queue with other arguments, so queues must be recreated to change it.
     """
 
     TYPE_FANOUT = 'fanout'
     TYPE_DIRECT = 'direct'
 
+    loop: asyncio.AbstractEventLoop
+    reconnect_timeout: float
+
+    codec: Codec
+    publisher: Publisher
+    acks: AckCoalescer
+
+    # declared topology (queue, exchange and binding) futures by queue key
+    _topology: Dict[Hashable, asyncio.Future]
+    # opened channels by name
+    _channels: Dict[str, Any]
+    # channel-wide prefetch windows applied to channels
+    _prefetch: 'weakref.WeakKeyDictionary[Any, int]'
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, publish_window=PUBLISH_WINDOW,
+                 publish_batch_size=PUBLISH_BATCH_SIZE,
+                 publish_confirms=True, ack_window=ACK_WINDOW,
+                 ack_batch_size=ACK_BATCH_SIZE, codec=DEFAULT_CODEC,
+                 compress_threshold=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, max_priority=None):
+        self._topology = {}
+        self._channels = {}
+        self._prefetch = weakref.WeakKeyDictionary()
+        self.max_priority = max_priority
+        self.codec = get_codec(codec)
+        self.publisher = Publisher(self, codec=self.codec,
+                                   window=publish_window,
+                                   batch_size=publish_batch_size,
+                                   confirms=publish_confirms,
+                                   compress_threshold=compress_threshold,
+                                   compress_level=compress_level)
+        self.acks = AckCoalescer(self, window=ack_window,
+                                 batch_size=ack_batch_size)
+
+    @abstractmethod
+    def connect(self, loop=None) -> asyncio.Future:
+        """Establish connection to queue backend.
+
+        Return `Future` that will be resolved when connection is ready.
+        """
+        pass  # pragma: no cover
+
+    @property
+    @abstractmethod
+    def is_open(self):
+        """Connection opened flag.
+        """
+        pass  # pragma: no cover
+
+    @abstractmethod
+    async def channel(self, name='default'):
+        """Get channel by name (coroutine).
+        """
+        pass  # pragma: no cover
+
+    @abstractmethod
+    def close(self) -> asyncio.Future:
+        """Close connection.
+
+        Return `Future` that will be resolved after connection close.
+        """
+        pass  # pragma: no cover
+
+    def set_prefetch(self, channel, prefetch_count) -> bool:
+        """Set channel-wide (global QoS) prefetch window of channel.
+
+        Per-consumer limit of channel is dropped once, window is sent only
+        if it is changed, so queues sharing channel don't resend it. Return
+        True if QoS was sent.
+        """
+        current = self._prefetch.get(channel)
+        if current == prefetch_count:
+            return False
+        if current is None:
+            channel.basic_qos(prefetch_count=0)
+        channel.basic_qos(prefetch_count=prefetch_count, all_channels=True)
+        self._prefetch[channel] = prefetch_count
+        return True
+
+    def decode(self, properties, body):
+        """Decode message body by its content type.
+
+        Messages of backend codec content type are decoded with it.
+        """
+        return decode(properties, body, preferred=self.codec)
+
+    @property
+    def channels(self) -> Dict[str, int]:
+        """Channel numbers of opened channels by name.
+        """
+        return {name: channel.channel_number
+                for name, channel in self._channels.items()
+                if channel.is_open}
+
+    async def get_queue(self, *args, **kwargs) -> Queue:
+        """Get queue for backend.
+
+        Topology declared only once for each queue key, next calls with the
+        same arguments will just attach queue to the channel without any
+        broker round-trip. Concurrent calls wait for the first declaration.
+        """
+        queue = Queue(self, *args, **kwargs)
+        key = queue.topology_key
+        if key is None:
+            logger.debug("Start declare queue...")
+            return await queue.declare()
+
+        if key in self._topology:
+            await self._topology[key]
+            return await queue.attach()
+
+        declared = self._topology[key] = self._create_future()
+        logger.debug("Start declare queue...")
+        try:
+            await queue.declare()
+        except Exception as exc:
+            self.invalidate_topology(key)
+            declared.set_exception(exc)
+            declared.exception()  # mark retrieved if no one waits
+            raise
+        declared.set_result(True)
+        return queue
+
+    # pylint: disable=too-many-arguments
+    async def publish_delayed(self, exchange, routing_key, body, delay,
+                              priority=None) -> asyncio.Future:
+        """Publish message to exchange after delay.
+
+        Message is published to the delay bucket queue with TTL, expired
+        messages are dead-lettered to the target exchange with original
+        routing key. Delay rounded up to the nearest bucket from
+        `DELAY_BUCKETS`, so message never arrives earlier than requested.
+        `ValueError` raised if delay is longer than `MAX_DELAY`.
+
+        Return publish future (see `Publisher.publish`).
+        """
+        check_delay(delay)
+        bucket = delay_bucket(delay)
+        name = (f"delay.{exchange or 'amq.default'}.{routing_key}."
+                f"{bucket}ms")
+        await self.get_queue(
+            name, auto_delete=False, durable=True,
+            arguments={
+                'x-message-ttl': bucket,
+                'x-dead-letter-exchange': exchange,
+                'x-dead-letter-routing-key': routing_key,
+            }
+        )
+        return await self.publisher.publish('', name, body,
+                                            priority=priority)
+
+    def invalidate_topology(self, key=None):
+        """Forget declared topology.
+
+        Drop single queue key or whole cache if no key provided. Used when
+        queue deleted or channel/connection lost.
+        """
+        if key is None:
+            self._topology.clear()
+        else:
+            self._topology.pop(key, None)
+
+    async def events_queue(self, event_type, **kwargs) -> Queue:
+        """Get events queue.
+        """
+        name = f"events.{event_type}"
+        return await self.get_queue(name, auto_delete=False, durable=True,
+                                    **kwargs)
+
+    async def generation_queue(self, event_type=None, name=None,
+                               **kwargs) -> Queue:
+        """Declare tmp generation queue.
+        """
+        if not any([event_type, name]):  # pragma: no cover
+            raise Exception("You must provide event_type or name")
+        if name is None:
+            name = gen_id(f"gen.{event_type}")
+        return await self.get_queue(
+            name=name, exchange='', exchange_type=self.TYPE_DIRECT,
+            routing_key=name, auto_delete=True, **kwargs
+        )
+
+    async def messages_queue(self, event_type, **kwargs) -> Queue:
+        """Get messages queue.
+        """
+        return await self.get_queue(
+            name=f"messages.{event_type}",
+            exchange=MESSAGES_EXCHANGE,
+            exchange_type=self.TYPE_DIRECT,
+            routing_key=event_type,
+            auto_delete=False,
+            durable=True,
+            arguments=self.priority_arguments(),
+            **kwargs
+        )
+
+    async def messages_exchange(self, **kwargs) -> Queue:
+        """Get shared messages exchange to publish messages of any type.
+
+        Routing key of message must be its event type.
+        """
+        return await self.get_queue(
+            exchange=MESSAGES_EXCHANGE,
+            exchange_type=self.TYPE_DIRECT,
+            **kwargs
+        )
+
+    async def cluster_queue(self, **kwargs) -> Queue:
+        """Get cluster queue.
+        """
+        return await self.get_queue(
+            name=gen_id('cluster.node'),
+            auto_delete=True,
+            durable=False,
+
+            exchange='cluster',
+            exchange_type=self.TYPE_FANOUT,
+            routing_key='',
+            **kwargs
+        )
+
+    async def output_queue(self, event_type: str, output_name=None,
+                           **kwargs) -> Queue:
+        """Get output queue.
+        """
+        name = f"output.{event_type}"
+        return await self.get_queue(
+            name=name,
+            auto_delete=False,
+            durable=True,
+
+            exchange=name,
+            exchange_type=self.TYPE_DIRECT,
+            routing_key=output_name,
+            arguments=self.priority_arguments(),
+            **kwargs
+        )
+
+    def priority_arguments(self) -> Optional[Dict[str, Any]]:
+        """Get arguments of priority queues.
+        """
+        if not self.max_priority:
+            return None
+        return {'x-max-priority': self.max_priority}
+
+    def _create_future(self):
+        """Create future bounded to backend loop.
+        """
+        return asyncio.Future(loop=self.loop)
+
+
+# pylint: disable=too-many-instance-attributes
+class QueueBackend(AbstractQueueBackend):
+    """Queue backend implementation.
+
+    RabbitMQ (AMQP 0-9-1) backend on top of pika asyncio adapter.
+    """
+
     reconnect_timeout: float
 
     # set to True before expected close
@@ -37,9 +342,12 @@ class QueueBackend:
     _channels: Dict[str, pika.channel.Channel]
     _channels_opening: Dict[str, asyncio.Future]
 
+    # pylint: disable=too-many-arguments
     def __init__(self, host='127.0.0.1', port=5672, username='guest',
                  password='guest', virtual_host="/", loop=None,
-                 reconnect_timeout=3):
+                 reconnect_timeout=3, prefetch_count=DEFAULT_PREFETCH_COUNT,
+                 **kwargs):
+        super().__init__(**kwargs)
         self.loop = loop
         self.host = host
         self.port = port
@@ -47,6 +355,7 @@ class QueueBackend:
         self.password = password
         self.virtual_host = virtual_host
         self.reconnect_timeout = reconnect_timeout
+        self.prefetch_count = prefetch_count
 
         self.log = logger
 
@@ -56,7 +365,6 @@ class QueueBackend:
         self._closing = False
 
         self._channels_opening = {}
-        self._channels = {}
 
     # pylint: disable=no-self-use
     def get_url(self):
@@ -122,7 +430,7 @@ class QueueBackend:
             """On channel closed handler.
             """
             channel.add_on_close_callback(self.on_channel_closed)
-            channel.basic_qos(prefetch_count=100)
+            channel.basic_qos(prefetch_count=self.prefetch_count)
             self._channels[name] = channel
             try:
                 self._channels_opening[name].set_result(channel)
@@ -137,6 +445,7 @@ class QueueBackend:
         """Handle channel closed event.
         """
         self.log.debug('CHANNEL%i closed', channel.channel_number)
+        self.invalidate_topology()
 
     def on_open_error_callback(self, *args, **kwargs):  # pragma: no cover
         """Opening error callback.
@@ -159,6 +468,8 @@ class QueueBackend:
             self.log.error('Connection closed unexpectedly: %s %s',
                            reply_code, reply_text)
 
+        self.invalidate_topology()
+
         # cancel _connecting Future
         if self._connecting and not self._connecting.done():  # pragma: no cover
             self.log.error('Cancel _connecting it is not done')
@@ -186,74 +497,23 @@ class QueueBackend:
         """Close connection.
         """
         self._normal_close = True
+        if self.publisher.flush_nowait():  # pragma: no cover
+            self.log.warning("%i published messages were not sent",
+                             self.publisher.pending)
+        self.acks.flush()
         self.connection.close()
         return self._closing  # future will be resolved after connection close
 
-    async def get_queue(self, *args, **kwargs) -> Queue:
-        """Get queue for backend.
-        """
-        queue = Queue(self, *args, **kwargs)
-        self.log.debug("Start declare queue...")
-        return await queue.declare()
-
-    async def events_queue(self, event_type) -> Queue:
-        """Get events queue.
-        """
-        name = f"events.{event_type}"
-        return await self.get_queue(name, auto_delete=False, durable=True)
-
-    async def generation_queue(self, event_type=None, name=None) -> Queue:
-        """Declare tmp generation queue.
-        """
-        if not any([event_type, name]):  # pragma: no cover
-            raise Exception("You must provide event_type or name")
-        if name is None:
-            name = gen_id(f"gen.{event_type}")
-        return await self.get_queue(
-            name=name, exchange='', exchange_type=self.TYPE_DIRECT,
-            routing_key=name, auto_delete=True
-        )
-
-    async def messages_queue(self, event_type) -> Queue:
-        """Get messages queue.
-        """
-        return await self.get_queue(
-            name=f"messages.{event_type}",
-            exchange=f'messages.{event_type}',
-            exchange_type=self.TYPE_DIRECT,
-            routing_key=event_type,
-            auto_delete=False,
-            durable=True,
-        )
 
-    async def cluster_queue(self) -> Queue:
-        """Get cluster queue.
-        """
-        return await self.get_queue(
-            name=gen_id('cluster.node'),
-            auto_delete=True,
-            durable=False,
-
-            exchange='cluster',
-            exchange_type=self.TYPE_FANOUT,
-            routing_key=''
-        )
-
-    async def output_queue(self, event_type: str, output_name=None) -> Queue:
-        """Get output queue.
-        """
-        name = f"output.{event_type}"
-        return await self.get_queue(
-            name=name,
-            auto_delete=False,
-            durable=True,
+def check_delay(delay):
+    """Raise `ValueError` if delay (seconds) can't be published.
+    """
+    if delay > MAX_DELAY:
+        raise ValueError(f"Delay {delay}s is longer than max {MAX_DELAY}s")
 
-            exchange=name,
-            exchange_type=self.TYPE_DIRECT,
-            routing_key=output_name
-        )
 
-    def _create_future(self):
-        """Create future bounded to backend loop.
-        """
-        return asyncio.Future(loop=self.loop)
+def delay_bucket(delay):
+    """Get delay bucket (milliseconds) for delay (seconds).
+    """
+    check_delay(delay)
+    return DELAY_BUCKETS[bisect_left(DELAY_BUCKETS, delay * 1000)]
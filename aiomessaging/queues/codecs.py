@@ -0,0 +1,189 @@
+"""Wire codecs.
+
+Codec used to publish is chosen in config (`queue.codec`), consumers pick
+decoder by AMQP `content_type` of every delivery, so nodes with different
+codecs can work together during rollout.
+
+Large bodies are compressed and marked with AMQP `content_encoding`.
+"""
+import zlib
+
+from typing import Dict, Optional, Union
+
+import ujson
+
+from ..exceptions import UnknownContentType
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+DEFAULT_CODEC = 'json'
+
+# zlib stream (RFC 1950), "deflate" in HTTP terms
+DEFLATE = 'deflate'
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+class Codec:
+
+    """Base codec.
+    """
+
+    name: str
+    content_type: str
+
+    def encode(self, obj) -> Union[str, bytes]:
+        """Serialize object to message body.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def decode(self, body: bytes):
+        """Deserialize message body.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class JsonCodec(Codec):
+
+    """JSON codec (ujson).
+    """
+
+    name = 'json'
+    content_type = JSON
+
+    # pylint: disable=c-extension-no-member
+    def encode(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    def decode(self, body):
+        return ujson.loads(body)
+
+
+class OrjsonCodec(Codec):
+
+    """JSON codec (orjson).
+
+    Requires `orjson` package.
+    """
+
+    name = 'orjson'
+    content_type = JSON
+
+    def __init__(self):
+        if orjson is None:  # pragma: no cover
+            raise Exception("orjson codec requires `orjson` package")
+
+    # pylint: disable=no-member
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+    def decode(self, body):
+        return orjson.loads(body)
+
+
+class MsgpackCodec(Codec):
+
+    """MessagePack codec.
+
+    Requires `msgpack` package.
+    """
+
+    name = 'msgpack'
+    content_type = MSGPACK
+
+    def __init__(self):
+        if msgpack is None:  # pragma: no cover
+            raise Exception("msgpack codec requires `msgpack` package")
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+# decoder instances by content type
+_decoders: Dict[str, Codec] = {}
+
+
+def register_codec(codec_class):
+    """Register codec class.
+
+    Codec registered earlier is used to decode messages of the same content
+    type unless other one is preferred by backend.
+    """
+    CODECS[codec_class.name] = codec_class
+
+
+def get_codec(name=DEFAULT_CODEC) -> Codec:
+    """Get codec instance by name.
+    """
+    if name not in CODECS:
+        raise Exception(f"Unknown codec `{name}`")
+    return CODECS[name]()
+
+
+def get_decoder(content_type: Optional[str]) -> Codec:
+    """Get codec to decode message of content type.
+
+    Messages without content type are treated as JSON.
+    """
+    content_type = content_type or JSON
+    decoder = _decoders.get(content_type)
+    if decoder is None:
+        for codec_class in CODECS.values():
+            if codec_class.content_type == content_type:
+                try:
+                    decoder = codec_class()
+                except Exception as exc:  # pragma: no cover
+                    raise UnknownContentType(str(exc))
+                _decoders[content_type] = decoder
+                break
+        else:
+            raise UnknownContentType(
+                f"No codec for content type `{content_type}`"
+            )
+    return decoder
+
+
+def compress(body: Union[str, bytes], level=DEFAULT_COMPRESS_LEVEL) -> bytes:
+    """Compress message body.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return zlib.compress(body, level)
+
+
+def decode(properties, body, preferred: Optional[Codec] = None):
+    """Decode message body by its properties.
+
+    Body is decompressed first if it has content encoding. `preferred` codec
+    is used for messages of its content type.
+    """
+    if properties.content_encoding:
+        if properties.content_encoding != DEFLATE:
+            raise UnknownContentType(
+                f"Unknown content encoding `{properties.content_encoding}`"
+            )
+        body = zlib.decompress(body)
+    content_type = properties.content_type or JSON
+    if preferred is not None and preferred.content_type == content_type:
+        return preferred.decode(body)
+    return get_decoder(content_type).decode(body)
@@ -0,0 +1,730 @@
+"""In-memory queue backend.
+
+Emulates AMQP broker inside the process: exchanges (direct and fanout),
+routing keys, bindings, per-channel prefetch, acknowledgements and auto-delete
+queues. Allows single-node deployments and benchmarks to run without
+RabbitMQ and without network round-trip on every stage hop.
+
+Channels implement subset of `pika.channel.Channel` used by `Queue`, so the
+same `Queue` implementation works on top of both backends.
+"""
+import logging
+import asyncio
+
+from collections import OrderedDict, defaultdict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
+
+from pika import exceptions, frame, spec
+
+from ..utils import gen_id
+
+from .backend import (
+    AbstractQueueBackend,
+    DEFAULT_PREFETCH_COUNT,
+    check_delay,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBrokerError(Exception):
+    """In-memory broker error.
+
+    Raised on operations which would be rejected by real AMQP broker (like
+    redeclaration of exchange with another type).
+    """
+    pass
+
+
+class Envelope:
+
+    """Published message with routing information.
+    """
+
+    __slots__ = ['exchange', 'routing_key', 'properties', 'body',
+                 'redelivered']
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, exchange, routing_key, properties, body,
+                 redelivered=False):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = redelivered
+
+
+class MemoryConsumer:
+
+    """Queue consumer registered with `basic_consume`.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, tag, queue, channel, callback, prefetch_count):
+        self.tag = tag
+        self.queue = queue
+        self.channel = channel
+        self.callback = callback
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    @property
+    def has_capacity(self):
+        """Consumer can receive one more message.
+        """
+        if not self.channel.has_capacity:
+            return False
+        if not self.prefetch_count:
+            return True
+        return self.unacked < self.prefetch_count
+
+    def deliver(self, envelope: Envelope):
+        """Deliver message to consumer callback.
+        """
+        delivery_tag = self.channel.track(self, envelope)
+        self.unacked += 1
+        method = spec.Basic.Deliver(
+            consumer_tag=self.tag,
+            delivery_tag=delivery_tag,
+            redelivered=envelope.redelivered,
+            exchange=envelope.exchange,
+            routing_key=envelope.routing_key
+        )
+        try:
+            self.callback(self.channel, method, envelope.properties,
+                          envelope.body)
+        # pylint: disable=broad-except
+        except Exception:
+            logger.exception("Exception in consumer callback %s", self.tag)
+
+
+class PriorityMessages:
+
+    """Messages of priority queue (`x-max-priority` argument).
+
+    Deque-like container: messages with higher priority go first, FIFO
+    within one priority. Priorities above maximum are treated as maximum.
+    """
+
+    def __init__(self, max_priority):
+        self.max_priority = max_priority
+        self._levels = [deque() for _ in range(max_priority + 1)]
+
+    def _level(self, envelope: Envelope) -> Deque[Envelope]:
+        priority = envelope.properties.priority or 0
+        return self._levels[min(priority, self.max_priority)]
+
+    def append(self, envelope: Envelope):
+        """Add message to the tail of its priority.
+        """
+        self._level(envelope).append(envelope)
+
+    def appendleft(self, envelope: Envelope):
+        """Return message to the head of its priority.
+        """
+        self._level(envelope).appendleft(envelope)
+
+    def extendleft(self, envelopes):
+        """Return messages to the heads of their priorities.
+        """
+        for envelope in envelopes:
+            self.appendleft(envelope)
+
+    def popleft(self) -> Envelope:
+        """Take message with highest priority.
+        """
+        for level in reversed(self._levels):
+            if level:
+                return level.popleft()
+        raise IndexError("pop from an empty queue")
+
+    def __iter__(self):
+        for level in reversed(self._levels):
+            yield from level
+
+    def __getitem__(self, index):
+        for i, envelope in enumerate(self):
+            if i == index:
+                return envelope
+        raise IndexError("queue index out of range")
+
+    def __len__(self):
+        return sum(len(level) for level in self._levels)
+
+
+class MemoryQueueState:
+
+    """Queue state inside in-memory broker.
+    """
+
+    messages: Union[Deque[Envelope], PriorityMessages]
+    consumers: Deque[MemoryConsumer]
+
+    def __init__(self, name, durable=False, auto_delete=False,
+                 arguments=None):
+        self.name = name
+        self.durable = durable
+        self.auto_delete = auto_delete
+        max_priority = (arguments or {}).get('x-max-priority')
+        if max_priority:
+            self.messages = PriorityMessages(max_priority)
+        else:
+            self.messages = deque()
+        self.consumers = deque()
+        self.scheduled = False
+        # messages requeued while dispatching, returned after dispatch
+        self.dispatching = False
+        self.requeued = []
+
+    def next_consumer(self) -> Optional[MemoryConsumer]:
+        """Select next consumer with free prefetch window (round-robin).
+        """
+        for _ in range(len(self.consumers)):
+            consumer = self.consumers[0]
+            self.consumers.rotate(-1)
+            if consumer.has_capacity:
+                return consumer
+        return None
+
+
+class MemoryBroker:
+
+    """In-process broker.
+
+    Holds exchanges, queues and bindings. One broker can be shared between
+    several backend instances to connect them together.
+    """
+
+    loop: Optional[asyncio.AbstractEventLoop]
+    exchanges: Dict[str, str]
+    bindings: Dict[str, Set[Tuple[str, str]]]
+    queues: Dict[str, MemoryQueueState]
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        # default exchange routes messages by queue name
+        self.exchanges = {'': AbstractQueueBackend.TYPE_DIRECT}
+        self.bindings = defaultdict(set)
+        self.queues = {}
+
+    def declare_exchange(self, name, exchange_type):
+        """Declare exchange.
+        """
+        declared = self.exchanges.setdefault(name, exchange_type)
+        if declared != exchange_type:
+            raise MemoryBrokerError(
+                f"Exchange `{name}` already declared with type `{declared}`"
+            )
+
+    def declare_queue(self, name, durable=False, auto_delete=False,
+                      arguments=None) -> str:
+        """Declare queue.
+
+        Generate queue name if empty name passed. Return queue name.
+        """
+        if not name:
+            name = gen_id('amq.gen')
+        if name not in self.queues:
+            self.queues[name] = MemoryQueueState(name, durable, auto_delete,
+                                                 arguments)
+        return name
+
+    def bind_queue(self, name, exchange, routing_key):
+        """Bind queue to exchange with routing key.
+        """
+        if exchange not in self.exchanges:
+            raise MemoryBrokerError(f"No exchange `{exchange}`")
+        if name not in self.queues:
+            raise MemoryBrokerError(f"No queue `{name}`")
+        self.bindings[exchange].add((routing_key or '', name))
+
+    def delete_queue(self, name) -> int:
+        """Delete queue with all bindings and consumers.
+
+        Return number of dropped messages.
+        """
+        state = self.queues.pop(name, None)
+        if state is None:
+            return 0
+        for bindings in self.bindings.values():
+            for binding in [b for b in bindings if b[1] == name]:
+                bindings.discard(binding)
+        for consumer in list(state.consumers):
+            consumer.channel.forget_consumer(consumer)
+        state.consumers.clear()
+        return len(state.messages)
+
+    def route(self, exchange, routing_key) -> List[MemoryQueueState]:
+        """Get list of queues message must be delivered to.
+        """
+        if exchange == '':
+            state = self.queues.get(routing_key)
+            return [state] if state else []
+        exchange_type = self.exchanges[exchange]
+        names = {
+            name for key, name in self.bindings[exchange]
+            if exchange_type == AbstractQueueBackend.TYPE_FANOUT
+            or key == routing_key
+        }
+        return [self.queues[name] for name in names]
+
+    def publish(self, exchange, routing_key, body, properties):
+        """Publish message to exchange.
+
+        Unroutable messages are dropped like AMQP broker does for
+        non-mandatory publish.
+        """
+        if exchange not in self.exchanges:
+            raise MemoryBrokerError(f"No exchange `{exchange}`")
+        for state in self.route(exchange, routing_key):
+            state.messages.append(
+                Envelope(exchange, routing_key, properties, body)
+            )
+            self.schedule(state)
+
+    def add_consumer(self, consumer: MemoryConsumer):
+        """Register consumer of queue.
+        """
+        consumer.queue.consumers.append(consumer)
+        self.schedule(consumer.queue)
+
+    def remove_consumer(self, consumer: MemoryConsumer):
+        """Unregister consumer.
+
+        Auto-delete queue will be deleted after last consumer removed.
+        """
+        state = consumer.queue
+        if consumer in state.consumers:
+            state.consumers.remove(consumer)
+        if state.auto_delete and not state.consumers \
+                and self.queues.get(state.name) is state:
+            self.delete_queue(state.name)
+
+    def requeue(self, consumer: MemoryConsumer, envelope: Envelope):
+        """Return unacked message to the head of its queue.
+        """
+        consumer.unacked -= 1
+        state = consumer.queue
+        if self.queues.get(state.name) is not state:
+            return  # queue deleted, message lost as in AMQP
+        envelope.redelivered = True
+        if state.dispatching:
+            # don't redeliver rejected message in the same dispatch
+            state.requeued.append(envelope)
+            return
+        state.messages.appendleft(envelope)
+        self.schedule(state)
+
+    def release(self, consumer: MemoryConsumer):
+        """Release consumer prefetch slot after ack.
+        """
+        consumer.unacked -= 1
+        self.schedule(consumer.queue)
+
+    def schedule(self, state: MemoryQueueState):
+        """Schedule dispatch of queue messages to consumers.
+
+        Dispatch executed on the next loop iteration, so publisher never
+        reenters consumer callbacks.
+        """
+        if state.scheduled or not state.messages or not state.consumers:
+            return
+        state.scheduled = True
+        self.loop.call_soon(self.dispatch, state)
+
+    # pylint: disable=no-self-use
+    def dispatch(self, state: MemoryQueueState):
+        """Deliver queued messages while consumers have free capacity.
+        """
+        state.scheduled = False
+        state.dispatching = True
+        try:
+            while state.messages:
+                consumer = state.next_consumer()
+                if consumer is None:
+                    break
+                consumer.deliver(state.messages.popleft())
+        finally:
+            state.dispatching = False
+        if state.requeued:
+            state.messages.extendleft(reversed(state.requeued))
+            state.requeued = []
+            self.schedule(state)
+
+
+# pylint: disable=too-many-instance-attributes
+class MemoryChannel:
+
+    """In-memory channel.
+
+    Implements callback-style `pika.channel.Channel` subset used by `Queue`.
+    Callbacks are invoked synchronously, message delivery is scheduled on the
+    event loop.
+    """
+
+    _unacked: Dict[int, Tuple[MemoryConsumer, Envelope]]
+    _consumers: Dict[str, MemoryConsumer]
+
+    def __init__(self, broker: MemoryBroker, channel_number: int):
+        self.broker = broker
+        self.channel_number = channel_number
+        self.prefetch_count = 0
+        # channel-wide window shared by all consumers (global QoS)
+        self.global_prefetch_count = 0
+        self.is_open = True
+
+        self._delivery_tag = 0
+        self._unacked = OrderedDict()
+        self._consumers = {}
+        self._close_callbacks = []
+
+        # publisher confirms
+        self._confirm_callback = None
+        self._publish_tag = 0
+        self._confirm_scheduled = False
+
+    def add_on_close_callback(self, callback):
+        """Add channel close callback.
+        """
+        self._close_callbacks.append(callback)
+
+    # pylint: disable=unused-argument
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0,
+                  all_channels=False):
+        """Set prefetch count.
+
+        Per-consumer limit applies to consumers created after this call,
+        channel-wide limit (`all_channels=True`) applies immediately.
+        """
+        if all_channels:
+            self.global_prefetch_count = prefetch_count
+            for consumer in self._consumers.values():
+                self.broker.schedule(consumer.queue)
+        else:
+            self.prefetch_count = prefetch_count
+        self._reply(callback, spec.Basic.QosOk())
+
+    @property
+    def has_capacity(self):
+        """Channel-wide prefetch window is not exhausted.
+        """
+        if not self.global_prefetch_count:
+            return True
+        return len(self._unacked) < self.global_prefetch_count
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def exchange_declare(self, callback=None, exchange=None,
+                         exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, nowait=False,
+                         arguments=None):
+        """Declare exchange.
+        """
+        self._ensure_open()
+        self.broker.declare_exchange(exchange, exchange_type)
+        self._reply(callback, spec.Exchange.DeclareOk())
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def queue_declare(self, callback, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, nowait=False,
+                      arguments=None):
+        """Declare queue.
+        """
+        self._ensure_open()
+        name = self.broker.declare_queue(queue, durable, auto_delete,
+                                         arguments)
+        state = self.broker.queues[name]
+        self._reply(callback, spec.Queue.DeclareOk(
+            queue=name,
+            message_count=len(state.messages),
+            consumer_count=len(state.consumers)
+        ))
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def queue_bind(self, callback, queue, exchange, routing_key=None,
+                   nowait=False, arguments=None):
+        """Bind queue to exchange.
+        """
+        self._ensure_open()
+        self.broker.bind_queue(queue, exchange, routing_key)
+        self._reply(callback, spec.Queue.BindOk())
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def queue_delete(self, callback=None, queue='', if_unused=False,
+                     if_empty=False, nowait=False):
+        """Delete queue.
+        """
+        self._ensure_open()
+        message_count = self.broker.delete_queue(queue)
+        self._reply(callback, spec.Queue.DeleteOk(message_count=message_count))
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        """Start consume queue. Return consumer tag.
+        """
+        self._ensure_open()
+        if queue not in self.broker.queues:
+            raise MemoryBrokerError(f"No queue `{queue}`")
+        consumer_tag = consumer_tag or gen_id('ctag')
+        consumer = MemoryConsumer(consumer_tag, self.broker.queues[queue],
+                                  self, consumer_callback,
+                                  self.prefetch_count)
+        self._consumers[consumer_tag] = consumer
+        self.broker.add_consumer(consumer)
+        return consumer_tag
+
+    # pylint: disable=unused-argument
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        """Cancel consumer.
+
+        Unacked messages stay on channel and can be acked later.
+        """
+        self._ensure_open()
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            self.broker.remove_consumer(consumer)
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag=consumer_tag))
+
+    # pylint: disable=unused-argument
+    def confirm_delivery(self, callback=None, nowait=False):
+        """Turn on publisher confirms.
+
+        Callback receives `Basic.Ack` frames, confirms are coalesced into one
+        multiple ack per loop iteration.
+        """
+        self._ensure_open()
+        self._confirm_callback = callback
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        """Publish message.
+
+        Publish to unknown exchange closes channel like AMQP broker does.
+        """
+        self._ensure_open()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        try:
+            self.broker.publish(exchange, routing_key, body,
+                                properties or spec.BasicProperties())
+        except MemoryBrokerError as exc:
+            self.broker.loop.call_soon(self.close, 404, str(exc))
+            return
+        if self._confirm_callback is not None:
+            self._publish_tag += 1
+            if not self._confirm_scheduled:
+                self._confirm_scheduled = True
+                self.broker.loop.call_soon(self._confirm)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        """Acknowledge message(s).
+        """
+        for tag in self._select(delivery_tag, multiple):
+            consumer, _ = self._unacked.pop(tag)
+            self.broker.release(consumer)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        """Reject message(s).
+        """
+        for tag in self._select(delivery_tag or 0, multiple):
+            consumer, envelope = self._unacked.pop(tag)
+            if requeue:
+                self.broker.requeue(consumer, envelope)
+            else:
+                self.broker.release(consumer)
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        """Close channel.
+
+        Cancel all consumers and requeue unacked messages.
+        """
+        if not self.is_open:
+            return
+        self.is_open = False
+        for consumer in list(self._consumers.values()):
+            self.broker.remove_consumer(consumer)
+        self._consumers.clear()
+        for consumer, envelope in self._unacked.values():
+            self.broker.requeue(consumer, envelope)
+        self._unacked.clear()
+        for callback in self._close_callbacks:
+            callback(self, reply_code, reply_text)
+
+    def track(self, consumer: MemoryConsumer, envelope: Envelope) -> int:
+        """Register delivered message and return its delivery tag.
+        """
+        self._delivery_tag += 1
+        self._unacked[self._delivery_tag] = (consumer, envelope)
+        return self._delivery_tag
+
+    def forget_consumer(self, consumer: MemoryConsumer):
+        """Drop consumer of deleted queue.
+        """
+        self._consumers.pop(consumer.tag, None)
+
+    def _select(self, delivery_tag, multiple):
+        """Select delivery tags affected by ack/nack.
+        """
+        if multiple:
+            return [tag for tag in self._unacked
+                    if not delivery_tag or tag <= delivery_tag]
+        if delivery_tag not in self._unacked:
+            raise MemoryBrokerError(
+                f"Unknown delivery tag {delivery_tag} on "
+                f"CHANNEL{self.channel_number}"
+            )
+        return [delivery_tag]
+
+    def _confirm(self):
+        """Confirm all published messages.
+        """
+        self._confirm_scheduled = False
+        if self.is_open:
+            self._reply(self._confirm_callback, spec.Basic.Ack(
+                delivery_tag=self._publish_tag, multiple=True
+            ))
+
+    def _ensure_open(self):
+        if not self.is_open:
+            raise exceptions.ChannelClosed(
+                f"CHANNEL{self.channel_number} is closed"
+            )
+
+    def _reply(self, callback, method):
+        if callback is not None:
+            callback(frame.Method(self.channel_number, method))
+
+
+class MemoryQueueBackend(AbstractQueueBackend):
+
+    """In-memory queue backend.
+
+    Drop-in replacement of `QueueBackend` for single-node installations.
+    Messages are not persisted and live only within the process.
+
+    Delayed messages are held by event loop timers (exact delay, no TTL
+    buckets) and published to target exchange when timer fires.
+
+    :param MemoryBroker broker: broker to connect to (new one by default).
+    :param int prefetch_count: prefetch count for every channel.
+
+    RabbitMQ connection options (`host`, `port`, `username`, `password`,
+    `virtual_host`) are accepted and ignored, so backend can be switched in
+    config without touching other queue options.
+    """
+
+    _channels: Dict[str, MemoryChannel]
+    _delayed: Set[asyncio.TimerHandle]
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def __init__(self, loop=None, broker=None, reconnect_timeout=3,
+                 prefetch_count=DEFAULT_PREFETCH_COUNT, host=None, port=None,
+                 username=None, password=None, virtual_host=None, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+        self.broker = broker or MemoryBroker()
+        self.reconnect_timeout = reconnect_timeout
+        self.prefetch_count = prefetch_count
+
+        self.log = logger
+
+        self._open = False
+        self._channel_number = 0
+        self._delayed = set()
+
+    def connect(self, loop=None) -> asyncio.Future:
+        """Connect to in-memory broker.
+        """
+        if loop:
+            self.loop = loop
+        if not self.loop:
+            self.loop = asyncio.get_event_loop()
+        if self.broker.loop is None:
+            self.broker.loop = self.loop
+        self._open = True
+
+        future = self._create_future()
+        future.set_result(True)
+        return future
+
+    @property
+    def is_open(self):
+        return self._open
+
+    async def channel(self, name='default') -> MemoryChannel:
+        """Get channel by name (coroutine).
+        """
+        if not self._open:
+            raise MemoryBrokerError("Backend is not connected")
+        channel = self._channels.get(name)
+        if channel is None or not channel.is_open:
+            self._channel_number += 1
+            channel = MemoryChannel(self.broker, self._channel_number)
+            channel.add_on_close_callback(self.on_channel_closed)
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+            self._channels[name] = channel
+        return channel
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """Handle channel closed event.
+
+        Auto-delete queues of the channel are gone, declare them again.
+        """
+        self.log.debug('CHANNEL%i closed', channel.channel_number)
+        self.invalidate_topology()
+
+    # pylint: disable=too-many-arguments
+    async def publish_delayed(self, exchange, routing_key, body, delay,
+                              priority=None) -> asyncio.Future:
+        """Publish message to exchange after delay.
+
+        Message is accepted immediately (returned future is resolved) and
+        held by loop timer until delay expires. Delays are limited like in
+        RabbitMQ backend (see `AbstractQueueBackend.publish_delayed`).
+        """
+        check_delay(delay)
+
+        def publish():
+            self._delayed.discard(handle)
+            self.loop.create_task(
+                self.publisher.publish(exchange, routing_key, body,
+                                       priority=priority)
+            )
+
+        handle = self.loop.call_later(delay, publish)
+        self._delayed.add(handle)
+
+        future = self._create_future()
+        future.set_result(None)
+        return future
+
+    @property
+    def delayed(self):
+        """Number of messages waiting for delay to expire.
+        """
+        return len(self._delayed)
+
+    def close(self) -> asyncio.Future:
+        """Close all channels.
+        """
+        if self._delayed:
+            self.log.warning("%i delayed messages dropped",
+                             len(self._delayed))
+            for handle in self._delayed:
+                handle.cancel()
+            self._delayed.clear()
+        if self.publisher.flush_nowait():  # pragma: no cover
+            self.log.warning("%i published messages were not sent",
+                             self.publisher.pending)
+        self.acks.flush()
+        self._open = False
+        self.invalidate_topology()
+        for channel in self._channels.values():
+            channel.close()
+        self._channels.clear()
+
+        future = self._create_future()
+        future.set_result((200, 'Normal shutdown'))
+        return future
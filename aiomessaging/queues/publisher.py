@@ -0,0 +1,357 @@
+"""Coalescing publisher.
+"""
+import logging
+import asyncio
+
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Dict, List, Optional, Tuple
+
+import pika
+
+from ..exceptions import PublishError
+from .codecs import (
+    Codec,
+    JsonCodec,
+    DEFLATE,
+    DEFAULT_COMPRESS_LEVEL,
+    compress,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# default time to collect messages before write (0 — next loop iteration)
+PUBLISH_WINDOW = 0
+# buffer size to write immediately and apply backpressure to publishers
+PUBLISH_BATCH_SIZE = 1000
+
+
+# pylint: disable=too-many-instance-attributes
+class Publisher:
+
+    """Coalescing publisher.
+
+    Collects messages published within short window (or until batch size
+    reached), serializes the whole batch in one pass and writes it to the
+    channel at once, so the underlying connection sends frames together.
+
+    In confirm mode channel is switched to publisher confirms and every
+    message is tracked by its delivery tag. Confirms are handled
+    asynchronously, so any number of messages can be in flight.
+
+    Publish returns future which will be resolved when message was confirmed
+    by broker (or written to the channel if confirms disabled). Future fails
+    with `PublishError` if message was nacked or channel closed.
+
+    :param backend: queue backend to get channel from.
+    :param Codec codec: codec to serialize messages with (JSON by default).
+    :param int compress_threshold: compress encoded bodies longer than this
+                                   (disabled if not provided).
+    :param int compress_level: zlib compression level.
+    :param float window: time to collect messages before write.
+    :param int batch_size: max number of buffered messages.
+    :param bool confirms: enable publisher confirms.
+    :param str channel_name: name of backend channel to publish on.
+    """
+
+    _buffer: List[Tuple[str, str, Any, Optional[int], asyncio.Future]]
+    _flush_handle: Optional[asyncio.Handle]
+    # serializes channel acquisition of concurrent flushes
+    _channel_lock: Optional[asyncio.Lock]
+    # future by delivery tag
+    _unconfirmed: Dict[int, asyncio.Future]
+    # number of not confirmed messages by future
+    _waiting: Dict[asyncio.Future, int]
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, backend, codec: Codec = None, window=PUBLISH_WINDOW,
+                 batch_size=PUBLISH_BATCH_SIZE, confirms=True,
+                 channel_name='publish', compress_threshold=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.backend = backend
+        self.codec = codec or JsonCodec()
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.window = window
+        self.batch_size = batch_size
+        self.confirms = confirms
+        self.channel_name = channel_name
+
+        self.properties = pika.BasicProperties(
+            app_id='example-publisher',
+            content_type=self.codec.content_type
+        )
+        self.compressed_properties = pika.BasicProperties(
+            app_id='example-publisher',
+            content_type=self.codec.content_type,
+            content_encoding=DEFLATE
+        )
+        # properties of prioritized messages by (priority, compressed)
+        self._priority_properties = {}
+
+        self._buffer = []
+        self._flush_handle = None
+        self._channel = None
+        self._channel_lock = None
+
+        self._delivery_tag = 0
+        self._unconfirmed = OrderedDict()
+        self._waiting = {}
+
+    async def publish(self, exchange, routing_key, body,
+                      priority=None) -> asyncio.Future:
+        """Add message to the buffer.
+
+        Wait buffer flush only if it is full.
+        """
+        future = self._create_future(1)
+        self._buffer.append((exchange, routing_key, body, priority, future))
+        await self._buffered()
+        return future
+
+    async def publish_many(self, exchange, routing_key, bodies,
+                           priorities=None) -> asyncio.Future:
+        """Add batch of messages to the buffer.
+
+        `bodies` may be any iterable (generator for huge batches), it is
+        consumed in chunks of `batch_size`, every full chunk is written
+        before the next one is taken. `priorities` is an optional iterable
+        of message priorities.
+
+        Return single future resolved when the whole batch was confirmed.
+        """
+        # extra count keeps future pending until all bodies are buffered
+        future = self._create_future(1)
+        bodies = iter(bodies)
+        priorities = iter(priorities) if priorities is not None else None
+        while not future.done():
+            chunk = list(islice(bodies, self.batch_size))
+            if not chunk:
+                break
+            if priorities is None:
+                chunk_priorities = [None] * len(chunk)
+            else:
+                chunk_priorities = islice(priorities, len(chunk))
+            self._waiting[future] += len(chunk)
+            self._buffer.extend(
+                (exchange, routing_key, body, priority, future)
+                for body, priority in zip(chunk, chunk_priorities)
+            )
+            await self._buffered()
+        self._settle(future)
+        return future
+
+    async def flush(self):
+        """Write all buffered messages to the channel.
+
+        Messages are written in chunks of `batch_size`, loop is released
+        between chunks.
+        """
+        self._cancel_flush()
+        while self._buffer:
+            if self._channel is None or not self._channel.is_open:
+                await self._acquire_channel()
+            if self.flush_nowait(self.batch_size):
+                await asyncio.sleep(0)
+
+    def flush_nowait(self, limit=None):
+        """Write buffered messages if channel is available.
+
+        Write at most `limit` messages if provided (all by default).
+
+        Return number of messages left in buffer.
+        """
+        self._cancel_flush()
+        if self._channel is None or not self._channel.is_open:
+            return len(self._buffer)
+
+        if limit is None:
+            batch, self._buffer = self._buffer, []
+        else:
+            batch, self._buffer = self._buffer[:limit], self._buffer[limit:]
+        encode = self.codec.encode
+        channel = self._channel
+        threshold = self.compress_threshold
+        for exchange, routing_key, body, priority, future in batch:
+            try:
+                payload = encode(body)
+            # pylint: disable=broad-except
+            except Exception as exc:
+                # fail only this message, the rest of batch is written
+                logger.error("Can't encode message (%s): %s", routing_key,
+                             exc)
+                self._settle(future, PublishError(f"Encode failed: {exc}"))
+                continue
+            compressed = bool(threshold and len(payload) > threshold)
+            if compressed:
+                payload = compress(payload, self.compress_level)
+            properties = self.get_properties(priority, compressed)
+            try:
+                channel.basic_publish(exchange, routing_key, payload,
+                                      properties)
+            except pika.exceptions.ChannelClosed:  # pragma: no cover
+                logger.error('Message not delivered (%s): %s',
+                             routing_key, body)
+                self._settle(future, PublishError("Channel closed"))
+                continue
+            if self.confirms:
+                self._delivery_tag += 1
+                self._unconfirmed[self._delivery_tag] = future
+            else:
+                self._settle(future)
+        return len(self._buffer)
+
+    def get_properties(self, priority=None, compressed=False):
+        """Get message properties.
+        """
+        if priority is None:
+            if compressed:
+                return self.compressed_properties
+            return self.properties
+        key = (priority, compressed)
+        if key not in self._priority_properties:
+            self._priority_properties[key] = pika.BasicProperties(
+                app_id=self.properties.app_id,
+                content_type=self.properties.content_type,
+                content_encoding=DEFLATE if compressed else None,
+                priority=priority
+            )
+        return self._priority_properties[key]
+
+    @property
+    def pending(self):
+        """Number of buffered messages.
+        """
+        return len(self._buffer)
+
+    @property
+    def in_flight(self):
+        """Number of messages written but not confirmed yet.
+        """
+        return len(self._unconfirmed)
+
+    def on_confirm(self, method_frame):
+        """Handle publisher confirm (Basic.Ack or Basic.Nack).
+        """
+        method = method_frame.method
+        error = None
+        if isinstance(method, pika.spec.Basic.Nack):
+            error = PublishError(
+                f"Message nacked by broker (tag {method.delivery_tag})"
+            )
+        if method.multiple:
+            while self._unconfirmed:
+                tag = next(iter(self._unconfirmed))
+                if tag > method.delivery_tag:
+                    break
+                self._settle(self._unconfirmed.pop(tag), error)
+        elif method.delivery_tag in self._unconfirmed:
+            self._settle(self._unconfirmed.pop(method.delivery_tag), error)
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """Fail all unconfirmed messages of closed channel.
+        """
+        if channel is not self._channel:
+            return  # pragma: no cover
+        if self._unconfirmed:
+            logger.warning("Publish channel closed with %i unconfirmed "
+                           "messages: %s %s", len(self._unconfirmed),
+                           reply_code, reply_text)
+        error = PublishError(f"Channel closed: {reply_code} {reply_text}")
+        unconfirmed, self._unconfirmed = self._unconfirmed, OrderedDict()
+        for future in unconfirmed.values():
+            self._settle(future, error)
+
+    async def _acquire_channel(self):
+        """Get publish channel from backend.
+
+        Concurrent flushes wait for the first one, so new channel is set up
+        (delivery tags reset, confirms enabled) exactly once.
+        """
+        if self._channel_lock is None:
+            # created lazily to bind to the running loop
+            self._channel_lock = asyncio.Lock()
+        async with self._channel_lock:
+            if self._channel is not None and self._channel.is_open:
+                return
+            channel = await self.backend.channel(self.channel_name)
+            if channel is not self._channel:
+                self._setup_channel(channel)
+
+    def _setup_channel(self, channel):
+        """Start using new channel.
+        """
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.add_on_close_callback(self.on_channel_closed)
+        if self.confirms:
+            channel.confirm_delivery(self.on_confirm)
+
+    def _create_future(self, count) -> asyncio.Future:
+        # pylint: disable=protected-access
+        future = self.backend._create_future()
+        future.add_done_callback(_retrieve_exception)
+        if count:
+            self._waiting[future] = count
+        else:
+            future.set_result(None)
+        return future
+
+    def _settle(self, future, error=None):
+        """Mark one message of future as confirmed (or failed).
+        """
+        if future.done():
+            return
+        if error is not None:
+            self._waiting.pop(future, None)
+            future.set_exception(error)
+            return
+        self._waiting[future] -= 1
+        if not self._waiting[future]:
+            del self._waiting[future]
+            future.set_result(None)
+
+    async def _buffered(self):
+        """Schedule or force buffer flush after new messages added.
+        """
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = self.backend.loop.call_later(
+                self.window, self._start_flush
+            )
+
+    def _cancel_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self.backend.loop.create_task(self._flush_task())
+
+    async def _flush_task(self):
+        """Scheduled flush. Retry after reconnect timeout on failure.
+        """
+        try:
+            await self.flush()
+        # pylint: disable=broad-except
+        except Exception:
+            logger.exception("Publish failed, %i messages pending. Retry "
+                             "after %ss", len(self._buffer),
+                             self.backend.reconnect_timeout)
+            self._flush_handle = self.backend.loop.call_later(
+                self.backend.reconnect_timeout, self._start_flush
+            )
+
+
+def _retrieve_exception(future: asyncio.Future):
+    """Mark publish failure retrieved for futures nobody waits for.
+    """
+    if not future.cancelled() and future.exception() is not None:
+        logger.debug("Publish failed: %s", future.exception())
@@ -4,10 +4,11 @@ import logging
 import asyncio
 
 from functools import partial
+from itertools import tee
+from typing import Optional
 from abc import ABC, abstractmethod, abstractproperty
 
 import pika
-import ujson
 
 from ..logging import QueueLoggerAdapter
 
@@ -58,13 +59,23 @@ class AbstractQueue(ABC):
         """
         pass  # pragma: no cover
 
-    async def publish(self, body, routing_key=None):
+    async def publish(self, body, routing_key=None, confirm=False):
         """Publish message to the queue.
 
+        Wait for publish confirmation if `confirm` is True.
+
         TODO: bad interface
         """
         pass  # pragma: no cover
 
+    async def publish_many(self, bodies, routing_key=None, confirm=False):
+        """Publish batch of messages to the queue.
+
+        Override to publish the whole batch at once.
+        """
+        for body in bodies:
+            await self.publish(body, routing_key=routing_key, confirm=confirm)
+
 
 # pylint: disable=too-many-instance-attributes
 class Queue(AbstractQueue):
@@ -80,19 +91,30 @@ class Queue(AbstractQueue):
 
     Queue handle reconnects by itself obtaining new channel from backend if
     current one was closed.
+
+    Queue is attached to the backend channel with `channel_name` name.
+    Consumer which needs its own QoS must consume on a dedicated channel.
+
+    Optional `arguments` are passed to queue declaration (`x-message-ttl`,
+    `x-dead-letter-exchange` etc).
     """
 
     _consume_handler = None
     _consumer_tag = None
     _channel: pika.channel.Channel
     _normal_close = False
+    # channel-wide prefetch window set by consumer (restored on reconnect)
+    prefetch_count: Optional[int] = None
 
+    # pylint: disable=too-many-arguments
     def __init__(self, backend, name=None, exchange='', exchange_type='direct',
-                 routing_key=None, auto_delete=True, durable=False):
+                 routing_key=None, auto_delete=True, durable=False,
+                 channel_name='default', arguments=None):
         self._name = name
         super().__init__()
 
         self._backend = backend
+        self.channel_name = channel_name
 
         self.exchange = exchange
         self.exchange_type = exchange_type
@@ -100,6 +122,7 @@ class Queue(AbstractQueue):
 
         self.auto_delete = auto_delete
         self.durable = durable
+        self.arguments = arguments
 
         assert self.exchange is not None or self.name is not None, \
             ("You must define name if you want to consume queue"
@@ -109,15 +132,53 @@ class Queue(AbstractQueue):
     def name(self):
         return self._name
 
-    async def declare(self) -> 'Queue':
-        """Declare required queue and exchange.
+    @property
+    def topology_key(self):
+        """Declared topology cache key.
 
-        Queue, exchange and binding will be declared if information provided.
+        `None` for server-named queues: they are unique on every declare.
+        """
+        if self.name == '':
+            return None
+        arguments = tuple(sorted((self.arguments or {}).items()))
+        return (self.name, self.exchange, self.exchange_type,
+                self.routing_key, self.auto_delete, self.durable, arguments)
+
+    @property
+    def acks(self):
+        """Backend acknowledgements coalescer.
+        """
+        return self._backend.acks
+
+    def decode(self, properties, body):
+        """Decode delivered message body.
+        """
+        return self._backend.decode(properties, body)
+
+    @property
+    def channel_number(self) -> Optional[int]:
+        """Number of attached channel.
+        """
+        channel = getattr(self, '_channel', None)
+        if channel is None:
+            return None
+        return channel.channel_number
+
+    async def attach(self) -> 'Queue':
+        """Acquire channel for queue without topology declaration.
         """
         # we are relying to this in other functions
-        self._channel = await self._backend.channel()
+        self._channel = await self._backend.channel(self.channel_name)
         self.log.debug("Channel acquired CHANNEL%i",
                        self._channel.channel_number)
+        return self
+
+    async def declare(self) -> 'Queue':
+        """Declare required queue and exchange.
+
+        Queue, exchange and binding will be declared if information provided.
+        """
+        await self.attach()
 
         if self.exchange:
             await self.declare_exchange()
@@ -125,7 +186,7 @@ class Queue(AbstractQueue):
         if self.name is not None:
             await self.declare_queue()
 
-        if self.exchange:
+        if self.exchange and self.name is not None:
             await self.bind_queue()
 
         return self
@@ -141,11 +202,30 @@ class Queue(AbstractQueue):
         self._channel.add_on_close_callback(
             self.on_channel_closed
         )
+        if self.prefetch_count is not None:
+            self._apply_prefetch()
         self._consumer_tag = self._channel.basic_consume(bounded_handler,
                                                          self.name)
         self.log.debug("Consumer tag %s on CHANNEL%i",
                        self._consumer_tag, self._channel.channel_number)
 
+    def set_prefetch(self, prefetch_count):
+        """Set prefetch window of queue channel.
+
+        Window is shared by all consumers of the channel (global QoS) and can
+        be resized at any time. Per-consumer limit is dropped for consumers
+        started after this call. QoS is sent only if window of the channel
+        is changed (see `AbstractQueueBackend.set_prefetch`).
+        """
+        self.prefetch_count = prefetch_count
+        self._apply_prefetch()
+
+    def _apply_prefetch(self):
+        if self._backend.set_prefetch(self._channel, self.prefetch_count):
+            self.log.debug("Prefetch count %i on CHANNEL%i",
+                           self.prefetch_count,
+                           self._channel.channel_number)
+
     async def declare_and_consume(self, handler):
         """Declare queue and consume.
 
@@ -157,34 +237,68 @@ class Queue(AbstractQueue):
         except pika.exceptions.ChannelClosed:  # pragma: no cover
             self.reconnect()
 
-    async def publish(self, body, routing_key=None):
+    # pylint: disable=too-many-arguments
+    async def publish(self, body, routing_key=None, confirm=False,
+                      delay=None, priority=None) -> asyncio.Future:
         """Publish message to the queue using exchange.
+
+        Message is buffered by backend publisher and written together with
+        other messages published within the same window. Return future
+        resolved when message was confirmed by broker.
+
+        Pass `confirm=True` to wait for confirmation. `PublishError` will be
+        raised if message was not confirmed.
+
+        Pass `delay` (seconds) to deliver message not earlier than after
+        delay (see `AbstractQueueBackend.publish_delayed`).
+
+        Message priority is taken from `meta.priority` of message body if
+        not provided.
         """
-        properties = pika.BasicProperties(
-            app_id='example-publisher',
-            content_type='application/json'
-        )
-        self.log.debug("Publish to %s:%s", self.exchange,
-                       routing_key or self.routing_key)
-        channel = await self._backend.channel('publish')
-        try:
-            channel.basic_publish(
-                self.exchange,
-                routing_key or self.routing_key or '',
-                # pylint: disable=c-extension-no-member
-                ujson.dumps(body, ensure_ascii=False),
-                properties)
-        except pika.exceptions.ChannelClosed:  # pragma: no cover
-            self.log.error(
-                'Message not delivered (%s): %s',
-                routing_key, body
+        routing_key = routing_key or self.routing_key or ''
+        if priority is None:
+            priority = message_priority(body)
+        if delay:
+            self.log.debug("Publish to %s:%s with delay %ss", self.exchange,
+                           routing_key, delay)
+            future = await self._backend.publish_delayed(
+                self.exchange, routing_key, body, delay, priority=priority
             )
+            if confirm:
+                await future
+            return future
+        self.log.debug("Publish to %s:%s", self.exchange, routing_key)
+        future = await self._backend.publisher.publish(
+            self.exchange, routing_key, body, priority=priority
+        )
+        if confirm:
+            await future
+        return future
+
+    async def publish_many(self, bodies, routing_key=None,
+                           confirm=False) -> asyncio.Future:
+        """Publish batch of messages to the queue using exchange.
+
+        Return future resolved when the whole batch was confirmed.
+        """
+        routing_key = routing_key or self.routing_key or ''
+        self.log.debug("Publish batch to %s:%s", self.exchange, routing_key)
+        # bodies are streamed, priorities are taken in step with them
+        bodies, prioritized = tee(bodies)
+        priorities = map(message_priority, prioritized)
+        future = await self._backend.publisher.publish_many(
+            self.exchange, routing_key, bodies, priorities=priorities
+        )
+        if confirm:
+            await future
+        return future
 
     async def delete(self):
         """Delete queue explicitly.
         """
         # pylint: disable=protected-access
         future = self._backend._create_future()
+        self._backend.invalidate_topology(self.topology_key)
 
         def on_delete(method_frame):
             future.set_result(True)
@@ -226,7 +340,7 @@ class Queue(AbstractQueue):
 
         self._channel.queue_declare(
             on_queue_declare, self.name, auto_delete=self.auto_delete,
-            durable=self.durable
+            durable=self.durable, arguments=self.arguments
         )
 
         self.log.debug('Declaring queue itself')
@@ -310,6 +424,9 @@ class Queue(AbstractQueue):
             """
             self.log.debug("Cancel ok on CHANNEL%s",
                            method_frame.channel_number)
+        if self.auto_delete:
+            # broker deletes queue after last consumer cancelled
+            self._backend.invalidate_topology(self.topology_key)
         try:
             if self._consumer_tag:
                 self._channel.basic_cancel(
@@ -323,4 +440,21 @@ class Queue(AbstractQueue):
         """Queue representation.
         """
         return (f'<Queue (name={self.name};exchange={self.exchange};'
-                f'routing_key={self.routing_key}>')
+                f'routing_key={self.routing_key};'
+                f'channel={self.channel_name}:{self.channel_number}>')
+
+
+def message_priority(body) -> Optional[int]:
+    """Get AMQP priority of message body from `meta.priority`.
+
+    Invalid priorities are ignored, valid ones are limited to 0..255.
+    """
+    if not isinstance(body, dict):
+        return None
+    meta = body.get('meta')
+    if not isinstance(meta, dict):
+        return None
+    priority = meta.get('priority')
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        return None
+    return max(0, min(255, priority))
@@ -32,11 +32,11 @@ class Router:
             # No more routes available (all finished or failed)
             return None
 
-    def apply_next_effect(self, message):
+    async def apply_next_effect(self, message):
         """Apply next effect for message.
         """
         effect = self.next_effect(message)
-        new_state = effect.apply(message)
+        new_state = await effect.apply(message)
         message.set_route_state(effect, new_state)
         if effect.next_action(message.get_route_state(effect)):
             message.set_route_status(effect, EffectStatus.PENDING)
@@ -0,0 +1,2 @@
+"""aiomessaging benchmarks.
+"""
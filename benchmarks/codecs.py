@@ -0,0 +1,63 @@
+"""Message serialization benchmark.
+
+Measures `Message.to_dict` / `Message.from_dict` round-trip through every
+available wire codec (encode + decode), with route growing like it does on
+every stage of the output pipeline.
+
+    python -m benchmarks.codecs [--number N] [--routes R]
+"""
+import argparse
+import timeit
+
+from aiomessaging.message import Message, Route
+from aiomessaging.effects import send
+from aiomessaging.contrib.dummy import NullOutput, ConsoleOutput
+from aiomessaging.queues.codecs import CODECS, get_codec
+
+
+def make_message(routes):
+    """Message with `routes` send effects in route.
+    """
+    outputs = [NullOutput(), ConsoleOutput()]
+    return Message(
+        event_id='benchmark',
+        event_type='example_event',
+        content={'title': 'Benchmark', 'text': 'x' * 200, 'user_id': 1},
+        meta={'priority': 1, 'tags': ['a', 'b']},
+        route=[Route(send(outputs[i % 2], outputs[(i + 1) % 2]))
+               for i in range(routes)],
+    )
+
+
+def roundtrip(message, codec):
+    """Serialize message, encode, decode and load it back.
+    """
+    body = codec.encode(message.to_dict())
+    return Message.from_dict(codec.decode(body)), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--routes', type=int, default=5)
+    args = parser.parse_args()
+
+    message = make_message(args.routes)
+    print(f"{'codec':10} {'size':>8} {'us/op':>10}")
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        # pylint: disable=broad-except
+        except Exception as exc:
+            print(f"{name:10} skipped: {exc}")
+            continue
+        _, size = roundtrip(message, codec)
+        seconds = timeit.timeit(
+            lambda: roundtrip(message, codec),
+            number=args.number
+        )
+        print(f"{name:10} {size:>8} {seconds / args.number * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,8 @@ setup(
         'click',
     ],
     extras_require={
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
         'dev': [
             'Sphinx',
             'commonmark',
@@ -1,6 +1,7 @@
 import pytest
 
-from aiomessaging import QueueBackend
+from aiomessaging import QueueBackend, MemoryQueueBackend
+from aiomessaging import outputs
 
 
 @pytest.fixture
@@ -9,3 +10,29 @@ async def backend():
     await backend.connect()
     yield backend
     await backend.close()
+
+
+@pytest.fixture
+async def memory_backend():
+    backend = MemoryQueueBackend()
+    await backend.connect()
+    yield backend
+    await backend.close()
+
+
+def clear_output_registries():
+    """Drop shared state of outputs (batchers, limiters, breakers, pools).
+    """
+    # pylint: disable=protected-access
+    outputs.shutdown_executors()
+    for registry in (outputs._batchers, outputs._rate_limits,
+                     outputs._rate_limiters, outputs._breaker_configs,
+                     outputs._breakers):
+        registry.clear()
+
+
+@pytest.fixture
+def output_registries():
+    clear_output_registries()
+    yield
+    clear_output_registries()
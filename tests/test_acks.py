@@ -0,0 +1,135 @@
+"""
+Acknowledgements coalescing tests.
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+from aiomessaging.consumers.base import SingleQueueConsumer
+
+# pylint:disable=unused-import
+from .fixtures import memory_backend  # noqa
+
+
+async def deliver(backend, name, count):
+    """Publish `count` messages to new queue and collect delivery tags.
+    """
+    queue = await backend.get_queue(name, auto_delete=False,
+                                    channel_name=name)
+    tags = []
+
+    def handler(queue, channel, basic_deliver, properties, body):
+        backend.acks.track(channel, basic_deliver.delivery_tag)
+        tags.append(basic_deliver.delivery_tag)
+
+    queue.consume(handler)
+    await queue.publish_many(({'a': i} for i in range(count)),
+                             routing_key=name)
+    await backend.publisher.flush()
+    await asyncio.sleep(0)
+    assert len(tags) == count
+    return await backend.channel(name), tags
+
+
+@pytest.mark.asyncio
+async def test_multiple_ack(memory_backend):
+    acks = memory_backend.acks
+    channel, tags = await deliver(memory_backend, 'multiple', 5)
+
+    with mock.patch.object(channel, 'basic_ack',
+                           wraps=channel.basic_ack) as basic_ack:
+        for tag in tags:
+            acks.ack(channel, tag)
+        assert acks.pending == 5
+        assert not basic_ack.called
+
+        acks.flush()
+        basic_ack.assert_called_once_with(5, multiple=True)
+        assert acks.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_gap(memory_backend):
+    acks = memory_backend.acks
+    channel, tags = await deliver(memory_backend, 'gap', 5)
+
+    with mock.patch.object(channel, 'basic_ack',
+                           wraps=channel.basic_ack) as basic_ack:
+        acks.nack(channel, 2)
+        for tag in (1, 4, 5):
+            acks.ack(channel, tag)
+        acks.flush()
+        assert basic_ack.call_args_list == [
+            mock.call(1, multiple=True), mock.call(4), mock.call(5),
+        ]
+
+        basic_ack.reset_mock()
+        acks.ack(channel, 3)
+        acks.flush()
+        basic_ack.assert_called_once_with(3, multiple=True)
+
+    assert not channel._unacked  # pylint: disable=protected-access
+
+
+@pytest.mark.asyncio
+async def test_batch_size(memory_backend):
+    acks = memory_backend.acks
+    acks.batch_size = 3
+    channel, tags = await deliver(memory_backend, 'batch', 4)
+
+    with mock.patch.object(channel, 'basic_ack',
+                           wraps=channel.basic_ack) as basic_ack:
+        for tag in tags:
+            acks.ack(channel, tag)
+        basic_ack.assert_called_once_with(3, multiple=True)
+        assert acks.pending == 1
+
+        # scheduled flush
+        await asyncio.sleep(0.01)
+        assert basic_ack.call_count == 2
+        assert acks.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_abandon(memory_backend):
+    acks = memory_backend.acks
+    channel, tags = await deliver(memory_backend, 'abandon', 3)
+
+    with mock.patch.object(channel, 'basic_ack',
+                           wraps=channel.basic_ack) as basic_ack:
+        acks.ack(channel, 2)
+        acks.abandon(channel, 1)
+        basic_ack.assert_called_once_with(2)
+
+        acks.ack(channel, 3)
+        assert basic_ack.call_count == 2
+        # abandoned delivery is never acknowledged
+        assert list(channel._unacked) == [1]  # pylint: disable=W0212
+
+
+@pytest.mark.asyncio
+async def test_consumer_acks(event_loop, memory_backend):
+    class CounterConsumer(SingleQueueConsumer):
+        counter = 0
+
+        async def handler(self, message):
+            self.counter += 1
+
+    queue = await memory_backend.get_queue('consumer_acks',
+                                           auto_delete=False)
+    consumer = CounterConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+    channel = await memory_backend.channel()
+
+    with mock.patch.object(channel, 'basic_ack',
+                           wraps=channel.basic_ack) as basic_ack:
+        await queue.publish_many(({'a': i} for i in range(20)),
+                                 routing_key='consumer_acks', confirm=True)
+        while consumer.counter < 20:
+            await asyncio.sleep(0)
+        await consumer.stop()
+        assert basic_ack.call_count < 20
+
+    assert not channel._unacked  # pylint: disable=protected-access
+    assert not memory_backend.broker.queues['consumer_acks'].messages
@@ -1,13 +1,19 @@
 """
 Application object tests.
 """
+import asyncio
+import threading
 from unittest import mock
 
 import pytest
 
 from aiomessaging.app import AiomessagingApp
+from aiomessaging.consumers import ConsumersManager
+from aiomessaging.contrib.dummy import NullOutput
 
 from .helpers import wait_messages
+# pylint:disable=unused-import
+from .fixtures import output_registries  # noqa
 
 
 def test_sync(event_loop, app):
@@ -42,3 +48,73 @@ def app():
     """
     with mock.patch('aiomessaging.app.apply_logging_configuration'):
         return AiomessagingApp(config='tests/testing.yml')
+
+
+@pytest.mark.asyncio
+async def test_channel_assignment(event_loop, app):
+    app.config.from_dict({
+        'queue': {'backend': 'memory'},
+        'consumers': {'event': {'channel': 'class'}},
+    })
+    app.queue = app.config.get_queue_backend()
+    app.consumers = ConsumersManager(app.config, app.queue)
+    app.set_event_loop(event_loop)
+    await app._start()
+
+    assignment = app.consumers.channel_assignment()
+    assert assignment['cluster'] == {
+        app.consumers.cluster.queue.name:
+            ('cluster', app.queue.channels['cluster'])
+    }
+    assert assignment['event.example_event'] == {
+        'events.example_event': ('event', app.queue.channels['event'])
+    }
+    assert assignment['message.example_event'] == {
+        'messages.example_event': (
+            'message.example_event',
+            app.queue.channels['message.example_event']
+        )
+    }
+    assert len(set(app.queue.channels.values())) == len(app.queue.channels)
+
+    await app.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_event_types(event_loop, app):
+    events = dict(app.config.events)
+    events['other_event'] = events['example_event']
+    app.config.from_dict({'queue': {'backend': 'memory'}, 'events': events})
+    app.queue = app.config.get_queue_backend()
+    app.consumers = ConsumersManager(app.config, app.queue)
+    app.set_event_loop(event_loop)
+    await app._start()
+
+    assert app.consumers.event_types() == ['example_event', 'other_event']
+    for event_type in events:
+        await app.send(event_type, {})
+    for event_type in events:
+        consumer = app.consumers.message_consumers[event_type]
+        message = await consumer.last_messages.get()
+        assert message['event_type'] == event_type
+
+    await app.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_shutdown_executors(app, output_registries):
+    """Hung blocking output call blocks neither loop nor shutdown.
+    """
+    released = threading.Event()
+    executor = NullOutput().get_executor()
+    executor.submit(released.wait)
+
+    ticks = []
+    ticker = asyncio.get_event_loop().call_later(0.01, ticks.append, 1)
+    try:
+        with mock.patch('aiomessaging.app.EXECUTORS_SHUTDOWN_TIMEOUT', 0.05):
+            await app.shutdown_executors()
+    finally:
+        ticker.cancel()
+        released.set()
+    assert ticks
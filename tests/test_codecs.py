@@ -0,0 +1,167 @@
+"""
+Wire codecs tests.
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+from pika import spec
+
+from aiomessaging.exceptions import UnknownContentType
+from aiomessaging.message import Message, Route
+from aiomessaging.effects import send
+from aiomessaging.contrib.dummy import NullOutput
+from aiomessaging.queues import MemoryQueueBackend
+from aiomessaging.queues.codecs import (
+    CODECS,
+    JSON,
+    get_codec,
+    get_decoder,
+    decode,
+)
+from aiomessaging.queues.memory import MemoryBroker
+from aiomessaging.consumers.base import SingleQueueConsumer
+
+from .helpers import wait_messages
+
+
+def available_codecs():
+    """Names of codecs which dependencies are installed.
+    """
+    names = []
+    for name in CODECS:
+        try:
+            get_codec(name)
+        # pylint: disable=broad-except
+        except Exception:
+            continue
+        names.append(name)
+    return names
+
+
+@pytest.mark.parametrize('name', available_codecs())
+def test_roundtrip(name):
+    codec = get_codec(name)
+    message = Message(event_id='test', event_type='example_event',
+                      content={'text': 'привет'}, meta={'priority': 1},
+                      route=[Route(send(NullOutput()))])
+    body = codec.encode(message.to_dict())
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    properties = spec.BasicProperties(content_type=codec.content_type)
+    loaded = Message.from_dict(decode(properties, body))
+    assert loaded.to_dict() == message.to_dict()
+
+
+def test_decoder():
+    assert get_decoder(None).content_type == JSON
+    with pytest.raises(UnknownContentType):
+        get_decoder('text/plain')
+    with pytest.raises(Exception):
+        get_codec('unknown')
+
+
+@pytest.mark.asyncio
+async def test_mixed_codecs(event_loop, caplog):
+    class CollectConsumer(SingleQueueConsumer):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.received = []
+
+        async def handler(self, message):
+            self.received.append(message)
+
+    broker = MemoryBroker()
+    orjson_node = MemoryQueueBackend(broker=broker, codec='orjson')
+    json_node = MemoryQueueBackend(broker=broker)
+    await orjson_node.connect(loop=event_loop)
+    await json_node.connect(loop=event_loop)
+
+    queue = await json_node.get_queue('mixed', auto_delete=False)
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+
+    for node in (orjson_node, json_node):
+        publish_queue = await node.get_queue('mixed', auto_delete=False)
+        await publish_queue.publish({'a': node.codec.name},
+                                    routing_key='mixed')
+    await wait_messages(consumer, 2)
+
+    # unknown content type held and returned to the queue, warned once
+    json_node.publisher.properties = spec.BasicProperties(
+        content_type='application/unknown'
+    )
+    for _ in range(2):
+        await queue.publish({'a': 'unknown'}, routing_key='mixed')
+    await json_node.publisher.flush()
+    await asyncio.sleep(0.01)
+    # not redelivered while held
+    assert not broker.queues['mixed'].messages
+    await consumer.stop()
+
+    assert consumer.received == [{'a': 'orjson'}, {'a': 'json'}]
+    assert len(broker.queues['mixed'].messages) == 2
+    warnings = [record for record in caplog.records
+                if 'Unknown content type' in record.getMessage()]
+    assert len(warnings) == 1
+
+
+@pytest.mark.asyncio
+async def test_unknown_content_type_delay(event_loop):
+    """Delivery of unknown content type is requeued after delay.
+    """
+    backend = MemoryQueueBackend()
+    await backend.connect(loop=event_loop)
+    queue = await backend.get_queue('unknown', auto_delete=False)
+    consumer = SingleQueueConsumer(queue=queue, loop=event_loop)
+    consumer.requeue_delay = 0.02
+    await consumer.start()
+
+    backend.publisher.properties = spec.BasicProperties(
+        content_type='application/unknown'
+    )
+    with mock.patch.object(queue.acks, 'nack',
+                           wraps=queue.acks.nack) as nack:
+        await queue.publish({'a': 1}, routing_key='unknown', confirm=True)
+        await asyncio.sleep(0.1)
+        await consumer.stop()
+    # redelivered a few times, not in a loop
+    assert 2 <= nack.call_count <= 6
+    assert all(kwargs['requeue'] for _, kwargs in nack.call_args_list)
+    assert len(backend.broker.queues['unknown'].messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_compression(event_loop):
+    class CollectConsumer(SingleQueueConsumer):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.received = []
+
+        async def handler(self, message):
+            self.received.append(message)
+
+    backend = MemoryQueueBackend(compress_threshold=100)
+    await backend.connect(loop=event_loop)
+    queue = await backend.get_queue('compress', auto_delete=False)
+
+    small, large = {'text': 'x'}, {'text': 'x' * 1000}
+    await queue.publish(small, routing_key='compress')
+    await queue.publish(large, routing_key='compress')
+    await backend.publisher.flush()
+
+    messages = backend.broker.queues['compress'].messages
+    assert messages[0].properties.content_encoding is None
+    assert messages[1].properties.content_encoding == 'deflate'
+    assert len(messages[1].body) < 100
+
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+    await wait_messages(consumer, 2)
+    await consumer.stop()
+    assert consumer.received == [small, large]
+
+    properties = spec.BasicProperties(content_encoding='br')
+    with pytest.raises(UnknownContentType):
+        decode(properties, b'')
@@ -28,3 +28,53 @@ def test_class_from_string():
     class_from_string(
         'NullOutput', base='aiomessaging.contrib.dummy'
     )
+
+
+def test_consumer_channel():
+    conf = Config()
+    conf.from_dict({'consumers': {
+        'event': {'channel': 'shared', 'workers': 2},
+        'output': {'channel': 'unknown'},
+    }})
+    assert conf.get_consumer_channel('event') == 'shared'
+    assert conf.get_consumer_config('event') == {'workers': 2}
+    assert conf.get_consumer_channel('message') == 'consumer'
+    with pytest.raises(Exception):
+        conf.get_consumer_channel('output')
+
+
+def test_generation_mode():
+    conf = Config()
+    conf.from_dict({'events': {
+        'default': {},
+        'direct': {'generation': 'direct'},
+        'unknown': {'generation': 'unknown'},
+    }})
+    assert conf.get_generation_mode('default') == 'queue'
+    assert conf.get_generation_mode('direct') == 'direct'
+    with pytest.raises(Exception):
+        conf.get_generation_mode('unknown')
+
+
+def test_rate_limits():
+    conf = Config()
+    conf.from_dict({'rate_limits': {
+        'sms': 10,
+        'push': {'rate': 100, 'burst': 500},
+    }})
+    assert conf.get_rate_limits() == {
+        'sms': {'rate': 10},
+        'push': {'rate': 100, 'burst': 500},
+    }
+
+
+def test_circuit_breakers():
+    conf = Config()
+    conf.from_dict({'circuit_breakers': {
+        'sms': {'open_timeout': 10},
+        'push': None,
+    }})
+    assert conf.get_circuit_breakers() == {
+        'sms': {'open_timeout': 10},
+        'push': {},
+    }
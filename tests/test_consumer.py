@@ -1,7 +1,7 @@
 import asyncio
 import pytest
 
-from aiomessaging.queues import QueueBackend
+from aiomessaging.queues import QueueBackend, MemoryQueueBackend
 from aiomessaging.consumers.base import BaseConsumer, SingleQueueConsumer
 
 from .helpers import (
@@ -129,3 +129,134 @@ async def test_consume_multiple_queues(event_loop, caplog):
     assert log_count(caplog, level="ERROR") == 0
 
     backend.close()
+
+
+@pytest.mark.asyncio
+async def test_task_tracking(event_loop):
+    """Finished handler tasks are dropped by done callback.
+    """
+    class CounterConsumer(CounterConsumerMixin, SingleQueueConsumer):
+        pass
+
+    backend = MemoryQueueBackend()
+    await backend.connect(loop=event_loop)
+    queue = await backend.messages_queue('example_event')
+
+    consumer = CounterConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+    for i in range(3):
+        await queue.publish({'a': i})
+    await wait_messages(consumer, 3)
+    await asyncio.sleep(0)
+    await consumer.stop()
+
+    assert consumer.counter == 3
+    assert not consumer.msg_tasks
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_worker_pool(event_loop, caplog):
+    """Consume with fixed number of workers and bounded buffer.
+
+    Prefetch window is limited by pool capacity, so broker holds extra
+    deliveries instead of rejecting them back to the queue.
+    """
+    class SlowConsumer(SingleQueueConsumer):
+        active = 0
+        max_active = 0
+        counter = 0
+
+        async def handler(self, message):
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            await asyncio.sleep(0.01)
+            self.active -= 1
+            self.counter += 1
+
+    backend = MemoryQueueBackend()
+    await backend.connect(loop=event_loop)
+    queue = await backend.messages_queue('example_event')
+
+    consumer = SlowConsumer(queue=queue, loop=event_loop, workers=2,
+                            buffer_size=3)
+    await consumer.start()
+    assert len(consumer.worker_tasks) == 2
+    assert consumer.prefetch_count == 5
+
+    await queue.publish_many({'a': i} for i in range(10))
+    while consumer.counter < 10:
+        await asyncio.sleep(0.01)
+    await consumer.stop()
+
+    assert consumer.counter == 10
+    assert consumer.max_active == 2
+    assert not consumer.msg_tasks
+    assert not consumer.worker_tasks
+    assert log_count(caplog, level='WARNING') == 0
+    await backend.close()
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+@pytest.mark.asyncio
+async def test_graceful_stop(event_loop, workers):
+    """In-flight deliveries are completed and acked on stop.
+    """
+    class SlowConsumer(CounterConsumerMixin, SingleQueueConsumer):
+        async def handler(self, message):
+            await asyncio.sleep(0.02)
+            await super().handler(message)
+
+    backend = MemoryQueueBackend()
+    await backend.connect(loop=event_loop)
+    queue = await backend.messages_queue('example_event')
+    queue2 = await backend.generation_queue(name='gen.graceful_stop')
+
+    consumer = SlowConsumer(queue=queue, loop=event_loop, workers=workers)
+    await consumer.start()
+    consumer.consume(queue2)
+    await queue.publish_many({'a': i} for i in range(4))
+    await backend.publisher.flush()
+    await asyncio.sleep(0.01)
+    assert consumer.in_flight == 4
+    await consumer.stop()
+
+    assert consumer.counter == 4
+    assert not consumer.consuming_queues
+    assert not backend.broker.queues['messages.example_event'].messages
+    channel = await backend.channel()
+    assert not channel._unacked  # pylint: disable=protected-access
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_stop_timeout(event_loop):
+    """Stragglers are reported and left unacknowledged.
+    """
+    class HangConsumer(CounterConsumerMixin, SingleQueueConsumer):
+        async def handler(self, message):
+            await asyncio.sleep(10)
+
+    backend = MemoryQueueBackend()
+    await backend.connect(loop=event_loop)
+    queue = await backend.messages_queue('example_event')
+
+    consumer = HangConsumer(queue=queue, loop=event_loop, stop_timeout=0.01)
+    stragglers = []
+
+    async def on_stop_timeout(count):
+        stragglers.append(count)
+
+    consumer.on_stop_timeout(on_stop_timeout)
+    await consumer.start()
+    await queue.publish_many({'a': i} for i in range(2))
+    await backend.publisher.flush()
+    await asyncio.sleep(0.01)
+    await consumer.stop()
+
+    assert stragglers == [2]
+    assert consumer.in_flight == 0
+    assert not consumer.msg_tasks
+    channel = await backend.channel()
+    assert len(channel._unacked) == 2  # pylint: disable=protected-access
+    await backend.close()
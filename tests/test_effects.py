@@ -1,57 +1,434 @@
 """
 Output pipeline effects test.
 """
+import time
+import asyncio
+import threading
+
 import pytest
 
 from aiomessaging.message import Message
+from aiomessaging.outputs import (
+    AbstractOutputBackend,
+    CircuitBreaker,
+    close_batchers,
+    get_batcher,
+)
+from aiomessaging.exceptions import CheckDelivery, Retry
 from aiomessaging.effects import (
     SendEffect,
     OutputStatus,
 )
 from aiomessaging.actions import SendOutputAction, CheckOutputAction
+from aiomessaging.queues.backend import MAX_DELAY
 
 from aiomessaging.contrib.dummy import (
     NullOutput,
     FailingOutput,
     CheckOutput,
     NeverDeliveredOutput,
+    RetryOutput,
 )
 
+# pylint:disable=unused-import
+from .fixtures import output_registries  # noqa
+
 
-def test_send_simple():
+@pytest.mark.asyncio
+async def test_send_simple():
     """Check that SendEffect returns provided output.
     """
     effect = SendEffect(NullOutput())
     message = Message(id='test_send_simple', event_type="test_event")
     assert isinstance(effect.next_action(), SendOutputAction)
-    state = effect.apply(message)
+    state = await effect.apply(message)
     assert effect.next_action(state) is None
 
 
-def test_failing_action():
+@pytest.mark.asyncio
+async def test_failing_action():
     """Test that failing output properly handled.
     """
     message = Message(id='test_send_simple', event_type="test_event")
     effect = SendEffect(FailingOutput())
     with pytest.raises(Exception):
-        effect.apply(message)
+        await effect.apply(message)
 
 
-def test_never_delivered():
+@pytest.mark.asyncio
+async def test_never_delivered():
     """Test send through NeverDeliveredOutput
     """
     message = Message(id='test_send_simple', event_type="test_event")
     effect = SendEffect(NeverDeliveredOutput())
-    effect.apply(message)
+    await effect.apply(message)
 
 
-def test_next_action(caplog):
+@pytest.mark.asyncio
+async def test_next_action(caplog):
     message = Message(id='test_send_simple', event_type="test_event")
     effect = SendEffect(CheckOutput())
-    state = effect.apply(message)
+    state = await effect.apply(message)
     assert state == [OutputStatus.CHECK]
     message.set_route_state(effect, state)
     action = effect.next_action(state)
     assert isinstance(action, CheckOutputAction)
-    state = effect.apply(message)
+    state = await effect.apply(message)
     assert state == [OutputStatus.SUCCESS]
+
+
+@pytest.mark.asyncio
+async def test_delay():
+    """Retry and delivery check delays passed to message.
+    """
+    message = Message(id='test_delay', event_type="test_event")
+    effect = SendEffect(RetryOutput(retries=1, delay=5))
+    message.get_route_status(effect)  # route created by router
+    assert await effect.apply(message) == [OutputStatus.RETRY]
+    assert 4 < message.delay <= 5
+
+    message = Message(id='test_delay', event_type="test_event")
+    effect = SendEffect(CheckOutput(delay=10))
+    await effect.apply(message)
+    assert message.delay == 10
+
+    # delays over delay queue limit are held in parts
+    message = Message(id='test_delay', event_type="test_event")
+    effect = SendEffect(RetryOutput(retries=1, delay=10 ** 6))
+    message.get_route_status(effect)
+    await effect.apply(message)
+    assert message.delay == MAX_DELAY
+    assert message.get_route_not_before(effect) > time.time() + MAX_DELAY
+
+
+@pytest.mark.asyncio
+async def test_backoff():
+    """Retries spaced with output backoff policy.
+    """
+    output = RetryOutput(retries=3, backoff={'base': 10, 'jitter': 0})
+    assert [output.retry_delay(i) for i in range(3)] == [10, 20, 40]
+    assert output.retry_delay(100) == 300
+
+    output = RetryOutput(backoff={'base': 10, 'jitter': 1})
+    assert 0 <= output.retry_delay(0) <= 10
+
+    # policy stored in route with output
+    effect = SendEffect(output, NullOutput())
+    message = Message(id='test_backoff', event_type="test_event")
+    message.get_route_status(effect)
+    state = await effect.apply(message)
+    loaded = Message.from_dict(message.to_dict())
+    assert loaded.route[0].effect.args[0].kwargs['backoff']['base'] == 10
+    assert loaded.route[0].not_before == message.route[0].not_before
+
+    # other pending output is not delayed
+    assert state == [OutputStatus.RETRY, OutputStatus.PENDING]
+    assert message.delay is None
+
+    # retried output is delayed
+    message.set_route_state(effect, state)
+    state = await effect.apply(message)
+    assert state == [OutputStatus.RETRY, OutputStatus.SUCCESS]
+    assert 0 < message.delay <= 10
+
+
+@pytest.mark.asyncio
+async def test_retry_not_before():
+    """Message arrived before retry delay expired is held back.
+    """
+    message = Message(id='test_not_before', event_type="test_event")
+    effect = SendEffect(RetryOutput(retries=1, delay=5))
+    message.get_route_status(effect)
+    state = await effect.apply(message)
+    message.set_route_state(effect, state)
+
+    # delay queue returned message too early
+    message.delay = None
+    assert await effect.apply(message) == [OutputStatus.RETRY]
+    assert message.get_route_retry(effect) == 1
+    assert 4 < message.delay <= 5
+
+    message.set_route_not_before(effect, time.time() - 1)
+    assert await effect.apply(message) == [OutputStatus.SUCCESS]
+
+
+class BlockingOutput(AbstractOutputBackend):
+    name = 'blocking'
+    blocking = True
+    executor_size = 2
+
+    # calls are held until released by test
+    released = threading.Event()
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def send(self, message, retry=0):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        cls.released.wait(1)
+        with cls.lock:
+            cls.active -= 1
+        return threading.current_thread().name
+
+
+@pytest.mark.asyncio
+async def test_blocking_output(output_registries):
+    """Blocking output executed in bounded thread pool.
+    """
+    BlockingOutput.released.clear()
+    BlockingOutput.max_active = 0
+
+    effect = SendEffect(BlockingOutput())
+    action = effect.next_action()
+    message = Message(id='test_blocking', event_type="test_event")
+
+    task = asyncio.ensure_future(asyncio.gather(
+        *(action.execute(message) for _ in range(4))
+    ))
+
+    # event loop is not blocked while pool threads are busy
+    async def pool_busy():
+        while BlockingOutput.active < 2:
+            await asyncio.sleep(0.001)
+    await asyncio.wait_for(pool_busy(), 1)
+    await asyncio.sleep(0.01)
+    assert BlockingOutput.active == 2
+
+    BlockingOutput.released.set()
+    threads = await asyncio.wait_for(task, 1)
+
+    assert BlockingOutput.max_active == 2
+    assert len(set(threads)) == 2
+    assert all(name.startswith('output.blocking') for name in threads)
+
+
+class AsyncOutput(AbstractOutputBackend):
+    name = 'async'
+
+    active = 0
+    max_active = 0
+
+    async def send(self, message, retry=0):
+        cls = type(self)
+        cls.active += 1
+        cls.max_active = max(cls.max_active, cls.active)
+        await asyncio.sleep(0.01)
+        cls.active -= 1
+        return True
+
+    async def check(self, message):
+        await asyncio.sleep(0)
+        return True
+
+
+class AsyncCheckOutput(AsyncOutput):
+    name = 'async_check'
+
+    async def send(self, message, retry=0):
+        raise CheckDelivery(delay=1)
+
+
+@pytest.mark.asyncio
+async def test_async_output():
+    """Async outputs are awaited and overlap on event loop.
+    """
+    effect = SendEffect(AsyncOutput())
+    messages = [Message(id=f'test_async_{i}', event_type="test_event")
+                for i in range(100)]
+    AsyncOutput.max_active = 0
+    states = await asyncio.gather(
+        *(effect.apply(message) for message in messages)
+    )
+    # all sends were awaited at the same time
+    assert AsyncOutput.max_active == 100
+    assert all(state == [OutputStatus.SUCCESS] for state in states)
+
+    effect = SendEffect(AsyncCheckOutput())
+    message = messages[0]
+    state = await effect.apply(message)
+    assert state == [OutputStatus.CHECK]
+    assert message.delay == 1
+    message.set_route_state(effect, state)
+    assert isinstance(effect.next_action(state), CheckOutputAction)
+    assert await effect.apply(message) == [OutputStatus.SUCCESS]
+
+
+class BatchOutput(AbstractOutputBackend):
+    name = 'batch'
+    batch_size = 4
+    batch_window = 0.01
+
+    batches = []
+
+    async def send(self, message, retry=0):  # pragma: no cover
+        raise NotImplementedError
+
+    async def send_batch(self, messages, retries):
+        self.batches.append(len(messages))
+        results = []
+        for message in messages:
+            if message.id == 'retry':
+                results.append(Retry('busy', delay=1))
+            else:
+                results.append(message.id != 'fail')
+        return results
+
+
+@pytest.fixture
+def batch_output(output_registries):
+    """Batch output with clean sent batches and batcher.
+    """
+    BatchOutput.batches = []
+    yield BatchOutput
+    BatchOutput.batches = []
+
+
+@pytest.mark.asyncio
+async def test_batch_output(batch_output):
+    """Concurrent sends collected to batches, results mapped back.
+    """
+    effect = SendEffect(batch_output())
+    ids = ['ok', 'fail', 'retry', 'ok2', 'ok3']
+    messages = [Message(id=id_, event_type="test_event") for id_ in ids]
+    for message in messages:
+        message.get_route_status(effect)
+    states = await asyncio.gather(
+        *(effect.apply(message) for message in messages)
+    )
+    # full batch sent at once, the rest after window
+    assert batch_output.batches == [4, 1]
+    assert states == [
+        [OutputStatus.SUCCESS], [OutputStatus.FAIL], [OutputStatus.RETRY],
+        [OutputStatus.SUCCESS], [OutputStatus.SUCCESS],
+    ]
+
+    # batch grows while provider latency is stable
+    batcher = get_batcher(batch_output())
+    batcher.size.interval = 0
+    # latency noise of instant provider must not shrink batch
+    batcher.size.tolerance = float('inf')
+    for _ in range(3):
+        await asyncio.gather(*(
+            effect.apply(Message(id='ok', event_type="test_event"))
+            for _ in range(batcher.batch_size)
+        ))
+    assert batcher.batch_size > 4
+
+
+@pytest.mark.asyncio
+async def test_close_batchers(batch_output):
+    """Collected batch is sent on close and close waits for it.
+    """
+    batcher = get_batcher(batch_output(batch_window=60))
+    message = Message(id='ok', event_type="test_event")
+    sends = [asyncio.ensure_future(batcher.send(message)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert batch_output.batches == []
+
+    await close_batchers()
+    assert batch_output.batches == [2]
+    # pylint: disable=protected-access
+    assert not batcher._tasks
+    assert await asyncio.gather(*sends) == [True, True]
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('test', min_calls=4, window=4,
+                             open_timeout=10, slow_call=1)
+    for success in (True, False, True):
+        breaker.record(success, now=0)
+    assert breaker.state(0) == 'closed'
+    # slow call is a failure
+    breaker.record(True, duration=2, now=0)
+    assert breaker.state(0) == 'open'
+    assert not breaker.acquire(5)
+    assert breaker.retry_after(5) == 5
+
+    # single trial call of half-open breaker
+    assert breaker.acquire(10)
+    assert breaker.state(10) == 'half_open'
+    assert not breaker.acquire(10)
+    breaker.record(False, now=10)
+    assert breaker.state(11) == 'open'
+
+    assert breaker.acquire(20)
+    breaker.record(True, now=20)
+    assert breaker.state(20) == 'closed'
+
+
+class BrokenOutput(AbstractOutputBackend):
+    name = 'broken'
+    circuit_breaker = {'min_calls': 2, 'open_timeout': 60}
+    calls = 0
+
+    def send(self, message, retry=0):
+        BrokenOutput.calls += 1
+        return False
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_routing(output_registries):
+    """Output with open breaker is skipped by routing and deferred.
+    """
+    BrokenOutput.calls = 0
+    # time is frozen: breaker stays open for the whole test
+    BrokenOutput().get_circuit_breaker().clock = lambda: 0
+
+    effect = SendEffect(BrokenOutput(), NullOutput())
+    for i in range(2):
+        message = Message(id=f'test_breaker_{i}', event_type="test_event")
+        message.get_route_status(effect)
+        assert await effect.apply(message) == [OutputStatus.FAIL,
+                                               OutputStatus.PENDING]
+    assert BrokenOutput().get_circuit_breaker().state() == 'open'
+
+    # broken output skipped, next one selected at once
+    message = Message(id='test_breaker', event_type="test_event")
+    message.get_route_status(effect)
+    assert isinstance(effect.next_action().get_output(), NullOutput)
+    state = await effect.apply(message)
+    assert state == [OutputStatus.PENDING, OutputStatus.SUCCESS]
+
+    # then deferred until breaker is half-open, retry is not counted
+    message.set_route_state(effect, state)
+    state = await effect.apply(message)
+    assert state == [OutputStatus.RETRY, OutputStatus.SUCCESS]
+    assert 59 < message.delay <= 60
+    assert message.get_route_retry(effect) == 0
+    assert BrokenOutput.calls == 2
+
+
+class HangingOutput(AbstractOutputBackend):
+    name = 'hanging'
+    circuit_breaker = {'min_calls': 1, 'open_timeout': 60}
+
+    async def send(self, message, retry=0):
+        await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_cancel(output_registries):
+    """Cancelled trial call of half-open breaker is released.
+    """
+    now = 0
+    breaker = HangingOutput().get_circuit_breaker()
+    breaker.clock = lambda: now
+    breaker.record(False)
+    now = 60
+    assert breaker.state() == 'half_open'
+
+    effect = SendEffect(HangingOutput())
+    message = Message(id='test_breaker_cancel', event_type="test_event")
+    message.get_route_status(effect)
+    task = asyncio.ensure_future(effect.apply(message))
+    await asyncio.sleep(0)
+    assert not breaker.acquire()
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert breaker.state() == 'half_open'
+    assert breaker.acquire()
@@ -6,6 +6,8 @@ from aiomessaging.pipeline import EventPipeline, GenerationPipeline
 from aiomessaging.cluster import Cluster
 from aiomessaging.queues import QueueBackend
 from aiomessaging.event import Event
+from aiomessaging.exceptions import PublishError
+from aiomessaging.contrib.dummy import DummyGenerator
 
 from .helpers import (
     send_test_message,
@@ -14,6 +16,9 @@ from .helpers import (
     wait_messages,
 )
 
+# pylint:disable=unused-import
+from .fixtures import memory_backend  # noqa
+
 
 @pytest.mark.asyncio
 async def test_start(event_loop: asyncio.AbstractEventLoop, caplog):
@@ -92,6 +97,66 @@ async def test_error_handler(event_loop: asyncio.AbstractEventLoop, caplog):
     assert log_count(caplog, level='ERROR') == 1
 
 
+@pytest.mark.asyncio
+async def test_direct_generation(event_loop, memory_backend):
+    queue = await memory_backend.events_queue('example')
+    consumer = EventConsumer(
+        event_type='example',
+        loop=event_loop,
+        event_pipeline=EventPipeline([]),
+        generators=GenerationPipeline([DummyGenerator(msg_count=3)]),
+        queue_service=memory_backend,
+        direct=True,
+        queue=queue
+    )
+    complete = []
+
+    async def on_complete(queue_name):
+        complete.append(queue_name)  # pragma: no cover
+
+    consumer.on_generation_complete(on_complete)
+    await consumer.start()
+    await queue.publish({'type': 'example', 'a': 1}, routing_key=queue.name)
+    await wait_messages(consumer)
+    await consumer.stop()
+
+    messages = memory_backend.broker.queues['messages.example'].messages
+    assert len(messages) == 3
+    # no tmp queue and cluster broadcast
+    assert not complete
+    assert not [name for name in memory_backend.broker.queues
+                if name.startswith('gen.')]
+
+
+@pytest.mark.asyncio
+async def test_generation_confirmed(event_loop, memory_backend):
+    """Generation finished after generated messages were confirmed.
+    """
+    async def generator(event, queue):
+        # confirmation not requested by generator
+        await queue.publish(event.payload, routing_key=queue.routing_key)
+
+    consumer = EventConsumer(
+        event_type='example',
+        loop=event_loop,
+        event_pipeline=EventPipeline([]),
+        generators=GenerationPipeline([generator]),
+        queue_service=memory_backend,
+        direct=True,
+        queue=await memory_backend.events_queue('example')
+    )
+    await consumer.generate_messages(Event('example', payload={'a': 1}))
+    assert memory_backend.publisher.in_flight == 0
+    messages = memory_backend.broker.queues['messages.example'].messages
+    assert len(messages) == 1
+
+    # failed publish fails generation, so event is not acknowledged
+    with pytest.raises(PublishError):
+        await consumer.generate_messages(
+            Event('example', payload={'a': object()})
+        )
+
+
 class FailEventConsumer(EventConsumer):
     async def handle_event(self, event: Event):
         raise Exception("Test exception")
@@ -1,13 +1,20 @@
 import asyncio
 import pytest
 
+from pika import spec
+
 from aiomessaging.consumers import GenerationConsumer
+from aiomessaging.consumers.generation import end_of_stream
+from aiomessaging.exceptions import PublishError
 from aiomessaging.message import Message
 from aiomessaging.event import Event
 from aiomessaging.queues import QueueBackend
 
 from .helpers import send_test_message, has_log_message, wait_messages
 
+# pylint:disable=unused-import
+from .fixtures import memory_backend  # noqa
+
 
 @pytest.mark.asyncio
 async def test_simple(event_loop, caplog):
@@ -44,3 +51,150 @@ async def test_simple(event_loop, caplog):
     await backend.close()
 
     assert not has_log_message(caplog, level='ERROR')
+
+
+@pytest.mark.asyncio
+async def test_end_of_stream(event_loop, memory_backend):
+    messages_queue = await memory_backend.messages_queue('example_event')
+    consumer = GenerationConsumer(
+        messages_queue=messages_queue, loop=event_loop
+    )
+    await consumer.start()
+
+    queue = await memory_backend.generation_queue('example_event')
+    message = Message(event_type='example_event', event_id='test')
+    await queue.publish_many([message.to_dict()] * 3)
+    await queue.publish(end_of_stream(queue.name))
+    consumer.consume(queue)
+
+    broker = memory_backend.broker
+    await wait_queue_removed(broker, queue.name)
+    assert len(broker.queues['messages.example_event'].messages) == 3
+    assert not consumer.last_recived_time
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_requeue_before_marker(event_loop, memory_backend):
+    class FailOnceConsumer(GenerationConsumer):
+        failed = False
+
+        async def send_output(self, message):
+            if message.content.get('n') == 1 and not self.failed:
+                # marker is delivered while this one is handled
+                await asyncio.sleep(0.01)
+                self.failed = True
+                raise PublishError('not confirmed')
+            await super().send_output(message)
+
+    messages_queue = await memory_backend.messages_queue('example_event')
+    consumer = FailOnceConsumer(
+        messages_queue=messages_queue, loop=event_loop
+    )
+    await consumer.start()
+
+    queue = await memory_backend.generation_queue('example_event')
+    await queue.publish_many([
+        Message(event_type='example_event', event_id='test',
+                content={'n': n}).to_dict()
+        for n in range(3)
+    ])
+    await queue.publish(end_of_stream(queue.name))
+    consumer.consume(queue)
+
+    broker = memory_backend.broker
+    await wait_queue_removed(broker, queue.name)
+    await consumer.stop()
+
+    assert consumer.failed
+    # requeued message was not lost with tmp queue
+    assert len(broker.queues['messages.example_event'].messages) == 3
+
+
+@pytest.mark.asyncio
+async def test_rejected_delivery(event_loop, memory_backend):
+    """Deliveries not passed to handler are not tracked.
+    """
+    messages_queue = await memory_backend.messages_queue('example_event')
+    consumer = GenerationConsumer(
+        messages_queue=messages_queue, loop=event_loop
+    )
+    await consumer.start()
+
+    queue = await memory_backend.generation_queue('example_event')
+    consumer.consume(queue)
+    # held by consumer, can't be decoded
+    memory_backend.publisher.properties = spec.BasicProperties(
+        content_type='application/unknown'
+    )
+    await queue.publish({'a': 1}, confirm=True)
+    await asyncio.sleep(0.01)
+
+    # pylint: disable=protected-access
+    assert not consumer._delivery_queues
+    await consumer.stop()
+
+
+def test_batch_mode():
+    with pytest.raises(AssertionError):
+        GenerationConsumer(messages_queue=None, batch_size=10)
+
+
+async def wait_queue_removed(broker, name, timeout=1):
+    """Wait tmp queue auto-deleted by broker.
+    """
+    async def wait():
+        while name in broker.queues:
+            await asyncio.sleep(0.001)
+    await asyncio.wait_for(wait(), timeout)
+
+
+@pytest.mark.asyncio
+async def test_idle_cleanup(event_loop, memory_backend):
+    messages_queue = await memory_backend.messages_queue('example_event')
+    consumer = GenerationConsumer(
+        messages_queue=messages_queue, loop=event_loop,
+        cleanup_timeout=0.05
+    )
+    await consumer.start()
+
+    first = await memory_backend.generation_queue('example_event')
+    consumer.consume(first)
+    await asyncio.sleep(0.03)
+    second = await memory_backend.generation_queue('example_event')
+    consumer.consume(second)
+    await asyncio.sleep(0.03)
+
+    # first queue deleted by deadline, second one is not expired yet
+    assert list(consumer.last_recived_time) == [second]
+    await asyncio.sleep(0.04)
+    assert not consumer.last_recived_time
+    assert not [name for name in memory_backend.broker.queues
+                if name.startswith('gen.')]
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_route_by_event_type(event_loop, memory_backend):
+    for event_type in ('first_event', 'second_event'):
+        await memory_backend.messages_queue(event_type)
+    consumer = GenerationConsumer(
+        messages_queue=await memory_backend.messages_exchange(),
+        loop=event_loop
+    )
+    await consumer.start()
+
+    queue = await memory_backend.generation_queue('first_event')
+    await queue.publish_many([
+        Message(event_type='first_event', event_id='test').to_dict(),
+        Message(event_type='second_event', event_id='test').to_dict(),
+        Message(event_type='second_event', event_id='test').to_dict(),
+    ])
+    await queue.publish(end_of_stream(queue.name))
+    consumer.consume(queue)
+    await wait_messages(consumer, 4)
+    await consumer.stop()
+
+    queues = memory_backend.broker.queues
+    assert len(queues['messages.first_event'].messages) == 1
+    assert len(queues['messages.second_event'].messages) == 2
@@ -0,0 +1,508 @@
+"""
+In-memory queue backend tests.
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+from pika import frame, spec
+
+from aiomessaging.config import Config
+from aiomessaging.exceptions import PublishError
+from aiomessaging.outputs import BackoffPolicy
+from aiomessaging.queues import AbstractQueueBackend, MemoryQueueBackend, Queue
+from aiomessaging.queues.backend import delay_bucket
+from aiomessaging.queues.memory import MemoryBroker, MemoryBrokerError
+from aiomessaging.consumers.base import SingleQueueConsumer
+
+# pylint:disable=unused-import
+from .fixtures import memory_backend  # noqa
+
+from .helpers import log_count, wait_messages
+
+
+class CollectConsumer(SingleQueueConsumer):
+    """Collect received messages to list.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = []
+
+    async def handler(self, message):
+        self.received.append(message)
+
+
+@pytest.mark.asyncio
+async def test_declare_queue(memory_backend):
+    queue = await memory_backend.get_queue('test_declare')
+    assert isinstance(queue, Queue)
+    assert 'test_declare' in memory_backend.broker.queues
+
+    queue = await memory_backend.get_queue('')
+    assert queue.name.startswith('amq.gen')
+
+
+@pytest.mark.asyncio
+async def test_publish_consume(event_loop, memory_backend, caplog):
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+
+    await queue.publish({'a': 1})
+    await queue.publish({'a': 2})
+    await wait_messages(consumer, 2)
+    await consumer.stop()
+
+    assert consumer.received == [{'a': 1}, {'a': 2}]
+    assert log_count(caplog, level='ERROR') == 0
+
+
+@pytest.mark.asyncio
+async def test_direct_routing(memory_backend):
+    await memory_backend.output_queue('example_event', 'null')
+    await memory_backend.output_queue('example_event', 'console')
+    other = await memory_backend.get_queue(
+        'other', exchange='output.example_event', routing_key='sms'
+    )
+
+    await other.publish({'a': 1}, routing_key='null')
+    await other.publish({'a': 2}, routing_key='console')
+    await other.publish({'a': 3}, routing_key='sms')
+    await memory_backend.publisher.flush()
+
+    broker = memory_backend.broker
+    assert len(broker.queues['output.example_event'].messages) == 2
+    assert len(broker.queues['other'].messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_fanout(event_loop, memory_backend):
+    node_1 = await memory_backend.cluster_queue()
+    node_2 = await memory_backend.cluster_queue()
+
+    consumer_1 = CollectConsumer(queue=node_1, loop=event_loop)
+    consumer_2 = CollectConsumer(queue=node_2, loop=event_loop)
+    await consumer_1.start()
+    await consumer_2.start()
+
+    await node_1.publish({'action': 'test'})
+    await wait_messages(consumer_1)
+    await wait_messages(consumer_2)
+
+    await consumer_1.stop()
+    await consumer_2.stop()
+
+    assert consumer_1.received == consumer_2.received == [{'action': 'test'}]
+
+
+@pytest.mark.asyncio
+async def test_prefetch_and_ack(memory_backend):
+    memory_backend.prefetch_count = 2
+    queue = await memory_backend.get_queue('prefetch')
+    delivered = []
+
+    def handler(queue, channel, basic_deliver, properties, body):
+        delivered.append((channel, basic_deliver.delivery_tag))
+
+    queue.consume(handler)
+    for i in range(5):
+        await queue.publish({'a': i}, routing_key='prefetch')
+    await memory_backend.publisher.flush()
+    await asyncio.sleep(0)
+    assert len(delivered) == 2
+
+    channel, tag = delivered[-1]
+    channel.basic_ack(tag, multiple=True)
+    await asyncio.sleep(0)
+    assert len(delivered) == 4
+
+    with pytest.raises(MemoryBrokerError):
+        channel.basic_ack(tag)
+
+
+@pytest.mark.asyncio
+async def test_close_requeue(memory_backend):
+    queue = await memory_backend.get_queue('requeue', auto_delete=False)
+    queue.consume(lambda *args: None)
+    await queue.publish({'a': 1}, routing_key='requeue')
+    await memory_backend.publisher.flush()
+    await asyncio.sleep(0)
+
+    state = memory_backend.broker.queues['requeue']
+    assert not state.messages
+
+    await memory_backend.close()
+    assert len(state.messages) == 1
+    assert state.messages[0].redelivered
+
+
+@pytest.mark.asyncio
+async def test_auto_delete(memory_backend):
+    queue = await memory_backend.generation_queue('example_event')
+    await queue.publish({'a': 1})
+    assert queue.name in memory_backend.broker.queues
+
+    queue.consume(lambda *args: None)
+    queue.cancel()
+    assert queue.name not in memory_backend.broker.queues
+
+
+@pytest.mark.asyncio
+async def test_shared_broker(event_loop):
+    broker = MemoryBroker()
+    publisher = MemoryQueueBackend(broker=broker)
+    worker = MemoryQueueBackend(broker=broker)
+    await publisher.connect(loop=event_loop)
+    await worker.connect(loop=event_loop)
+
+    queue = await worker.events_queue('example_event')
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+
+    events = await publisher.events_queue('example_event')
+    await events.publish({'a': 1}, routing_key='events.example_event')
+    await wait_messages(consumer)
+    await consumer.stop()
+
+    assert consumer.received == [{'a': 1}]
+
+
+def test_config_backend():
+    conf = Config()
+    conf.from_dict({'queue': {'backend': 'memory', 'prefetch_count': 10}})
+    backend = conf.get_queue_backend()
+    assert isinstance(backend, MemoryQueueBackend)
+    assert backend.prefetch_count == 10
+
+    conf = Config()
+    conf.from_dict({'queue': {'backend': 'unknown'}})
+    with pytest.raises(Exception):
+        conf.get_queue_backend()
+
+
+def test_example_config_backend():
+    conf = Config()
+    conf.from_file('example.yml')
+    conf['queue']['backend'] = 'memory'
+    backend = conf.get_queue_backend()
+    assert isinstance(backend, MemoryQueueBackend)
+    # priority queues can't be redeclared over existing ones, off by default
+    assert backend.max_priority is None
+
+
+@pytest.mark.asyncio
+async def test_topology_cache(memory_backend):
+    channel = await memory_backend.channel()
+    with mock.patch.object(channel, 'queue_declare',
+                           wraps=channel.queue_declare) as queue_declare:
+        queue_1 = await memory_backend.messages_queue('example_event')
+        queue_2 = await memory_backend.messages_queue('example_event')
+        assert queue_declare.call_count == 1
+        assert queue_1 is not queue_2
+        assert queue_2.name == 'messages.example_event'
+
+        # server-named queues are never cached
+        await memory_backend.get_queue('')
+        await memory_backend.get_queue('')
+        assert queue_declare.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_topology_invalidation(memory_backend):
+    channel = await memory_backend.channel()
+    with mock.patch.object(channel, 'queue_declare',
+                           wraps=channel.queue_declare) as queue_declare:
+        queue = await memory_backend.generation_queue(name='gen.test')
+        await queue.delete()
+        await memory_backend.generation_queue(name='gen.test')
+        assert queue_declare.call_count == 2
+
+        memory_backend.invalidate_topology()
+        await memory_backend.generation_queue(name='gen.test')
+        assert queue_declare.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_topology_channel_closed(memory_backend):
+    channel = await memory_backend.channel()
+    queue = await memory_backend.generation_queue(name='gen.closed')
+    queue.consume(mock.Mock())
+    # consumer cancelled by channel close, auto-delete queue deleted
+    channel.close()
+    assert 'gen.closed' not in memory_backend.broker.queues
+
+    # auto-delete queue of closed channel declared again
+    queue = await memory_backend.generation_queue(name='gen.closed')
+    assert queue.channel_number != channel.channel_number
+    assert 'gen.closed' in memory_backend.broker.queues
+
+
+@pytest.mark.asyncio
+async def test_publish_many(event_loop, memory_backend):
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = CollectConsumer(queue=queue, loop=event_loop,
+                               last_messages_size=11)
+    await consumer.start()
+
+    channel = await memory_backend.channel('publish')
+    with mock.patch.object(channel, 'basic_publish',
+                           wraps=channel.basic_publish) as basic_publish:
+        written = await queue.publish_many({'a': i} for i in range(10))
+        await queue.publish({'a': 10})
+        assert not written.done()
+        assert memory_backend.publisher.pending == 11
+
+        await written
+        assert basic_publish.call_count == 11
+
+    await wait_messages(consumer, 11)
+    await consumer.stop()
+    assert consumer.received == [{'a': i} for i in range(11)]
+
+
+@pytest.mark.asyncio
+async def test_publish_many_stream(event_loop, memory_backend):
+    publisher = memory_backend.publisher
+    publisher.batch_size = 3
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = CollectConsumer(queue=queue, loop=event_loop,
+                               last_messages_size=10)
+    await consumer.start()
+
+    channel = await memory_backend.channel('publish')
+    buffered = []
+
+    def bodies():
+        for i in range(10):
+            buffered.append(publisher.pending)
+            yield {'a': i}
+            assert basic_publish.call_count >= i // 3 * 3
+
+    with mock.patch.object(channel, 'basic_publish',
+                           wraps=channel.basic_publish) as basic_publish:
+        written = await queue.publish_many(bodies(), confirm=True)
+    assert written.done()
+    # generator consumed chunk by chunk, full chunks written on the way
+    assert max(buffered) < 3
+
+    await wait_messages(consumer, 10)
+    await consumer.stop()
+    assert consumer.received == [{'a': i} for i in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_flush_chunks(memory_backend):
+    publisher = memory_backend.publisher
+    queue = await memory_backend.messages_queue('example_event')
+    await memory_backend.channel('publish')
+    for i in range(7):
+        await queue.publish({'a': i})
+    publisher.batch_size = 3
+    with mock.patch.object(publisher, 'flush_nowait',
+                           wraps=publisher.flush_nowait) as flush_nowait, \
+            mock.patch('asyncio.sleep', wraps=asyncio.sleep) as sleep:
+        await publisher.flush()
+    assert flush_nowait.call_count == 3
+    # loop released between chunks
+    assert sleep.call_count == 2
+    assert publisher.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_size(memory_backend):
+    memory_backend.publisher.batch_size = 3
+    queue = await memory_backend.messages_queue('example_event')
+    for i in range(7):
+        await queue.publish({'a': i})
+    assert memory_backend.publisher.pending == 1
+
+
+@pytest.mark.asyncio
+async def test_publish_confirm(memory_backend):
+    queue = await memory_backend.messages_queue('example_event')
+    confirmed = await queue.publish({'a': 1}, confirm=True)
+    assert confirmed.done()
+    assert memory_backend.publisher.in_flight == 0
+
+    confirmed = await queue.publish_many([{'a': 2}, {'a': 3}])
+    await memory_backend.publisher.flush()
+    assert memory_backend.publisher.in_flight == 2
+    await confirmed
+    assert memory_backend.publisher.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_publish_nack(memory_backend):
+    publisher = memory_backend.publisher
+    queue = await memory_backend.messages_queue('example_event')
+    first = await queue.publish({'a': 1})
+    second = await queue.publish({'a': 2})
+    await publisher.flush()
+
+    # broker rejected first message before memory channel confirmed it
+    publisher.on_confirm(frame.Method(1, spec.Basic.Nack(delivery_tag=1)))
+    with pytest.raises(PublishError):
+        await first
+    await second
+
+
+@pytest.mark.asyncio
+async def test_publish_encode_error(event_loop, memory_backend):
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+
+    broken = await queue.publish({'a': object()})
+    valid = await queue.publish({'a': 1})
+    await memory_backend.publisher.flush()
+
+    # only message which can't be encoded failed
+    with pytest.raises(PublishError):
+        await broken
+    await valid
+    await queue.publish({'a': 2}, confirm=True)
+
+    await wait_messages(consumer, 2)
+    await consumer.stop()
+    assert consumer.received == [{'a': 1}, {'a': 2}]
+
+
+@pytest.mark.asyncio
+async def test_publish_channel_closed(memory_backend):
+    queue = await memory_backend.get_queue(exchange='unknown',
+                                           routing_key='test')
+    await memory_backend.channel('publish')
+    memory_backend.broker.exchanges.pop('unknown')
+    with pytest.raises(PublishError):
+        await queue.publish({'a': 1}, confirm=True)
+
+    # publisher reopens channel
+    queue = await memory_backend.messages_queue('example_event')
+    await queue.publish({'a': 1}, confirm=True)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_flush(memory_backend):
+    publisher = memory_backend.publisher
+    channel = await memory_backend.channel('publish')
+    get_channel = memory_backend.channel
+
+    async def slow_channel(name='default'):
+        await asyncio.sleep(0)
+        return await get_channel(name)
+
+    queue = await memory_backend.messages_queue('example_event')
+    with mock.patch.object(memory_backend, 'channel', slow_channel), \
+            mock.patch.object(channel, 'confirm_delivery',
+                              wraps=channel.confirm_delivery) as confirm:
+        first = await queue.publish({'a': 1})
+        second = await queue.publish({'a': 2})
+        await asyncio.gather(publisher.flush(), publisher.flush())
+        assert confirm.call_count == 1
+
+    await asyncio.wait_for(asyncio.gather(first, second), 1)
+    assert publisher.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_ack_after_confirm(event_loop, memory_backend):
+    class FailingPublishConsumer(SingleQueueConsumer):
+        attempts = 0
+
+        async def handler(self, message):
+            self.attempts += 1
+            if self.attempts == 1:
+                raise PublishError("test")
+
+    queue = await memory_backend.get_queue('confirm_test', auto_delete=False)
+    consumer = FailingPublishConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+
+    await queue.publish({'a': 1}, routing_key='confirm_test')
+    await wait_messages(consumer)
+    await consumer.stop()
+
+    assert consumer.attempts == 2
+    assert not memory_backend.broker.queues['confirm_test'].messages
+
+
+@pytest.mark.asyncio
+async def test_publish_delayed(event_loop, memory_backend):
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+
+    await queue.publish({'a': 1}, delay=0.05, confirm=True)
+    await queue.publish({'a': 2})
+    await wait_messages(consumer)
+    assert consumer.received == [{'a': 2}]
+    assert memory_backend.delayed == 1
+
+    await asyncio.sleep(0.1)
+    await consumer.stop()
+    assert consumer.received == [{'a': 2}, {'a': 1}]
+    assert memory_backend.delayed == 0
+
+
+@pytest.mark.asyncio
+async def test_delay_buckets(memory_backend):
+    assert delay_bucket(0.01) == 63
+    assert delay_bucket(1) == 1000
+    assert 3000 <= delay_bucket(3) < 3300
+    assert delay_bucket(2 ** 16) == 2 ** 16 * 1000
+    # longer delay can't be published without arriving early
+    with pytest.raises(ValueError):
+        delay_bucket(2 ** 16 + 1)
+    queue = await memory_backend.messages_queue('example_event')
+    with pytest.raises(ValueError):
+        await queue.publish({'a': 1}, delay=10 ** 9)
+
+    # jittered retries of one attempt are spread over several buckets
+    policy = BackoffPolicy()
+    for retry in range(9):
+        buckets = {delay_bucket(policy.delay(retry)) for _ in range(1000)}
+        assert len(buckets) > 4
+
+    channel = await memory_backend.channel()
+    with mock.patch.object(channel, 'queue_declare',
+                           wraps=channel.queue_declare) as queue_declare:
+        # TTL + dead letter implementation used by RabbitMQ backend
+        await AbstractQueueBackend.publish_delayed(
+            memory_backend, 'messages.example_event', 'example_event',
+            {'a': 1}, 3
+        )
+        await memory_backend.publisher.flush()
+        _, kwargs = queue_declare.call_args
+        assert kwargs['arguments'] == {
+            'x-message-ttl': 3085,
+            'x-dead-letter-exchange': 'messages.example_event',
+            'x-dead-letter-routing-key': 'example_event',
+        }
+
+    name = 'delay.messages.example_event.example_event.3085ms'
+    assert len(memory_backend.broker.queues[name].messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_priority(event_loop):
+    backend = MemoryQueueBackend(max_priority=10)
+    await backend.connect(loop=event_loop)
+    queue = await backend.messages_queue('example_event')
+
+    await queue.publish({'a': 1})
+    await queue.publish({'a': 2, 'meta': {'priority': 5}})
+    await queue.publish({'a': 3}, priority=100)
+    await queue.publish_many([{'a': 4, 'meta': {'priority': 'high'}},
+                              {'a': 5, 'meta': {'priority': 5}}])
+    await backend.publisher.flush()
+
+    messages = backend.broker.queues['messages.example_event'].messages
+    assert len(messages) == 5
+    assert messages[0].properties.priority == 100
+
+    consumer = CollectConsumer(queue=queue, loop=event_loop)
+    await consumer.start()
+    await wait_messages(consumer, 5)
+    await consumer.stop()
+    assert [body['a'] for body in consumer.received] == [3, 2, 5, 1, 4]
@@ -41,6 +41,18 @@ def test_route_serialize():
     assert msg.route[0].serialize() == route.serialize()
 
 
+def test_route_serialize_not_before():
+    """Retry time is serialized only if set (old route format otherwise).
+    """
+    effect = send(NullOutput())
+    assert len(Route(effect=effect).serialize()) == 4
+
+    route = Route(effect=effect, retry_count=1, not_before=100.0)
+    data = route.serialize()
+    assert len(data) == 5
+    assert Route.load(data).not_before == 100.0
+
+
 def test_update_state():
     """Test route state update.
     """
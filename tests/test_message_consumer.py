@@ -2,13 +2,18 @@
 Message consumer tests.
 """
 import asyncio
+from unittest import mock
+
 import pytest
 
-from aiomessaging.consumers import MessageConsumer
+from aiomessaging.consumers import MessageConsumer, OutputConsumer
 from aiomessaging.message import Message
 from aiomessaging.queues import QueueBackend
 from aiomessaging.router import Router
-from aiomessaging.contrib.dummy.pipelines import example_pipeline
+from aiomessaging.contrib.dummy.pipelines import (
+    example_pipeline,
+    sequence_pipeline,
+)
 
 from .helpers import (
     has_log_message,
@@ -16,6 +21,9 @@ from .helpers import (
     wait_messages,
 )
 
+# pylint:disable=unused-import
+from .fixtures import memory_backend  # noqa
+
 
 @pytest.mark.asyncio
 async def test_simple(event_loop, caplog):
@@ -74,3 +82,117 @@ async def test_any_output_available(event_loop, caplog):
 
     # Skip output logs
     assert log_count(caplog, level='ERROR') == 0
+
+
+@pytest.mark.asyncio
+async def test_observed_dedupe(event_loop, memory_backend):
+    output_queue = await memory_backend.output_queue('example_event')
+    router = Router(output_pipeline=example_pipeline)
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = MessageConsumer(
+        event_type='example_event',
+        router=router,
+        output_queue=output_queue,
+        queue=queue,
+        loop=event_loop,
+        observed_ttl=0.05
+    )
+    observed = []
+
+    async def on_output_observed(event_type, output):
+        observed.append((event_type, output.name))
+
+    consumer.on_output_observed(on_output_observed)
+    await consumer.start()
+
+    for i in range(5):
+        message = Message(event_type='example_event', event_id=str(i))
+        await queue.publish(message.to_dict())
+    await wait_messages(consumer, 5)
+    assert len(observed) == 1
+    assert consumer.observed_suppressed == 4
+
+    # refreshed after TTL
+    await asyncio.sleep(0.06)
+    message = Message(event_type='example_event', event_id='last')
+    await queue.publish(message.to_dict())
+    await wait_messages(consumer)
+    await consumer.stop()
+    assert len(observed) == 2
+
+
+@pytest.mark.asyncio
+async def test_local_outputs(event_loop, memory_backend):
+    output_queue = await memory_backend.output_queue('example_event')
+    queue = await memory_backend.messages_queue('example_event')
+    output_consumer = OutputConsumer(
+        event_type='example_event',
+        router=Router(output_pipeline=sequence_pipeline),
+        messages_queue=queue,
+        queue=await memory_backend.output_queue('example_event', 'null'),
+        loop=event_loop
+    )
+    await output_consumer.start()
+    consumer = MessageConsumer(
+        event_type='example_event',
+        router=Router(output_pipeline=sequence_pipeline),
+        output_queue=output_queue,
+        queue=queue,
+        loop=event_loop,
+        local_outputs=True
+    )
+    consumer.add_local_output('null', output_consumer)
+    await consumer.start()
+
+    with mock.patch.object(output_consumer, 'apply_effect',
+                           wraps=output_consumer.apply_effect) as apply:
+        message = Message(event_type='example_event', event_id='1')
+        await queue.publish(message.to_dict())
+        await wait_messages(consumer)
+        assert apply.call_count == 2
+    await consumer.stop()
+    await output_consumer.stop()
+
+    # both effects applied without round-trip through the broker
+    assert not memory_backend.broker.queues['output.example_event'].messages
+    assert not memory_backend.broker.queues['messages.example_event'].messages
+
+
+@pytest.mark.asyncio
+async def test_batch_mode(event_loop, memory_backend):
+    output_queue = await memory_backend.output_queue('example_event')
+    # bind output queue to output routing key
+    await memory_backend.output_queue('example_event', 'null')
+    queue = await memory_backend.messages_queue('example_event')
+    consumer = MessageConsumer(
+        event_type='example_event',
+        router=Router(output_pipeline=sequence_pipeline),
+        output_queue=output_queue,
+        queue=queue,
+        loop=event_loop,
+        batch_size=10,
+        last_messages_size=20
+    )
+    await consumer.start()
+    channel = await memory_backend.channel()
+
+    with mock.patch.object(channel, 'basic_ack',
+                           wraps=channel.basic_ack) as basic_ack, \
+            mock.patch.object(output_queue, 'publish_many',
+                              wraps=output_queue.publish_many) as publish:
+        await queue.publish_many(
+            Message(event_type='example_event', event_id=str(i)).to_dict()
+            for i in range(15)
+        )
+        await wait_messages(consumer, 15)
+        await consumer.stop()
+
+        # full batch and the rest collected by timer
+        assert publish.call_count == 2
+        assert basic_ack.call_args_list == [
+            mock.call(10, multiple=True), mock.call(15, multiple=True),
+        ]
+
+    messages = memory_backend.broker.queues['output.example_event'].messages
+    assert len(messages) == 15
+    assert {m.routing_key for m in messages} == {'null'}
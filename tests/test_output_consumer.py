@@ -3,14 +3,24 @@ Output consumer test suite.
 """
 import pytest
 
+from aiomessaging.consumers import OutputConsumer
+from aiomessaging.message import Message
+from aiomessaging.outputs import (
+    TokenBucket,
+    get_rate_limiter,
+    set_rate_limit,
+)
+from aiomessaging.router import Router
+from aiomessaging.contrib.dummy import NullOutput
 from aiomessaging.contrib.dummy.pipelines import (
+    simple_pipeline,
     sequence_pipeline,
     failing_output_pipeline,
     all_dummy_pipeline,
 )
 
 # pylint:disable=unused-import
-from .fixtures import backend  # noqa
+from .fixtures import backend, memory_backend, output_registries  # noqa
 
 from .helpers import (
     OutputConsumerContext,
@@ -50,3 +60,65 @@ async def test_dummy_consumers(backend, caplog):
                             await wait_messages(last_ouput)
 
     assert log_count(caplog, level='ERROR') == 0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve(0) == 0
+    assert bucket.reserve(0) == 0
+    assert bucket.reserve(0) == pytest.approx(0.1)
+    assert bucket.reserve(0) == pytest.approx(0.2)
+    bucket.cancel()
+    # refilled with rate, not over burst
+    assert bucket.reserve(0.2) == 0
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(10) > 0
+
+    now = 0
+    bucket = TokenBucket(rate=1, clock=lambda: now)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 1
+    now = 2
+    assert bucket.reserve() == 0
+
+
+def test_rate_limiters(output_registries):
+    assert get_rate_limiter(NullOutput()) is None
+    limiter = get_rate_limiter(NullOutput(rate_limit=10))
+    assert limiter is get_rate_limiter(NullOutput(rate_limit=10))
+    assert limiter is not get_rate_limiter(NullOutput(rate_limit=20))
+
+    # config overrides output declaration
+    set_rate_limit('null', rate=5)
+    assert get_rate_limiter(NullOutput()).rate == 5
+    assert get_rate_limiter(NullOutput(rate_limit=10)).rate == 5
+
+
+@pytest.mark.asyncio
+async def test_rate_limit(event_loop, memory_backend, output_registries):
+    set_rate_limit('null', rate=50, burst=1)
+    # time is frozen: waits depend only on number of reserved tokens
+    get_rate_limiter(NullOutput()).clock = lambda: 0
+    messages_queue = await memory_backend.messages_queue('example_event')
+    queue = await memory_backend.output_queue('example_event', 'null')
+    consumer = OutputConsumer(
+        event_type='example_event',
+        router=Router(output_pipeline=simple_pipeline),
+        messages_queue=messages_queue,
+        queue=queue,
+        loop=event_loop,
+        rate_max_wait=0.05
+    )
+    await consumer.start()
+
+    await queue.publish_many(
+        Message(event_type='example_event', event_id=str(i)).to_dict()
+        for i in range(5)
+    )
+    await wait_messages(consumer, 5)
+    await consumer.stop()
+
+    # one message sent at once, two held (0.02s and 0.04s), others deferred
+    assert get_rate_limiter(NullOutput()).tokens == -2
+    assert memory_backend.delayed == 2
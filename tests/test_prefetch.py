@@ -0,0 +1,129 @@
+"""
+Adaptive prefetch tests.
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+from aiomessaging.consumers.base import SingleQueueConsumer
+from aiomessaging.consumers.prefetch import AdaptivePrefetch
+
+# pylint:disable=unused-import
+from .fixtures import memory_backend  # noqa
+
+
+def test_bounds():
+    prefetch = AdaptivePrefetch(initial=5000, min_count=2, max_count=100)
+    assert prefetch.prefetch_count == 100
+
+    prefetch = AdaptivePrefetch(min_count=2, max_count=100)
+    assert prefetch.prefetch_count == 2
+
+    with pytest.raises(AssertionError):
+        AdaptivePrefetch(min_count=10, max_count=5)
+
+
+def test_grow_and_shrink():
+    prefetch = AdaptivePrefetch(initial=8, interval=1, smoothing=1)
+
+    # window is not changed within interval
+    assert prefetch.observe(0.01, in_flight=8, now=0) is None
+    assert prefetch.observe(0.01, in_flight=8, now=0.5) is None
+
+    # latency stays on baseline and window is saturated
+    assert prefetch.observe(0.01, in_flight=8, now=1) == 10
+
+    # window is not used
+    assert prefetch.observe(0.01, in_flight=2, now=2) is None
+
+    # latency grows
+    assert prefetch.observe(0.1, in_flight=10, now=3) == 5
+    assert prefetch.prefetch_count == 5
+
+
+@pytest.mark.asyncio
+async def test_global_qos(memory_backend):
+    queue = await memory_backend.get_queue('global_qos')
+    delivered = []
+
+    def handler(queue, channel, basic_deliver, properties, body):
+        delivered.append((channel, basic_deliver.delivery_tag))
+
+    queue.set_prefetch(2)
+    queue.consume(handler)
+    for i in range(6):
+        await queue.publish({'a': i}, routing_key='global_qos')
+    await memory_backend.publisher.flush()
+    await asyncio.sleep(0)
+    assert len(delivered) == 2
+
+    # window of live consumer resized
+    queue.set_prefetch(4)
+    await asyncio.sleep(0)
+    assert len(delivered) == 4
+
+
+@pytest.mark.asyncio
+async def test_qos_per_channel(event_loop, memory_backend):
+    class NoopConsumer(SingleQueueConsumer):
+        async def handler(self, message):  # pragma: no cover
+            pass
+
+    channel = await memory_backend.channel('shared_qos')
+    with mock.patch.object(channel, 'basic_qos',
+                           wraps=channel.basic_qos) as basic_qos:
+        consumer = NoopConsumer(queue=None, loop=event_loop,
+                                prefetch_count=4)
+        for name in ('first_qos', 'second_qos'):
+            consumer.consume(await memory_backend.get_queue(
+                name, channel_name='shared_qos'
+            ))
+        # per-consumer limit dropped and window set once
+        assert basic_qos.call_args_list == [
+            mock.call(prefetch_count=0),
+            mock.call(prefetch_count=4, all_channels=True),
+        ]
+
+        basic_qos.reset_mock()
+        for queue in consumer.consuming_queues:
+            queue.set_prefetch(8)
+        basic_qos.assert_called_once_with(prefetch_count=8,
+                                          all_channels=True)
+    assert channel.global_prefetch_count == 8
+
+
+@pytest.mark.asyncio
+async def test_adaptive_consumer(event_loop, memory_backend):
+    class SlowConsumer(SingleQueueConsumer):
+        delay = 0.001
+        counter = 0
+
+        async def handler(self, message):
+            await asyncio.sleep(self.delay)
+            self.counter += 1
+
+    queue = await memory_backend.get_queue('adaptive', channel_name='test')
+    consumer = SlowConsumer(queue=queue, loop=event_loop, prefetch_count=4,
+                            adaptive_prefetch=True, max_prefetch=8)
+    consumer.prefetch.interval = 0
+    consumer.prefetch.tolerance = 20
+    consumer.prefetch.smoothing = 1
+    await consumer.start()
+    channel = await memory_backend.channel('test')
+    assert channel.global_prefetch_count == 4
+
+    await queue.publish_many(({'a': i} for i in range(40)),
+                             routing_key='adaptive')
+    while consumer.counter < 40:
+        await asyncio.sleep(0.001)
+    assert channel.global_prefetch_count == 8
+
+    consumer.delay = 0.1
+    await queue.publish_many(({'a': i} for i in range(8)),
+                             routing_key='adaptive')
+    while consumer.counter < 48:
+        await asyncio.sleep(0.01)
+    assert channel.global_prefetch_count < 8
+
+    await consumer.stop()
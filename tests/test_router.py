@@ -1,6 +1,8 @@
 """
 router test suite
 """
+import pytest
+
 from aiomessaging.router import Router
 from aiomessaging.message import Message, Route
 from aiomessaging.effects import SendEffect, EffectStatus
@@ -12,7 +14,8 @@ from aiomessaging.contrib.dummy.pipelines import (
 )
 
 
-def test_simple_pipeline():
+@pytest.mark.asyncio
+async def test_simple_pipeline():
     """Test router constructor and simple pipeline
     """
     router = Router(output_pipeline=simple_pipeline)
@@ -21,14 +24,15 @@ def test_simple_pipeline():
 
     assert isinstance(effect, SendEffect)
 
-    router.apply_next_effect(message)
+    await router.apply_next_effect(message)
 
     assert message.route
     assert isinstance(message.route[0], Route)
     assert message.route[0].effect == effect
 
 
-def test_sequence_send():
+@pytest.mark.asyncio
+async def test_sequence_send():
     """Test sequence pipeline flow.
     """
     router = Router(output_pipeline=sequence_pipeline)
@@ -38,7 +42,7 @@ def test_sequence_send():
     assert isinstance(effect, SendEffect)
     assert effect.next_action().get_output().kwargs == {'test_arg': 2}
 
-    router.apply_next_effect(message)
+    await router.apply_next_effect(message)
 
     assert message.route
     assert isinstance(message.route[0], Route)
@@ -47,7 +51,7 @@ def test_sequence_send():
     assert isinstance(effect, SendEffect)
     assert effect.next_action().get_output().kwargs == {'test_arg': 1}
 
-    router.apply_next_effect(message)
+    await router.apply_next_effect(message)
 
     assert router.next_effect(message) is None
 